@@ -0,0 +1,87 @@
+import shutil
+from .config import DOWNLOAD_PATH, DISK_BUDGET_MB, DISK_RESERVE_MB, SPOOL_PATH, SPOOL_BUDGET_MB
+
+class DiskBudget:
+    """
+    Byte reservations against the download volume.
+
+    A job reserves its estimated size before it may start; once the download reports
+    its real size the reservation is corrected. Reservations are keyed by
+    (video key, format_id) and reference-counted, so users sharing one download share
+    one reservation. Jobs that do not fit wait in the queue instead of hitting ENOSPC.
+    """
+    def __init__(self, path=DOWNLOAD_PATH, budget_mb=DISK_BUDGET_MB, reserve_mb=DISK_RESERVE_MB):
+        self.path = path
+        self.margin = reserve_mb * 1024 * 1024
+        self._budget = budget_mb * 1024 * 1024 if budget_mb > 0 else None
+        self.reservations = {}  # key -> [reserved, written, refs]
+
+    @property
+    def budget(self):
+        if self._budget is None:
+            # Auto: whatever is free on first use, i.e. after startup cleaned the download dir
+            self._budget = max(0, shutil.disk_usage(self.path).free - self.margin)
+        return self._budget
+
+    @property
+    def reserved(self):
+        return sum(r[0] for r in self.reservations.values())
+
+    def _fits(self, nbytes):
+        if not self.reservations:
+            # Nothing else is running: admit even oversized jobs rather than deadlock
+            return True
+        if self.reserved + nbytes > self.budget:
+            return False
+        # Other processes may use the volume too, so also check what is actually free
+        outstanding = sum(max(0, r[0] - r[1]) for r in self.reservations.values())
+        free = shutil.disk_usage(self.path).free - self.margin
+        return free >= outstanding + nbytes
+
+    def try_reserve(self, key, nbytes):
+        """Reserves `nbytes` for `key`. Returns False if it does not fit right now."""
+        entry = self.reservations.get(key)
+        if entry is not None:
+            # Already downloading for someone else, no extra disk needed
+            entry[2] += 1
+            return True
+        if not self._fits(nbytes):
+            return False
+        self.reservations[key] = [nbytes, 0, 1]
+        return True
+
+    def adjust(self, key, written, total=None):
+        """Updates a reservation with bytes on disk and, when known, the real total size."""
+        entry = self.reservations.get(key)
+        if entry is None:
+            return
+        entry[1] = written
+        actual = max(written, total or 0)
+        if total and actual != entry[0]:
+            entry[0] = actual
+        elif written > entry[0]:
+            # Estimate was too low and no total is known, grow with the data
+            entry[0] = written
+
+    def release(self, key):
+        entry = self.reservations.get(key)
+        if entry is None:
+            return
+        entry[2] -= 1
+        if entry[2] <= 0:
+            del self.reservations[key]
+
+    def describe(self):
+        return f"{self.reserved / 1024 / 1024:.0f} MB reserved of {self.budget / 1024 / 1024:.0f} MB"
+
+class SpoolBudget(DiskBudget):
+    """
+    Reservations against the tmpfs spool of the small-clip fast path. Its memory is
+    shared with the bot, so unlike the disk budget nothing is admitted beyond it.
+    """
+    def _fits(self, nbytes):
+        return self.reserved + nbytes <= self.budget and super()._fits(nbytes)
+
+disk_budget = DiskBudget()
+# None when the fast path is disabled
+spool_budget = SpoolBudget(SPOOL_PATH, SPOOL_BUDGET_MB, 0) if SPOOL_PATH and SPOOL_BUDGET_MB > 0 else None
@@ -0,0 +1,120 @@
+import time
+from .config import FILE_CACHE_ENABLED, FILE_CACHE_DB, FILE_CACHE_MAX_ENTRIES, FILE_CACHE_MAX_AGE_DAYS
+from .store import SQLiteStore
+from .logger import logger
+from .utils import normalize_url
+
+def make_video_key(info, url):
+    """Identifies a video by extractor and id when known, otherwise by its normalized URL."""
+    if info.get('id') and info.get('platform'):
+        return f"{info['platform']}:{info['id']}"
+    return normalize_url(url)
+
+class FileIdCache(SQLiteStore):
+    """
+    Persistent map of (video key, format_id, chunk size, part index) -> Telegram file_id.
+    A job is only served from the cache once all of its parts were recorded and
+    `complete` stored the part count. Methods are blocking; call them via asyncio.to_thread.
+    """
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS parts ("
+        " video_key TEXT NOT NULL,"
+        " format_id TEXT NOT NULL,"
+        " chunk_size INTEGER NOT NULL,"
+        " part_index INTEGER NOT NULL,"
+        " part_count INTEGER,"
+        " file_id TEXT NOT NULL,"
+        " name TEXT,"
+        " size INTEGER,"
+        " created_at REAL NOT NULL,"
+        " last_used REAL NOT NULL,"
+        " PRIMARY KEY (video_key, format_id, chunk_size, part_index))",
+        "CREATE INDEX IF NOT EXISTS parts_last_used ON parts (last_used)",
+    ]
+
+    def __init__(self, db_path=FILE_CACHE_DB, max_entries=FILE_CACHE_MAX_ENTRIES, max_age_days=FILE_CACHE_MAX_AGE_DAYS):
+        super().__init__(db_path)
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400
+
+    def get_parts(self, video_key, format_id, chunk_size):
+        """
+        Returns the cached parts as a list of dicts ordered by part index,
+        or None if the job was never completed or has expired.
+        """
+        with self.lock:
+            conn = self._connect()
+            rows = conn.execute(
+                "SELECT part_index, part_count, file_id, name, size, created_at FROM parts"
+                " WHERE video_key = ? AND format_id = ? AND chunk_size = ? ORDER BY part_index",
+                (video_key, format_id, chunk_size)
+            ).fetchall()
+
+            if not rows:
+                return None
+
+            part_count = rows[0][1]
+            now = time.time()
+            if (
+                part_count is None
+                or len(rows) != part_count
+                or any(row[0] != i or row[1] != part_count for i, row in enumerate(rows))
+                or any(now - row[5] > self.max_age for row in rows)
+            ):
+                return None
+
+            conn.execute(
+                "UPDATE parts SET last_used = ? WHERE video_key = ? AND format_id = ? AND chunk_size = ?",
+                (now, video_key, format_id, chunk_size)
+            )
+            conn.commit()
+
+        return [{'file_id': row[2], 'name': row[3], 'size': row[4]} for row in rows]
+
+    def put_part(self, video_key, format_id, chunk_size, part_index, file_id, name=None, size=None):
+        """Records the file_id of one uploaded part. The job stays incomplete until `complete`."""
+        now = time.time()
+        self.execute(
+            "INSERT OR REPLACE INTO parts"
+            " (video_key, format_id, chunk_size, part_index, part_count, file_id, name, size, created_at, last_used)"
+            " VALUES (?, ?, ?, ?, NULL, ?, ?, ?, ?, ?)",
+            (video_key, format_id, chunk_size, part_index, file_id, name, size, now, now)
+        )
+
+    def complete(self, video_key, format_id, chunk_size, part_count):
+        """Marks a job as fully uploaded so later requests can be served from the cache."""
+        with self.lock:
+            conn = self._connect()
+            conn.execute(
+                "DELETE FROM parts WHERE video_key = ? AND format_id = ? AND chunk_size = ? AND part_index >= ?",
+                (video_key, format_id, chunk_size, part_count)
+            )
+            conn.execute(
+                "UPDATE parts SET part_count = ? WHERE video_key = ? AND format_id = ? AND chunk_size = ?",
+                (part_count, video_key, format_id, chunk_size)
+            )
+            conn.commit()
+        self.prune()
+
+    def invalidate(self, video_key, format_id, chunk_size):
+        """Drops a job, e.g. when Telegram no longer accepts one of its file_ids."""
+        self.execute(
+            "DELETE FROM parts WHERE video_key = ? AND format_id = ? AND chunk_size = ?",
+            (video_key, format_id, chunk_size)
+        )
+
+    def prune(self):
+        """Evicts entries older than the max age, then the least recently used beyond max entries."""
+        with self.lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM parts WHERE created_at < ?", (time.time() - self.max_age,))
+            count = conn.execute("SELECT COUNT(*) FROM parts").fetchone()[0]
+            if count > self.max_entries:
+                conn.execute(
+                    "DELETE FROM parts WHERE rowid IN (SELECT rowid FROM parts ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+                logger.info(f"File cache evicted {count - self.max_entries} entries")
+            conn.commit()
+
+file_cache = FileIdCache() if FILE_CACHE_ENABLED else None
@@ -0,0 +1,39 @@
+class JobCancelled(Exception):
+    """Raised where a cancelled job notices its token."""
+    pass
+
+class JobInterrupted(Exception):
+    """Raised to jobs whose download was stopped by a shutdown; they resume on the next start."""
+    pass
+
+class CancelToken:
+    """
+    Cancellation flag shared by everything working for one job.
+    `cancelled` may be read from any thread (e.g. yt-dlp hooks); `cancel` and the
+    callbacks run on the event loop.
+    """
+    def __init__(self):
+        self.cancelled = False
+        self.callbacks = []
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def on_cancel(self, callback):
+        """Runs `callback` when the token is cancelled, right away if it already is."""
+        if self.cancelled:
+            callback()
+        else:
+            self.callbacks.append(callback)
+
+    def check(self):
+        if self.cancelled:
+            raise JobCancelled("Cancelled.")
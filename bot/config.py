@@ -1,5 +1,6 @@
 import os
 import sys
+import socket
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -12,19 +13,217 @@ def get_env_variable(var_name, default=None, required=False):
         sys.exit(1)
     return value
 
+def get_bool_variable(var_name, default=False):
+    value = os.getenv(var_name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+# Self-hosted telegram-bot-api server (--local mode): uploads up to 2000 MB instead of 50 MB.
+# With shared files the server can read DOWNLOAD_PATH under the same path and parts are passed as file:// URIs.
+LOCAL_BOT_API = get_bool_variable("LOCAL_BOT_API", False)
+LOCAL_BOT_API_URL = get_env_variable("LOCAL_BOT_API_URL", "http://localhost:8081").rstrip("/")
+LOCAL_BOT_API_SHARED_FILES = get_bool_variable("LOCAL_BOT_API_SHARED_FILES", True)
+
 # Bot Configuration
 BOT_TOKEN = get_env_variable("BOT_TOKEN", required=True)
 DOWNLOAD_PATH = get_env_variable("DOWNLOAD_PATH", "downloads")
-MAX_CHUNK_SIZE_MB = int(get_env_variable("MAX_CHUNK_SIZE_MB", 50))
+MAX_CHUNK_SIZE_MB = int(get_env_variable("MAX_CHUNK_SIZE_MB", 2000 if LOCAL_BOT_API else 50))
 MAX_CONCURRENT_DOWNLOADS = int(get_env_variable("MAX_CONCURRENT_DOWNLOADS", 30))
 THREAD_POOL_SIZE = int(get_env_variable("THREAD_POOL_SIZE", 50))
 LOG_FILE = get_env_variable("LOG_FILE", "logs/bot.log")
 YTDLP_COOKIES_FILE = get_env_variable("YTDLP_COOKIES_FILE", "cookies.txt")
+DATA_PATH = get_env_variable("DATA_PATH", "data")
+
+# Deployment role: "standalone" runs everything in one process; a "frontend" receives updates
+# and queues jobs in JOB_DB, and "worker" processes run them. Workers sharing a host need
+# distinct WORKER_IDs: each keeps its downloads under DOWNLOAD_PATH/<WORKER_ID>.
+BOT_ROLE = get_env_variable("BOT_ROLE", "standalone").strip().lower()
+if BOT_ROLE not in ("standalone", "frontend", "worker"):
+    print(f"Error: BOT_ROLE must be standalone, frontend or worker, not {BOT_ROLE!r}.")
+    sys.exit(1)
+WORKER_ID = get_env_variable("WORKER_ID") or socket.gethostname()
+if BOT_ROLE == "worker":
+    DOWNLOAD_PATH = os.path.join(DOWNLOAD_PATH, WORKER_ID)
+# Jobs one worker runs at once; MAX_CONCURRENT_DOWNLOADS is the limit across all workers
+WORKER_SLOTS = int(get_env_variable("WORKER_SLOTS", MAX_CONCURRENT_DOWNLOADS))
+# A running job whose worker has not checked in for this long goes back to the queue
+JOB_LEASE_SECONDS = int(get_env_variable("JOB_LEASE_SECONDS", 60))
+JOB_POLL_INTERVAL = float(get_env_variable("JOB_POLL_INTERVAL", 2))
+# Front-end: receive updates by webhook when WEBHOOK_URL is set (needs python-telegram-bot[webhooks])
+WEBHOOK_URL = get_env_variable("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = get_env_variable("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(get_env_variable("WEBHOOK_PORT", 8443))
+WEBHOOK_SECRET = get_env_variable("WEBHOOK_SECRET", "")
+
+# Job scheduler: persistent queue with per-user fairness; weights as "user_id=weight,..."
+JOB_DB = get_env_variable("JOB_DB", os.path.join(DATA_PATH, "jobs.db"))
+MAX_QUEUED_JOBS_PER_USER = int(get_env_variable("MAX_QUEUED_JOBS_PER_USER", 3))
+DEFAULT_JOB_SIZE_MB = int(get_env_variable("DEFAULT_JOB_SIZE_MB", 200))
+SJF_AGING_SECONDS = int(get_env_variable("SJF_AGING_SECONDS", 300))
+QUEUE_STATUS_INTERVAL = int(get_env_variable("QUEUE_STATUS_INTERVAL", 15))
+# Partial downloads and sent parts of running jobs, so they resume after a restart
+JOURNAL_DB = get_env_variable("JOURNAL_DB", os.path.join(DATA_PATH, "journal.db"))
+USER_WEIGHTS = {
+    int(user_id): float(weight)
+    for user_id, weight in (
+        item.split("=", 1) for item in get_env_variable("USER_WEIGHTS", "").split(",")
+        if "=" in item
+    )
+}
+
+# Admission control: bytes reserved per job on the download volume; 0 = free space at startup
+DISK_BUDGET_MB = int(get_env_variable("DISK_BUDGET_MB", 0))
+DISK_RESERVE_MB = int(get_env_variable("DISK_RESERVE_MB", 1024))
+
+# Progress reporting: producer-side throttle and status message edit limits
+PROGRESS_INTERVAL = float(get_env_variable("PROGRESS_INTERVAL", 1.0))
+STATUS_EDIT_INTERVAL = float(get_env_variable("STATUS_EDIT_INTERVAL", 3.0))
+STATUS_EDITS_PER_SECOND = float(get_env_variable("STATUS_EDITS_PER_SECOND", 20))
+
+# Uploads: process-wide adaptive concurrency (AIMD) between these bounds
+UPLOAD_INITIAL_CONCURRENCY = int(get_env_variable("UPLOAD_INITIAL_CONCURRENCY", 3))
+UPLOAD_MIN_CONCURRENCY = int(get_env_variable("UPLOAD_MIN_CONCURRENCY", 1))
+UPLOAD_MAX_CONCURRENCY = int(get_env_variable("UPLOAD_MAX_CONCURRENCY", 12))
+
+# Bot API connection pools: uploads and control calls (edits, callback answers) do not share connections
+MEDIA_POOL_SIZE = int(get_env_variable("MEDIA_POOL_SIZE", UPLOAD_MAX_CONCURRENCY + 4))
+CONTROL_POOL_SIZE = int(get_env_variable("CONTROL_POOL_SIZE", 32))
+CONTROL_TIMEOUT = float(get_env_variable("CONTROL_TIMEOUT", 10))
+CONTROL_POOL_TIMEOUT = float(get_env_variable("CONTROL_POOL_TIMEOUT", 5))
+MEDIA_POOL_TIMEOUT = float(get_env_variable("MEDIA_POOL_TIMEOUT", 60))
+# HTTP/2 for control calls, needs httpx[http2]
+HTTP2 = get_bool_variable("HTTP2", False)
+
+# Send up to ALBUM_SIZE parts per sendMediaGroup request instead of one request per part
+ALBUM_UPLOADS = get_bool_variable("ALBUM_UPLOADS", True)
+ALBUM_SIZE = min(10, max(2, int(get_env_variable("ALBUM_SIZE", 10))))
+# Album members are held in memory together unless the local server reads them from disk
+ALBUM_MAX_MB = int(get_env_variable("ALBUM_MAX_MB", 200))
+# Send a job's parts (or albums) one after another so they appear in order in the chat.
+# Off, a single job uploads several requests at once but later parts may arrive first.
+ORDERED_UPLOADS = get_bool_variable("ORDERED_UPLOADS", True)
+
+# Watchdog: abort stages slower than STALL_MIN_SPEED_KB over STALL_WINDOW seconds, or past their deadline (0 = none)
+WATCHDOG_INTERVAL = float(get_env_variable("WATCHDOG_INTERVAL", 5))
+STALL_WINDOW = int(get_env_variable("STALL_WINDOW", 120))
+STALL_MIN_SPEED_KB = float(get_env_variable("STALL_MIN_SPEED_KB", 32))
+DOWNLOAD_DEADLINE = int(get_env_variable("DOWNLOAD_DEADLINE", 4 * 3600))
+SPLIT_DEADLINE = int(get_env_variable("SPLIT_DEADLINE", 1800))
+UPLOAD_DEADLINE = int(get_env_variable("UPLOAD_DEADLINE", 2 * 3600))
+
+# Updates processed at once; each user's updates still run one at a time, in order
+UPDATE_CONCURRENCY = int(get_env_variable("UPDATE_CONCURRENCY", 64))
+
+# Analyzed URLs waiting for a quality choice: lifetime and how many are kept across all users
+REQUEST_TTL = int(get_env_variable("REQUEST_TTL", 3600))
+MAX_PENDING_REQUESTS = int(get_env_variable("MAX_PENDING_REQUESTS", 1000))
+
+# Download engine. Profiles per extractor or host suffix as "key=fragments/buffer_kb/http_chunk_mb,..."
+# (0 MB = no chunking); fragment concurrency is then tuned per host from measured throughput.
+DOWNLOAD_PROFILES = {
+    key.strip().lower(): tuple(int(v) for v in value.split("/"))
+    for key, value in (
+        item.split("=", 1) for item in get_env_variable("DOWNLOAD_PROFILES", "youtube=4/1024/10,generic=4/256/0").split(",")
+        if item.count("/") == 2
+    )
+}
+HOST_CONNECTION_BUDGET = int(get_env_variable("HOST_CONNECTION_BUDGET", 16))
+MAX_FRAGMENT_CONCURRENCY = int(get_env_variable("MAX_FRAGMENT_CONCURRENCY", 16))
+# Use aria2c (when installed, Linux only) for single-file downloads that are not split while
+# downloading. Its progress is measured from the file and it is killed on cancel.
+USE_ARIA2C = get_bool_variable("USE_ARIA2C", False)
+
+# Extraction metadata cache; per-site TTLs as "youtube=1800,generic=300"
+METADATA_CACHE_SIZE = int(get_env_variable("METADATA_CACHE_SIZE", 256))
+METADATA_CACHE_TTL = int(get_env_variable("METADATA_CACHE_TTL", 600))
+METADATA_CACHE_TTLS = {
+    name.strip().lower(): int(ttl)
+    for name, ttl in (
+        item.split("=", 1) for item in get_env_variable("METADATA_CACHE_TTLS", "youtube=1800,generic=300").split(",")
+        if "=" in item
+    )
+}
+
+# Per-site token buckets in front of extraction and downloads, as "site=requests_per_second/burst".
+# Sites are named like extractors ("youtube", "dailymotion"); others get SITE_RATE_LIMIT.
+def _parse_rate(value):
+    rate, burst = value.split("/", 1)
+    return float(rate), int(burst)
+
+SITE_RATE_LIMIT = _parse_rate(get_env_variable("SITE_RATE_LIMIT", "1/5"))
+SITE_RATE_LIMITS = {
+    name.strip().lower(): _parse_rate(value)
+    for name, value in (
+        item.split("=", 1) for item in get_env_variable("SITE_RATE_LIMITS", "youtube=2/10").split(",")
+        if "=" in item and "/" in item
+    )
+}
+# Extractions that would queue longer than this for their site are refused
+SITE_RATE_MAX_WAIT = int(get_env_variable("SITE_RATE_MAX_WAIT", 30))
+# Failed extractions are remembered per error type, as "type=seconds"
+NEGATIVE_CACHE_TTLS = {
+    kind.strip().lower(): int(ttl)
+    for kind, ttl in (
+        item.split("=", 1) for item in get_env_variable("NEGATIVE_CACHE_TTLS", "auth=600,not_found=300,throttled=60,error=30").split(",")
+        if "=" in item
+    )
+}
+
+# Extraction runs in pre-warmed worker processes; 0 extracts in threads of the bot process
+EXTRACTION_WORKERS = int(get_env_variable("EXTRACTION_WORKERS", 2))
+EXTRACTION_TIMEOUT = int(get_env_variable("EXTRACTION_TIMEOUT", 60))
+EXTRACTION_MAX_TASKS = int(get_env_variable("EXTRACTION_MAX_TASKS", 100))
+
+# Pipeline: cut and upload parts while the download is still running
+PIPELINE_MODE = get_bool_variable("PIPELINE_MODE", True)
+PIPELINE_POLL_INTERVAL = float(get_env_variable("PIPELINE_POLL_INTERVAL", 0.5))
+# Upload parts as byte ranges of the original file instead of writing part files.
+# Off by default when parts are passed to a local server by path, which needs real files.
+VIRTUAL_CHUNKS = get_bool_variable("VIRTUAL_CHUNKS", not (LOCAL_BOT_API and LOCAL_BOT_API_SHARED_FILES))
+
+# Re-send previously uploaded parts by Telegram file_id
+FILE_CACHE_ENABLED = get_bool_variable("FILE_CACHE_ENABLED", True)
+FILE_CACHE_DB = get_env_variable("FILE_CACHE_DB", os.path.join(DATA_PATH, "file_cache.db"))
+FILE_CACHE_MAX_ENTRIES = int(get_env_variable("FILE_CACHE_MAX_ENTRIES", 50000))
+FILE_CACHE_MAX_AGE_DAYS = int(get_env_variable("FILE_CACHE_MAX_AGE_DAYS", 30))
+
+# Small-clip fast path: downloads expected to fit in one part are staged in a tmpfs spool (RAM)
+# within SPOOL_BUDGET_MB, and moved to DOWNLOAD_PATH if they turn out bigger. Empty disables it.
+# Off by default with a local Bot API server reading shared files, it only sees DOWNLOAD_PATH.
+SPOOL_PATH = get_env_variable(
+    "SPOOL_PATH",
+    "/dev/shm/video-splitter-bot" if os.path.isdir("/dev/shm") and not (LOCAL_BOT_API and LOCAL_BOT_API_SHARED_FILES) else ""
+)
+SPOOL_BUDGET_MB = int(get_env_variable("SPOOL_BUDGET_MB", 256))
+if SPOOL_PATH and BOT_ROLE == "worker":
+    SPOOL_PATH = os.path.join(SPOOL_PATH, WORKER_ID)
 
 # Ensure download directory exists
 if not os.path.exists(DOWNLOAD_PATH):
     os.makedirs(DOWNLOAD_PATH)
 
+# Logging pipeline: records are queued and written in batches by a background thread.
+# Tagged high-frequency messages can be sampled, keeping 1 in N: "tag=N,..."
+LOG_QUEUE_SIZE = int(get_env_variable("LOG_QUEUE_SIZE", 10000))
+LOG_BATCH_SIZE = int(get_env_variable("LOG_BATCH_SIZE", 256))
+LOG_SAMPLE_RATES = {
+    tag.strip(): max(1, int(rate))
+    for tag, rate in (
+        item.split("=", 1) for item in get_env_variable("LOG_SAMPLE_RATES", "").split(",")
+        if "=" in item
+    )
+}
+
+# Metrics: Prometheus text endpoint (0 disables) and users allowed to run /stats, as "id,id,..."
+METRICS_HOST = get_env_variable("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(get_env_variable("METRICS_PORT", 9464))
+ADMIN_USER_IDS = {int(user_id) for user_id in get_env_variable("ADMIN_USER_IDS", "").split(",") if user_id.strip()}
+
+# Ensure data directory exists
+if not os.path.exists(DATA_PATH):
+    os.makedirs(DATA_PATH)
+
 # Ensure log directory exists
 log_dir = os.path.dirname(LOG_FILE)
 if log_dir and not os.path.exists(log_dir):
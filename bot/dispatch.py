@@ -0,0 +1,72 @@
+import asyncio
+from telegram.ext import BaseUpdateProcessor
+from .session import KeyedLocks
+from .logger import logger
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different users concurrently (up to max_concurrent_updates),
+    while each user's own updates still run one at a time, in the order they arrived.
+    Updates without a user (e.g. channel posts) are not ordered.
+
+    PTB's own limit is taken before do_process_update, so updates waiting for their user's
+    lock would hold its slots and one busy user could stall everyone. It is left unbounded
+    and the real limit is taken only after the user's lock.
+    """
+    UNBOUNDED = 2 ** 31 - 1
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(self.UNBOUNDED)
+        self.slots = asyncio.Semaphore(max_concurrent_updates)
+        self.user_locks = KeyedLocks()
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, 'effective_user', None)
+        if user is None:
+            async with self.slots:
+                await coroutine
+            return
+        async with self.user_locks.hold(user.id), self.slots:
+            await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+class TaskSupervisor:
+    """
+    Owns background tasks started outside of update processing (jobs, cleanups):
+    keeps them referenced, names them, logs crashes and stops them on shutdown.
+    Application.create_task is not used because Application.stop waits for those tasks,
+    which would hold the shutdown until every running job finished.
+    """
+    def __init__(self):
+        self.tasks = set()
+
+    def spawn(self, coro, name=None):
+        task = asyncio.create_task(coro, name=name)
+        self.tasks.add(task)
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, task):
+        self.tasks.discard(task)
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            logger.error(f"Background task {task.get_name()} crashed: {error!r}", exc_info=error)
+
+    async def shutdown(self, timeout=10):
+        """Lets running tasks finish for up to `timeout` seconds, then cancels the rest."""
+        if not self.tasks:
+            return
+        _, pending = await asyncio.wait(set(self.tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+
+supervisor = TaskSupervisor()
@@ -0,0 +1,155 @@
+import os
+import shutil
+from collections import OrderedDict
+from urllib.parse import urlparse
+from .config import DOWNLOAD_PROFILES, HOST_CONNECTION_BUDGET, MAX_FRAGMENT_CONCURRENCY, USE_ARIA2C
+from .metrics import metrics
+from .logger import logger
+
+# Protocols downloaded as many small fragments, where parallel connections pay off
+FRAGMENTED_PROTOCOLS = {'m3u8', 'm3u8_native', 'http_dash_segments', 'http_dash_segments_generator'}
+
+class DownloadProfile:
+    __slots__ = ('fragments', 'buffersize', 'http_chunk_size')
+
+    def __init__(self, fragments, buffer_kb, http_chunk_mb):
+        self.fragments = max(1, fragments)
+        self.buffersize = max(16, buffer_kb) * 1024
+        self.http_chunk_size = http_chunk_mb * 1024 * 1024
+
+DEFAULT_PROFILE = DownloadProfile(4, 1024, 0)
+
+class HostState:
+    """Connections a host currently has open, and the throughput seen per connection count."""
+    __slots__ = ('in_use', 'level_rate')
+
+    def __init__(self):
+        self.in_use = 0
+        self.level_rate = {}  # connections -> bytes/s (moving average)
+
+    def tuned(self, start, max_level):
+        """
+        Connection count to try next: the best measured so far, or one more while an extra
+        connection has not been tried yet (hill climbing on measured throughput).
+        """
+        if not self.level_rate:
+            return start
+        best = max(self.level_rate, key=self.level_rate.get)
+        if best < max_level and (best + 1) not in self.level_rate:
+            return best + 1
+        return best
+
+class DownloadLease:
+    __slots__ = ('host', 'connections', 'options', 'tuned')
+
+    def __init__(self, host, connections, options, tuned):
+        self.host = host
+        self.connections = connections
+        self.options = options  # yt-dlp options for this download
+        self.tuned = tuned      # whether its throughput feeds the per-host tuning
+
+class DownloadEngine:
+    """
+    Picks yt-dlp settings per download: a profile by extractor or host (fragment concurrency,
+    read buffer, HTTP chunk size), aria2c for plain single-file downloads when installed, and a
+    per-host connection budget shared by all running downloads so many jobs cannot flood one CDN.
+    Fragment concurrency is then tuned per host from the throughput of finished downloads.
+    Used from the event loop only.
+    """
+    MAX_HOSTS = 1000
+
+    def __init__(self, profiles=DOWNLOAD_PROFILES, budget=HOST_CONNECTION_BUDGET, max_fragments=MAX_FRAGMENT_CONCURRENCY, aria2c=USE_ARIA2C):
+        self.profiles = {key: DownloadProfile(*values) for key, values in profiles.items()}
+        self.budget = max(1, budget)
+        self.max_fragments = max(1, max_fragments)
+        # Stopping a cancelled aria2c needs its pid, which the downloader finds in /proc
+        self.aria2c = aria2c and shutil.which('aria2c') is not None and os.path.isdir('/proc')
+        self.hosts = OrderedDict()  # host -> HostState
+
+    def profile_for(self, platform, host):
+        """Profile of the extractor, else of the longest matching host suffix, else the default."""
+        platform = (platform or '').lower()
+        if platform in self.profiles:
+            return self.profiles[platform]
+        # Extractor names may carry a suffix, e.g. "youtube:tab"
+        if platform.split(':')[0] in self.profiles:
+            return self.profiles[platform.split(':')[0]]
+        host = host or ''
+        matches = [key for key in self.profiles if host == key or host.endswith('.' + key)]
+        if matches:
+            return self.profiles[max(matches, key=len)]
+        return DEFAULT_PROFILE
+
+    def lease(self, url, fmt=None, platform=None, stream=False, external=True):
+        """
+        Reserves connections on the download's host and returns its settings. Pair with `release`.
+        external: whether an external downloader may be used (not for spooled clips).
+        """
+        fmt = fmt or {}
+        host = fmt.get('host') or urlparse(url).hostname or ''
+        profile = self.profile_for(platform, host)
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = HostState()
+        self.hosts.move_to_end(host)
+        self._prune()
+
+        fragmented = fmt.get('protocol') in FRAGMENTED_PROTOCOLS
+        # Appending fragments out of order is not possible, so aria2c is for plain files only
+        use_aria2c = self.aria2c and external and not stream and fmt.get('protocol') in ('http', 'https') and '+' not in str(fmt.get('format_id', ''))
+        if fragmented:
+            want = min(state.tuned(profile.fragments, self.max_fragments), self.max_fragments)
+        elif use_aria2c:
+            want = profile.fragments
+        else:
+            want = 1
+        # Never below one connection: the scheduler, not the budget, decides whether a job runs
+        connections = max(1, min(want, self.budget - state.in_use))
+        state.in_use += connections
+
+        options = {
+            'concurrent_fragment_downloads': connections,
+            'buffersize': profile.buffersize,
+        }
+        if profile.http_chunk_size:
+            options['http_chunk_size'] = profile.http_chunk_size
+        if use_aria2c:
+            options['external_downloader'] = {'http': 'aria2c'}
+            options['external_downloader_args'] = {
+                'aria2c': ['-c', '-x', str(connections), '-s', str(connections), '-k', '1M', '--file-allocation=none']
+            }
+        return DownloadLease(host, connections, options, fragmented)
+
+    def release(self, lease):
+        state = self.hosts.get(lease.host)
+        if state is not None:
+            state.in_use = max(0, state.in_use - lease.connections)
+
+    def report(self, lease, nbytes, seconds):
+        """Feeds the throughput of a finished download into the host's tuning."""
+        if seconds <= 0 or not nbytes:
+            return
+        rate = nbytes / seconds
+        metrics.throughput.observe(rate, stage="download_request")
+        state = self.hosts.get(lease.host)
+        if state is None or not lease.tuned:
+            return
+        previous = state.level_rate.get(lease.connections)
+        state.level_rate[lease.connections] = rate if previous is None else 0.7 * previous + 0.3 * rate
+        best = state.tuned(lease.connections, self.max_fragments)
+        if best != lease.connections:
+            logger.info(f"Fragment concurrency for {lease.host} tuned to {best} ({rate / 1024 / 1024:.1f} MB/s at {lease.connections})")
+
+    def _prune(self):
+        # Forget the least recently used idle hosts
+        for host in list(self.hosts):
+            if len(self.hosts) <= self.MAX_HOSTS:
+                return
+            if self.hosts[host].in_use == 0:
+                del self.hosts[host]
+
+download_engine = DownloadEngine()
+metrics.gauge(
+    "bot_host_connections", "Download connections open per host.",
+    lambda: {(('host', host),): state.in_use for host, state in download_engine.hosts.items() if state.in_use}
+)
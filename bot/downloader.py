@@ -1,65 +1,178 @@
 import yt_dlp
 import os
+import time
+import signal
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
-from .config import THREAD_POOL_SIZE
+from .config import THREAD_POOL_SIZE, PROGRESS_INTERVAL
+from .extract_pool import unpack_info
+from .utils import human_readable_size
+from .cancel import JobCancelled
+from .metrics import metrics
+from .download_engine import download_engine
+from .ratelimit import site_limiter
 from .logger import logger
 
+# Protocols where yt-dlp appends to the output file strictly in order,
+# so finished byte ranges can be shipped before the download completes.
+STREAMABLE_PROTOCOLS = {'http', 'https', 'http_dash_segments'}
+
 class VideoDownloader:
     def __init__(self):
         self.executor = ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE)
+        self.busy = 0  # downloads submitted to the executor and not finished
 
-    async def download_video(self, url, format_id, output_dir, progress_callback=None, user_context=None):
+    def supports_streaming(self, fmt):
+        """
+        Whether a processed format can be split while it downloads.
+        Merged formats and non-native downloaders rewrite the file, so they are excluded.
+        """
+        if not fmt or '+' in str(fmt.get('format_id', '')):
+            return False
+        return fmt.get('protocol') in STREAMABLE_PROTOCOLS
+
+    async def download_video(self, url, format_id, output_dir, progress_callback=None, user_context=None, growing=None, info_dict=None, stream=False, cancel=None, fmt=None, platform=None, external=True):
         """
         Downloads video using yt-dlp in a separate thread.
-        progress_callback should be an async function taking (status, percent_str).
+        progress_callback is a plain function taking (status, percent_str); it is called on the
+        event loop, at most once per PROGRESS_INTERVAL while downloading.
         user_context: dict with 'user_id', 'username' etc. for logging.
+        growing: optional GrowingFile that receives the target path and byte counters while writing.
+        stream: the file is split while it downloads, so nothing may rewrite it afterwards.
+        info_dict: optional sanitized info from the extractor, reused instead of extracting again.
+        cancel: optional CancelToken; the yt-dlp hooks abort the download once it is cancelled.
+        fmt, platform: the processed format and extractor name, used to pick the engine settings.
+        external: whether the engine may hand the download to aria2c.
         """
         loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(
-            self.executor,
-            self._download_sync,
-            url, format_id, output_dir, progress_callback, loop, user_context
-        )
+        # Downloads already hold a scheduler slot, so they queue for the site without a cap
+        await site_limiter.wait_async(url)
+        lease = download_engine.lease(url, fmt, platform, stream, external)
+        self.busy += 1
+        metrics.pool_occupancy.observe(self.busy)
+        started = time.monotonic()
+        poller = None
+        if 'external_downloader' in lease.options:
+            poller = asyncio.create_task(self._poll_external(output_dir, progress_callback, growing, cancel))
+        try:
+            filepath = await loop.run_in_executor(
+                self.executor,
+                self._download_sync,
+                url, format_id, output_dir, progress_callback, loop, user_context, growing, info_dict, stream, cancel,
+                lease.options
+            )
+            if filepath and os.path.exists(filepath):
+                download_engine.report(lease, os.path.getsize(filepath), time.monotonic() - started)
+            return filepath
+        finally:
+            if poller is not None:
+                poller.cancel()
+            self.busy -= 1
+            download_engine.release(lease)
 
-    def _download_sync(self, url, format_id, output_dir, progress_callback, loop, user_context=None):
+    async def _poll_external(self, output_dir, progress_callback, growing, cancel):
+        """
+        aria2c calls no progress hooks until it is done: measure the bytes in its directory
+        for progress, the watchdog and the budgets instead, and kill it once cancelled.
+        """
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            if cancel is not None and cancel.cancelled:
+                _kill_external(output_dir)
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(output_dir) if entry.is_file())
+            except OSError:
+                continue
+            if growing is not None:
+                growing.downloaded_bytes = size
+            if progress_callback:
+                progress_callback("downloading", human_readable_size(size))
+
+    def _download_sync(self, url, format_id, output_dir, progress_callback, loop, user_context=None, growing=None, info_dict=None, stream=False, cancel=None, engine_options=None):
         user_context = user_context or {}
+        last_report = [0.0]
+
+        def report(stage, percent_str):
+            try:
+                loop.call_soon_threadsafe(progress_callback, stage, percent_str)
+            except RuntimeError:
+                # Event loop already closed
+                pass
+
+        def check_cancelled(d=None):
+            # Raising from a hook is how yt-dlp lets callers abort a download
+            if cancel is not None and cancel.cancelled:
+                raise yt_dlp.utils.DownloadCancelled("Download cancelled.")
+
+        def postprocessor_hook(d):
+            check_cancelled()
+            if growing is not None:
+                growing.postprocessing = d['status'] != 'finished'
+
         def progress_hook(d):
+            check_cancelled()
+            if growing is not None:
+                # While downloading, the bytes are in the .part file
+                path = d.get('tmpfilename') if d['status'] == 'downloading' else None
+                if path or d.get('filename'):
+                    growing.path = path or d['filename']
+                growing.downloaded_bytes = d.get('downloaded_bytes') or growing.downloaded_bytes
+                growing.total_bytes = d.get('total_bytes') or d.get('total_bytes_estimate') or growing.total_bytes
+
+            if not progress_callback:
+                return
+
+            # yt-dlp calls this hundreds of times per second; throttle here on the
+            # download thread so the event loop only sees the latest state
             if d['status'] == 'downloading':
+                now = time.monotonic()
+                if now - last_report[0] < PROGRESS_INTERVAL:
+                    return
+                last_report[0] = now
                 percent_str = d.get('_percent_str', '0%')
                 # Remove ANSI codes if any
                 percent_str = percent_str.replace('\x1b[0;94m', '').replace('\x1b[0m', '').strip()
-
-                if progress_callback:
-                    asyncio.run_coroutine_threadsafe(
-                        progress_callback("downloading", percent_str),
-                        loop
-                    )
+                report("downloading", percent_str)
             elif d['status'] == 'finished':
-                if progress_callback:
-                    asyncio.run_coroutine_threadsafe(
-                        progress_callback("finished", "100%"),
-                        loop
-                    )
+                report("finished", "100%")
 
         ydl_opts = {
             'format': format_id, # format_id or 'best'
             'outtmpl': os.path.join(output_dir, '%(title)s.%(ext)s'),
-            'concurrent_fragment_downloads': 8,
-            'buffersize': 16384,
-            'nopart': True, # Write directly to final file
+            # Partial files keep the .part suffix so yt-dlp can resume them after a restart
+            'continuedl': True,
             'quiet': True,
             'no_warnings': True,
             'progress_hooks': [progress_hook],
+            'postprocessor_hooks': [postprocessor_hook],
             # Ensure we don't download playlists
             'noplaylist': True,
             # Restrict filenames to ASCII to avoid filesystem issues
             'restrictfilenames': True,
         }
 
+        # Fragment concurrency, buffers and downloader picked per host by the download engine
+        ydl_opts.update(engine_options or {})
+
+        if stream:
+            # Fixups rewrite the file after download, which would invalidate parts already sent
+            ydl_opts['fixup'] = 'never'
+
         try:
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
+                info = None
+                if info_dict is not None:
+                    try:
+                        # process_ie_result mutates the dict, the cached one is shared
+                        info = ydl.process_ie_result(unpack_info(info_dict), download=True)
+                    except yt_dlp.utils.DownloadError as e:
+                        # Stream URLs may have expired since extraction
+                        logger.warning(f"Cached info failed for {url}, extracting again: {e}", extra=user_context)
+                        if growing is not None:
+                            growing.path = None
+
+                if info is None:
+                    info = ydl.extract_info(url, download=True)
 
                 filepath = ydl.prepare_filename(info)
 
@@ -74,8 +187,36 @@ class VideoDownloader:
                     raise Exception("File not found after download.")
 
                 return filepath
+        except yt_dlp.utils.DownloadCancelled:
+            logger.info(f"Download of {url} cancelled", extra=user_context)
+            raise JobCancelled("Download cancelled.")
         except Exception as e:
+            if cancel is not None and cancel.cancelled:
+                # An external downloader killed on cancel
+                logger.info(f"Download of {url} cancelled", extra=user_context)
+                raise JobCancelled("Download cancelled.")
             logger.error(f"Download error for {url}: {e}", extra=user_context)
             raise e
 
+def _kill_external(output_dir):
+    """Terminates child processes (external downloaders) whose command line names output_dir."""
+    me = os.getpid()
+    targets = {os.path.normpath(output_dir).encode(), os.path.abspath(output_dir).encode()}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                # The command name may contain spaces, fields after it are fixed
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            if ppid != me:
+                continue
+            with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                cmdline = f.read()
+            if any(target in cmdline for target in targets):
+                os.kill(int(pid), signal.SIGTERM)
+        except (OSError, ValueError, IndexError):
+            continue
+
 downloader = VideoDownloader()
+metrics.gauge("bot_download_threads_busy", "Downloads running in the yt-dlp thread pool.", lambda: downloader.busy)
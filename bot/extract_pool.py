@@ -0,0 +1,156 @@
+import json
+import queue
+import asyncio
+import threading
+import zlib
+import multiprocessing
+import yt_dlp
+from .logger import logger
+
+class ExtractionTimeout(Exception):
+    """Raised when a worker does not answer within EXTRACTION_TIMEOUT."""
+    pass
+
+def _worker_main(conn):
+    """
+    Worker process loop: keeps one YoutubeDL instance warm and extracts URLs sent over `conn`.
+    Replies with (status, payload); only the processed info and a compressed info json cross back.
+    """
+    # Imported here so the parent does not pay for it at spawn time
+    from .extractor import extractor, AuthenticationError, EXTRACT_OPTS
+
+    ydl = yt_dlp.YoutubeDL(EXTRACT_OPTS)
+    while True:
+        try:
+            url = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if url is None:
+            break
+
+        try:
+            platform, (raw, processed) = extractor._extract(url, ydl=ydl)
+            raw_blob = zlib.compress(json.dumps(raw).encode(), 1)
+            conn.send(('ok', (platform, processed, raw_blob)))
+        except AuthenticationError as e:
+            conn.send(('auth', str(e)))
+        except yt_dlp.utils.DownloadError as e:
+            conn.send(('download', str(e)))
+        except Exception as e:
+            conn.send(('error', str(e)))
+
+    ydl.close()
+
+class _Worker:
+    __slots__ = ('process', 'conn', 'tasks')
+
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.tasks = 0
+
+class ExtractionPool:
+    """
+    Pool of pre-warmed extraction processes, so yt-dlp's regex/JS/JSON work
+    does not compete with the event loop for the GIL.
+    Blocking API: call `extract` from a thread (asyncio.to_thread), holding one of `slots`
+    so the thread finds an idle worker instead of blocking in the shared executor.
+    """
+    def __init__(self, workers, timeout, max_tasks):
+        self.size = workers
+        self.timeout = timeout
+        self.max_tasks = max_tasks
+        # spawn: forking a process that already runs threads is unsafe
+        self.ctx = multiprocessing.get_context('spawn')
+        self.idle = queue.Queue()
+        # One per worker, taken on the event loop before a thread is used
+        self.slots = asyncio.Semaphore(workers)
+        self.lock = threading.Lock()
+        self.started = False
+
+    def start(self):
+        """Spawns the workers. Called at startup so the first request finds them warm."""
+        with self.lock:
+            if self.started:
+                return
+            for _ in range(self.size):
+                self.idle.put(self._spawn())
+            self.started = True
+        logger.info(f"Extraction pool started with {self.size} workers")
+
+    def _spawn(self):
+        parent_conn, child_conn = self.ctx.Pipe()
+        process = self.ctx.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        return _Worker(process, parent_conn)
+
+    def _retire(self, worker, graceful=True):
+        try:
+            if graceful and worker.process.is_alive():
+                worker.conn.send(None)
+                worker.process.join(1)
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join(1)
+        except Exception:
+            pass
+        finally:
+            worker.conn.close()
+
+    def extract(self, url):
+        """
+        Extracts a URL in a worker process.
+        Returns (platform, (raw_blob, processed)) like VideoExtractor._extract.
+        """
+        self.start()
+        worker = self.idle.get()
+        healthy = False
+
+        try:
+            worker.conn.send(url)
+            if not worker.conn.poll(self.timeout):
+                raise ExtractionTimeout(f"Extraction timed out after {self.timeout}s")
+            status, payload = worker.conn.recv()
+            worker.tasks += 1
+            healthy = True
+        except (EOFError, BrokenPipeError, ConnectionResetError) as e:
+            raise Exception(f"Extraction worker died: {e}")
+        finally:
+            if not healthy:
+                # Timed out or crashed: kill it, a hung extraction would never come back
+                logger.warning(f"Replacing extraction worker pid={worker.process.pid}")
+                self._retire(worker, graceful=False)
+                worker = self._spawn()
+            elif worker.tasks >= self.max_tasks:
+                # Recycle long-lived workers to bound memory growth inside yt-dlp
+                self._retire(worker)
+                worker = self._spawn()
+            self.idle.put(worker)
+
+        if status == 'ok':
+            platform, processed, raw_blob = payload
+            return platform, (raw_blob, processed)
+
+        # Imported here to avoid a circular import at module load
+        from .extractor import AuthenticationError
+        if status == 'auth':
+            raise AuthenticationError(payload)
+        if status == 'download':
+            raise yt_dlp.utils.DownloadError(payload)
+        raise Exception(payload)
+
+    def shutdown(self):
+        with self.lock:
+            while not self.idle.empty():
+                self._retire(self.idle.get_nowait())
+            self.started = False
+
+def unpack_info(raw):
+    """
+    Returns a private, mutable copy of a cached info dict.
+    Pool workers hand it over as compressed json; thread mode keeps the dict itself.
+    """
+    if isinstance(raw, bytes):
+        return json.loads(zlib.decompress(raw))
+    return json.loads(json.dumps(raw))
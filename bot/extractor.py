@@ -1,24 +1,252 @@
+import ssl
+import time
+import asyncio
+import threading
+import urllib.error
+from collections import OrderedDict
+from concurrent.futures import Future
 import yt_dlp
+from yt_dlp.networking.exceptions import TransportError
+from .config import (
+    METADATA_CACHE_SIZE, METADATA_CACHE_TTL, METADATA_CACHE_TTLS,
+    EXTRACTION_WORKERS, EXTRACTION_TIMEOUT, EXTRACTION_MAX_TASKS,
+    NEGATIVE_CACHE_TTLS, SITE_RATE_MAX_WAIT
+)
+from .extract_pool import ExtractionPool
+from .ratelimit import site_limiter
+from .metrics import metrics
 from .logger import logger
-from .utils import human_readable_size
+from .formats import rank_formats
+from .utils import normalize_url
+
+EXTRACT_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'noplaylist': True,
+    'extract_flat': False, # We need formats, so extract_flat might be too shallow if True
+}
 
 class AuthenticationError(Exception):
     """Raised when the video requires authentication."""
     pass
 
+NOT_FOUND_MARKERS = ("404", "not found", "unavailable", "not available", "does not exist", "removed", "unsupported url")
+THROTTLED_MARKERS = ("429", "too many requests", "rate limit", "rate-limit")
+NETWORK_MARKERS = (
+    "timed out", "connection", "urlopen error", "name resolution", "name or service not known",
+    "getaddrinfo", "nodename nor servname", "network is unreachable", "[ssl", "certificate verify", "eof occurred"
+)
+
+def _is_network_error(error):
+    """Whether a DownloadError wraps a DNS, connection, TLS or timeout failure rather than an answer from the site."""
+    cause = (getattr(error, 'exc_info', None) or (None, None))[1]
+    for _ in range(5):
+        if cause is None:
+            break
+        if isinstance(cause, (TransportError, urllib.error.URLError, ssl.SSLError, OSError)) and not isinstance(cause, urllib.error.HTTPError):
+            return True
+        # ExtractorError keeps the underlying error in `cause`
+        cause = getattr(cause, 'cause', None) or cause.__cause__
+    message = str(error).lower()
+    return any(marker in message for marker in NETWORK_MARKERS)
+
+def classify_error(error):
+    """
+    Type of a failed extraction for the negative cache: "auth", "throttled", "not_found" or
+    "error". None for failures that say nothing about the link (timeouts, network errors,
+    crashed workers).
+    """
+    if isinstance(error, AuthenticationError):
+        return "auth"
+    if not isinstance(error, yt_dlp.utils.DownloadError):
+        return None
+    message = str(error).lower()
+    if any(marker in message for marker in THROTTLED_MARKERS):
+        return "throttled"
+    if _is_network_error(error):
+        return None
+    if any(marker in message for marker in NOT_FOUND_MARKERS):
+        return "not_found"
+    return "error"
+
+class MetadataCache:
+    """
+    Thread-safe LRU cache of extraction results with per-extractor TTLs.
+    Concurrent lookups of the same key share a single in-flight extraction.
+    Failures are remembered too, for a TTL per error type, and re-raised to reposts of the link.
+    """
+    def __init__(self, max_entries=METADATA_CACHE_SIZE, default_ttl=METADATA_CACHE_TTL, ttls=METADATA_CACHE_TTLS, failure_ttls=NEGATIVE_CACHE_TTLS):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.ttls = ttls
+        self.failure_ttls = failure_ttls
+        self.entries = OrderedDict()
+        self.failures = OrderedDict()  # key -> (expires_at, kind, exception type, message)
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached (raw, processed) pair or None if missing or expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, platform, value):
+        # Signed stream URLs expire, so sites get their own lifetime
+        ttl = self.ttls.get((platform or '').lower(), self.default_ttl)
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_failure(self, key):
+        """Returns (kind, exception type, message) of a recent failure, or None."""
+        with self.lock:
+            entry = self.failures.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.failures[key]
+                return None
+            return entry[1:]
+
+    def put_failure(self, key, error):
+        kind = classify_error(error)
+        ttl = self.failure_ttls.get(kind, 0) if kind else 0
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.failures[key] = (time.monotonic() + ttl, kind, type(error), str(error))
+            self.failures.move_to_end(key)
+            while len(self.failures) > self.max_entries:
+                self.failures.popitem(last=False)
+
+    def is_cached_or_loading(self, key):
+        """Whether a lookup of `key` would be answered without a new extraction."""
+        with self.lock:
+            if key in self.inflight:
+                return True
+        return self.get(key) is not None or self.get_failure(key) is not None
+
+    def get_or_load(self, key, loader):
+        """
+        Returns the cached value, or runs `loader` once for all concurrent callers.
+        loader returns (platform, value).
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        failure = self.get_failure(key)
+        if failure is not None:
+            kind, error_type, message = failure
+            metrics.negative_cache_hits.inc(kind=kind)
+            raise error_type(message)
+
+        with self.lock:
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.inflight[key] = future
+
+        if not owner:
+            return future.result()
+
+        try:
+            platform, value = loader()
+            self.put(key, platform, value)
+            future.set_result(value)
+            return value
+        except Exception as e:
+            self.put_failure(key, e)
+            future.set_exception(e)
+            raise e
+        finally:
+            with self.lock:
+                del self.inflight[key]
+
 class VideoExtractor:
+    def __init__(self):
+        self.cache = MetadataCache()
+        # Workers are spawned lazily (or by start_pool) so importing this module stays cheap
+        self.pool = ExtractionPool(EXTRACTION_WORKERS, EXTRACTION_TIMEOUT, EXTRACTION_MAX_TASKS) if EXTRACTION_WORKERS > 0 else None
+
+    def start_pool(self):
+        """Pre-warms the extraction workers; falls back to in-process extraction if that fails."""
+        if not self.pool:
+            return
+        try:
+            self.pool.start()
+        except Exception as e:
+            logger.error(f"Could not start extraction pool, extracting in threads: {e}")
+            self.pool = None
+
+    async def get_info_async(self, url):
+        """
+        get_info for the event loop. A new extraction first waits for its site's rate limit
+        here, so throttled requests queue on the loop instead of holding executor threads;
+        it fails fast with SiteBusy if the wait would exceed SITE_RATE_MAX_WAIT.
+        """
+        if self.cache.is_cached_or_loading(normalize_url(url)):
+            return await asyncio.to_thread(self.get_info, url)
+        await site_limiter.wait_async(url, SITE_RATE_MAX_WAIT)
+        pool = self.pool
+        if pool is None:
+            return await asyncio.to_thread(self.get_info, url)
+        # Wait for a free worker here, not in a thread blocked on the pool's idle queue
+        async with pool.slots:
+            return await asyncio.to_thread(self.get_info, url)
+
     def get_info(self, url):
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'noplaylist': True,
-            'extract_flat': False, # We need formats, so extract_flat might be too shallow if True
-        }
+        """
+        Returns the processed info for a URL, served from the metadata cache when fresh.
+        Blocking and not rate-limited; the bot goes through get_info_async.
+        """
+        raw, processed = self.cache.get_or_load(normalize_url(url), lambda: self._load(url))
+        return processed
 
+    def _load(self, url):
+        """Extracts a URL; a throttling error makes the next requests to its site back off."""
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            return self.pool.extract(url) if self.pool else self._extract(url)
+        except Exception as e:
+            if classify_error(e) == "throttled":
+                site_limiter.penalize(url)
+            raise e
+
+    def get_cached_raw_info(self, url):
+        """
+        Returns the sanitized yt-dlp info from a recent get_info, or None.
+        It may be packed (see extract_pool.unpack_info); the downloader unpacks it in its
+        thread and feeds it to process_ie_result instead of extracting the page again.
+        """
+        value = self.cache.get(normalize_url(url))
+        return value[0] if value else None
+
+    def _extract(self, url, ydl=None):
+        """
+        Extracts a URL, returning (platform, (raw, processed)).
+        Pool workers pass their long-lived YoutubeDL instance as `ydl`.
+        """
+        try:
+            if ydl is None:
+                with yt_dlp.YoutubeDL(EXTRACT_OPTS) as ydl:
+                    info = ydl.extract_info(url, download=False)
+            else:
                 info = ydl.extract_info(url, download=False)
-                return self._process_info(info)
+
+            processed = self._process_info(info)
+            # Same cleanup as an info json: drops the requested_* selections so it can be re-processed
+            raw = yt_dlp.YoutubeDL.sanitize_info(info, remove_private_keys=True)
+            return processed['platform'], (raw, processed)
         except yt_dlp.utils.DownloadError as e:
             error_msg = str(e)
             logger.error(f"Extraction failed for {url}: {error_msg}")
@@ -39,87 +267,16 @@ class VideoExtractor:
         """
         Process the raw info dictionary from yt-dlp.
         """
-        title = info.get('title', 'Unknown Title')
         duration = info.get('duration', 0)
-        uploader = info.get('uploader', 'Unknown Uploader')
-        extractor = info.get('extractor', 'Unknown Platform')
-        formats = info.get('formats', [])
-
-        # Filter and process formats
-        processed_formats = []
-        seen_resolutions = set()
-
-        # We want video formats, preferably with audio or we can merge.
-        # yt-dlp 'best' usually handles merging.
-        # But for manual selection, we need to show options.
-        # Usually users want 360p, 480p, 720p, 1080p.
-        # We should look for formats that have video.
-
-        # Sort formats by resolution/quality
-        # yt-dlp sorts them worst to best usually.
-
-        for f in formats:
-            # Skip audio only formats
-            if f.get('vcodec') == 'none':
-                continue
-
-            # Skip video only if we can't merge easily (but we can let yt-dlp merge)
-            # However, for the selection UI, we want to show "1080p (approx 50MB)"
-
-            resolution = f.get('resolution') or f.get('format_note')
-            if not resolution:
-                height = f.get('height')
-                if height:
-                    resolution = f"{height}p"
-                else:
-                    continue # Skip if no resolution info
-
-            # Simple deduplication based on resolution
-            # This is tricky because there might be multiple codecs (av01, vp9, h264).
-            # We should probably pick the best for each resolution or list them all?
-            # Prompt says: "Display format choices to the user... e.g. 360p, 480p..."
-            # So unique resolutions.
-
-            # We prefer mp4 containers for compatibility
-            ext = f.get('ext')
-
-            # Estimate size
-            filesize = f.get('filesize') or f.get('filesize_approx')
-
-            if resolution not in seen_resolutions:
-                processed_formats.append({
-                    'format_id': f['format_id'],
-                    'resolution': resolution,
-                    'ext': ext,
-                    'filesize': filesize,
-                    'filesize_str': human_readable_size(filesize) if filesize else "Unknown",
-                    'vcodec': f.get('vcodec'),
-                    'acodec': f.get('acodec'),
-                })
-                seen_resolutions.add(resolution)
-            else:
-                # If we already have this resolution, check if this one is "better" (e.g. mp4 vs webm, or has filesize)
-                # This is a simplified logic.
-                for existing in processed_formats:
-                    if existing['resolution'] == resolution:
-                        if (existing['filesize'] is None and filesize is not None) or \
-                           (existing['ext'] != 'mp4' and ext == 'mp4'):
-                                existing['format_id'] = f['format_id']
-                                existing['ext'] = ext
-                                existing['filesize'] = filesize
-                                existing['filesize_str'] = human_readable_size(filesize) if filesize else "Unknown"
-                        break
-
-        # Sort by height/resolution if possible?
-        # Typically they are already sorted by yt-dlp.
-        # Let's ensure they are meaningful.
-
         return {
-            'title': title,
+            'id': info.get('id'),
+            'webpage_url': info.get('webpage_url'),
+            'title': info.get('title', 'Unknown Title'),
             'duration': duration,
-            'uploader': uploader,
-            'platform': extractor,
-            'formats': processed_formats
+            'uploader': info.get('uploader', 'Unknown Uploader'),
+            'platform': info.get('extractor', 'Unknown Platform'),
+            # One choice per resolution, ranked by the parts and time it takes to deliver
+            'formats': rank_formats(info.get('formats', []), duration)
         }
 
 extractor = VideoExtractor()
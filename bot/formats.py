@@ -0,0 +1,120 @@
+import math
+from urllib.parse import urlparse
+from .config import MAX_CHUNK_SIZE_MB
+from .utils import human_readable_size, human_readable_duration
+
+# Bytes a codec needs for the same picture quality, relative to H.264
+CODEC_COST = {'av01': 0.6, 'hvc1': 0.7, 'hev1': 0.7, 'h265': 0.7, 'vp09': 0.75, 'vp9': 0.75, 'avc1': 1.0, 'h264': 1.0}
+# Audio that merges into the video's container without remuxing to mkv
+COMPATIBLE_AUDIO = {'mp4': 'm4a', 'webm': 'webm'}
+
+def estimate_size(fmt, duration=None):
+    """
+    Best guess of a format's size in bytes: filesize, filesize_approx, the ranking
+    estimate, or bitrate (kbit/s, tbr or vbr + abr) x duration. None if nothing is known.
+    """
+    if not fmt:
+        return None
+    size = fmt.get('filesize') or fmt.get('filesize_approx') or fmt.get('est_size')
+    if size:
+        return int(size)
+    bitrate = fmt.get('tbr') or ((fmt.get('vbr') or 0) + (fmt.get('abr') or 0))
+    if bitrate and duration:
+        return int(bitrate * 1000 / 8 * duration)
+    return None
+
+def codec_cost(vcodec):
+    return CODEC_COST.get((vcodec or '').split('.')[0].lower(), 1.0)
+
+def part_count(size, chunk_size=MAX_CHUNK_SIZE_MB * 1024 * 1024):
+    return max(1, math.ceil(size / chunk_size)) if size else None
+
+def _best_audio(formats):
+    """Best audio-only format per container ext, and overall (key None)."""
+    best = {}
+    for f in formats:
+        if f.get('vcodec') != 'none' or f.get('acodec') in (None, 'none'):
+            continue
+        quality = f.get('abr') or f.get('tbr') or 0
+        for key in (f.get('ext'), None):
+            if key not in best or quality > best[key][0]:
+                best[key] = (quality, f)
+    return {key: f for key, (_, f) in best.items()}
+
+def rank_formats(formats, duration):
+    """
+    Builds the quality choices from yt-dlp's formats: one per resolution, best first.
+    Video-only formats are merged with the best audio and include its size. Among formats
+    of one resolution the one with the fewest parts wins, then the most efficient codec,
+    then mp4. Sizes are estimated from bitrate and duration when yt-dlp does not know them.
+    """
+    audio = _best_audio(formats)
+    choices = {}  # resolution -> (sort key, choice)
+
+    for f in formats:
+        if f.get('vcodec') == 'none':
+            continue
+        height = f.get('height')
+        if height:
+            fps = f.get('fps') or 0
+            resolution = f"{height}p{int(fps)}" if fps > 30 else f"{height}p"
+        else:
+            resolution = f.get('resolution') or f.get('format_note')
+            if not resolution:
+                continue
+
+        format_id = f['format_id']
+        size = estimate_size(f, duration)
+        exact = bool(f.get('filesize'))
+        if f.get('acodec') == 'none':
+            # Video only: yt-dlp merges the audio in, which adds its size to the download
+            track = audio.get(COMPATIBLE_AUDIO.get(f.get('ext'))) or audio.get(None)
+            if track is not None:
+                format_id = f"{format_id}+{track['format_id']}"
+                audio_size = estimate_size(track, duration)
+                size = size + audio_size if size and audio_size else None
+                exact = exact and bool(track.get('filesize'))
+
+        parts = part_count(size)
+        choice = {
+            'format_id': format_id,
+            'resolution': resolution,
+            'height': height or 0,
+            'ext': f.get('ext'),
+            'filesize': size if exact else None,
+            'est_size': size,
+            'filesize_str': (human_readable_size(size) if exact else f"~{human_readable_size(size, 0)}") if size else "Unknown",
+            'parts': parts,
+            'vcodec': f.get('vcodec'),
+            'acodec': f.get('acodec'),
+            'protocol': f.get('protocol'),
+            'tbr': f.get('tbr'),
+            # Media host, the download engine budgets connections per host
+            'host': urlparse(f.get('url') or '').hostname,
+        }
+        key = (parts or math.inf, codec_cost(f.get('vcodec')), f.get('ext') != 'mp4', size or math.inf)
+        current = choices.get(resolution)
+        if current is None or key < current[0]:
+            choices[resolution] = (key, choice)
+
+    # Best quality first; formats of unknown size cannot be planned for and go last
+    ranked = [choice for _, choice in choices.values()]
+    ranked.sort(key=lambda c: (c['est_size'] is None, -c['height']))
+    return ranked
+
+def delivery_estimate(size, rate):
+    """Expected time to deliver `size` bytes at the measured end-to-end `rate`, or None."""
+    if not size or not rate:
+        return None
+    return size / rate
+
+def format_label(fmt, rate=None):
+    """Button text: resolution, size, part count and estimated delivery time when known."""
+    label = f"{fmt.get('resolution', 'Unknown')} · {fmt.get('filesize_str', '?')}"
+    parts = fmt.get('parts')
+    if parts:
+        label += f" · {parts} part{'s' if parts > 1 else ''}"
+    eta = delivery_estimate(fmt.get('est_size'), rate)
+    if eta is not None:
+        label += f" · ~{human_readable_duration(max(eta, 1))}"
+    return label
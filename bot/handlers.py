@@ -1,18 +1,26 @@
-import os
-import asyncio
 import time
-import uuid
+import asyncio
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from telegram.constants import ParseMode
 
-from .config import DOWNLOAD_PATH
-from .session import session_manager
+from .session import request_store
+from .scheduler import scheduler, Job, QueueFullError
+from .status import StatusMessage, cancel_markup
+from .cancel import JobCancelled, JobInterrupted
+from .watchdog import StageStalled
 from .extractor import extractor, AuthenticationError
-from .downloader import downloader
+from .formats import estimate_size, format_label
 from .splitter import splitter
+from .jobs import download_registry
 from .uploader import uploader
-from .utils import cleanup_temp_dir, human_readable_size, sanitize_filename
+from .journal import journal
+from .metrics import metrics
+from .upload_scheduler import upload_scheduler
+from .transport import request_pools
+from .cache import file_cache, make_video_key
+from .utils import human_readable_size, human_readable_duration, sanitize_filename
+from .config import ALBUM_UPLOADS, ALBUM_SIZE, ALBUM_MAX_MB, ORDERED_UPLOADS, UPLOAD_DEADLINE, ADMIN_USER_IDS
 from .logger import logger
 
 class BotHandlers:
@@ -22,154 +30,240 @@ class BotHandlers:
             "Send me any video URL, and I will download and split it for you."
         )
 
+    async def stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Admin-only summary of the metrics also served on the /metrics endpoint."""
+        if update.effective_user.id not in ADMIN_USER_IDS:
+            await update.message.reply_text("This command is only available to admins.")
+            return
+
+        def seconds(value):
+            return "-" if value is None else f"{value:.1f}s"
+
+        def rate(value):
+            return "-" if value is None else f"{human_readable_size(value)}/s"
+
+        lines = [
+            f"Jobs: {len(scheduler.running)}/{scheduler.slots} running, "
+            f"{sum(len(q) for q in scheduler.queues.values())} queued",
+            f"Queue wait: p50 {seconds(metrics.queue_wait.quantile(0.5))}, p95 {seconds(metrics.queue_wait.quantile(0.95))}",
+            "",
+            "Stage durations (p50 / p95, count):",
+        ]
+        for stage in ("extract", "download", "split", "upload", "upload_request"):
+            count = metrics.stage_seconds.count(stage=stage, outcome="ok")
+            if count:
+                p50 = metrics.stage_seconds.quantile(0.5, stage=stage, outcome="ok")
+                p95 = metrics.stage_seconds.quantile(0.95, stage=stage, outcome="ok")
+                lines.append(f"  {stage}: {seconds(p50)} / {seconds(p95)} ({count})")
+        lines.append("Throughput (p50 / p95):")
+        for stage in ("download", "upload_request"):
+            if metrics.throughput.count(stage=stage):
+                p50 = metrics.throughput.quantile(0.5, stage=stage)
+                p95 = metrics.throughput.quantile(0.95, stage=stage)
+                lines.append(f"  {stage}: {rate(p50)} / {rate(p95)}")
+        lines += [
+            "",
+            f"Uploads: {upload_scheduler.in_flight} in flight, limit {int(upload_scheduler.limit)}",
+            f"RetryAfter: {metrics.retry_after.total()} "
+            f"(uploads {metrics.retry_after.total(kind='upload')}, status edits {metrics.retry_after.total(kind='status_edit')})",
+        ]
+        for name, pool in request_pools.items():
+            s = pool.stats()
+            lines.append(f"HTTP pool {name}: {s['in_flight']}/{s['size']} busy, peak {s['peak']}, {s['pool_timeouts']} pool timeouts")
+
+        await update.message.reply_text("\n".join(lines))
+
     async def handle_url(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         url = update.message.text.strip()
         user_id = update.effective_user.id
 
-        # Check if user is already processing
-        lock = session_manager.get_user_lock(user_id)
-        if lock.locked():
-            await update.message.reply_text("You already have a task in progress. Please wait until it finishes.")
-            return
-
         status_msg = await update.message.reply_text("Analyzing URL...")
 
-        # We acquire the lock for the extraction phase.
-        # Note: If we release it after extraction, user can send another URL.
-        # But we want to prevent that until download is done?
-        # Actually, if we release lock, user can start another analysis.
-        # But if they start download, we need lock again.
-        # Best to keep lock? No, user interaction involves waiting for user input.
-        # So we release lock after extraction, but re-acquire for download.
-        # But we need to ensure context.user_data isn't overwritten?
-        # If user sends URL 2 while URL 1 is waiting for selection, URL 2 overwrites.
-        # That's acceptable behavior (latest URL takes precedence).
-
-        async with lock:
-            try:
-                # Run extraction in thread to avoid blocking loop
-                info = await asyncio.to_thread(extractor.get_info, url)
-
-                # Generate unique request ID to handle multiple requests
-                request_id = str(uuid.uuid4())
-
-                # Store info with request_id key
-                if 'requests' not in context.user_data:
-                    context.user_data['requests'] = {}
-
-                context.user_data['requests'][request_id] = {
-                    'video_info': info,
-                    'url': url
-                }
-
-                keyboard = []
-                formats = info.get('formats', [])
-
-                # Limit to top 10 unique resolutions
-                # Assuming formats are sorted or we just take first 10
-                for fmt in formats[:10]:
-                    res = fmt.get('resolution', 'Unknown')
-                    size = fmt.get('filesize_str', '?')
-                    fid = fmt.get('format_id')
-                    text = f"{res} ({size})"
-                    # callback_data limit is 64 bytes.
-                    # request_id (36) + dl_ (3) + _ (1) + fid (avg 3-5) = ~45 chars. Safe.
-                    callback_data = f"dl_{request_id}_{fid}"
-                    keyboard.append([InlineKeyboardButton(text, callback_data=callback_data)])
-
-                keyboard.append([InlineKeyboardButton("Cancel", callback_data="cancel")])
-
-                title = info.get('title', 'Unknown')
-                duration = info.get('duration', 0)
-
-                await status_msg.edit_text(
-                    f"Title: {title}\n"
-                    f"Duration: {duration}s\n"
-                    f"Select Quality:",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
+        # One trace id follows the request from extraction through its job
+        trace_id = metrics.new_trace_id()
+        log_ctx = {'user_id': user_id, 'trace_id': trace_id, 'url': url}
 
-            except AuthenticationError as e:
-                await status_msg.edit_text(str(e))
-            except Exception as e:
-                logger.error(f"Error handling URL {url}: {e}")
-                await status_msg.edit_text(f"Error analyzing URL: {e}")
+        # PerUserUpdateProcessor already handles one update per user at a time
+        try:
+            # Run extraction in thread to avoid blocking loop
+            with metrics.span("extract", log_ctx):
+                info = await extractor.get_info_async(url)
+
+            # Kept until a format is picked, or expired/evicted by the bounded store
+            token = request_store.add(user_id, url, info, trace_id)
+
+            keyboard = []
+            formats = info.get('formats', [])
+            # Delivery times from recent jobs, or at least from recent downloads
+            rate = metrics.recent_rate("delivery") or metrics.recent_rate("download")
+
+            # Ranked best quality first by the extractor; 10 buttons at most
+            for index, fmt in enumerate(formats[:10]):
+                text = format_label(fmt, rate)
+                # The format is referenced by its index, format ids may contain underscores
+                callback_data = f"dl_{token}_{index}"
+                keyboard.append([InlineKeyboardButton(text, callback_data=callback_data)])
+
+            keyboard.append([InlineKeyboardButton("Cancel", callback_data=f"close_{token}")])
+
+            title = info.get('title', 'Unknown')
+            duration = info.get('duration', 0)
+
+            await status_msg.edit_text(
+                f"Title: {title}\n"
+                f"Duration: {duration}s\n"
+                f"Select Quality:",
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+
+        except AuthenticationError as e:
+            await status_msg.edit_text(str(e))
+        except Exception as e:
+            logger.error(f"Error handling URL {url}: {e}", extra=log_ctx)
+            await status_msg.edit_text(f"Error analyzing URL: {e}")
 
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
+        data = query.data or ""
+        # Ids in callback data come from our buttons, but a client can send anything
+        for prefix in ("cancel_", "close_"):
+            if data.startswith(prefix) and not data[len(prefix):].isdigit():
+                await query.answer("Invalid button.")
+                logger.warning(f"Malformed callback data: {data[:64]!r}", extra={'user_id': update.effective_user.id})
+                return
         await query.answer()
 
-        data = query.data
-        if data == "cancel":
+        if data == "cancel" or data.startswith("close_"):
+            # "cancel" is the button of menus sent before request tokens existed
+            if data.startswith("close_"):
+                request_store.pop(int(data[len("close_"):]), update.effective_user.id)
             await query.edit_message_text("Cancelled.")
             return
 
-        if not data.startswith("dl_"):
+        if data.startswith("cancel_"):
+            await self._cancel_job(update, int(data[len("cancel_"):]))
             return
 
-        # Parse request_id and format_id
-        # dl_{request_id}_{format_id}
-        parts = data.split('_')
-        if len(parts) < 3:
+        if not data.startswith("dl_"):
             return
 
-        request_id = parts[1]
-        format_id = "_".join(parts[2:]) # format_id might contain underscores? Usually numeric or small string.
-
+        # dl_{token}_{format index}
+        parts = data.split('_')
         user_id = update.effective_user.id
+        username = update.effective_user.username
 
-        lock = session_manager.get_user_lock(user_id)
-        if lock.locked():
-            await query.edit_message_text("You already have a task in progress.")
+        # Taken out of the store right away so a second tap cannot queue it twice
+        request = None
+        if len(parts) == 3 and parts[1].isdigit() and parts[2].isdigit():
+            token = int(parts[1])
+            request = request_store.pop(token, user_id)
+        if not request:
+            await query.edit_message_text("Session expired or invalid. Please send the URL again.")
+            logger.warning(f"Session expired for user {user_id}", extra={'user_id': user_id, 'username': username})
+            return
+        formats = request.info.get('formats', [])
+        if int(parts[2]) >= len(formats):
+            # Not a button of this menu: keep the request so its real buttons still work
+            request_store.restore(token, request)
+            logger.warning(f"Invalid format index {parts[2]} for user {user_id}", extra={'user_id': user_id, 'username': username})
             return
 
-        # Acquire user lock for the duration of download
-        async with lock:
-            await query.edit_message_text("Queued for download...")
-
-            async with session_manager.semaphore:
-                await self._process_download(update, context, request_id, format_id, query.message)
-
-    async def _process_download(self, update, context, request_id, format_id, status_msg):
-        requests = context.user_data.get('requests', {})
-        request_data = requests.get(request_id)
-
-        user_id = update.effective_user.id
-        username = update.effective_user.username
+        info = request.info
+        fmt = formats[int(parts[2])]
+        format_id = fmt.get('format_id')
 
-        log_ctx = {'user_id': user_id, 'username': username}
+        job = Job(
+            user_id, username, update.effective_chat.id, query.message.message_id,
+            request.url, format_id, info, est_size=estimate_size(fmt, info.get('duration')),
+            trace_id=request.trace_id
+        )
 
-        if not request_data:
-            await status_msg.edit_text("Session expired or invalid. Please send the URL again.")
-            logger.warning(f"Session expired for user {user_id}", extra=log_ctx)
+        await query.edit_message_text("Queued for download...")
+        try:
+            # The scheduler runs the job in the background and keeps the message updated
+            await scheduler.submit(job)
+        except QueueFullError as e:
+            # Nothing was queued: keep the request and its buttons so the user can try again
+            request_store.restore(token, request)
+            await query.edit_message_text(str(e), reply_markup=query.message.reply_markup)
             return
 
-        url = request_data['url']
-        info = request_data['video_info']
+        # Now that the job has an id it can be cancelled; a job that already started overrides this text
+        StatusMessage(context.bot, job.chat_id, job.message_id, cancel_markup(job.id)).update("Queued for download...")
+
+    async def _cancel_job(self, update, job_id):
+        query = update.callback_query
+        result = await scheduler.cancel(job_id, update.effective_user.id)
+        status_msg = StatusMessage(query.get_bot(), query.message.chat_id, query.message.message_id)
+        if result == 'queued':
+            status_msg.update("Cancelled.")
+        elif result == 'running':
+            # run_job replaces this with "Cancelled." once everything has stopped
+            status_msg.update("Cancelling...")
+        logger.info(f"Cancel of job {job_id}: {result or 'not found'}", extra={'user_id': update.effective_user.id, 'job_id': job_id})
+
+    async def run_job(self, bot, job):
+        """Scheduler entry point: runs one job and returns the number of bytes processed."""
+        status_msg = StatusMessage(bot, job.chat_id, job.message_id, cancel_markup(job.id))
+        task = asyncio.create_task(self._process_download(bot, job, status_msg), name=f"job-{job.id}-pipeline")
+        # Cancelling interrupts whatever the job awaits: the download, the split or its uploads
+        job.cancel_token.on_cancel(task.cancel)
+        try:
+            return await task
+        except (asyncio.CancelledError, JobCancelled):
+            # A shutdown cancels this task too, and must reach the scheduler
+            if not job.cancel_token.cancelled or scheduler.stopping:
+                raise
+            if job.id in scheduler.lost:
+                # Another worker took over the job and its status message
+                return 0
+            logger.info(f"Job {job.id} cancelled by user", extra={'user_id': job.user_id, 'job_id': job.id})
+            status_msg.reply_markup = None
+            status_msg.update("Cancelled.")
+            return 0
+
+    async def _process_download(self, bot, job, status_msg):
+        user_id = job.user_id
+        log_ctx = {'user_id': user_id, 'username': job.username, 'job_id': job.id, 'trace_id': job.trace_id}
+
+        url = job.url
+        info = job.info
+        format_id = job.format_id
+        chat_id = job.chat_id
 
         log_ctx['url'] = url
 
         title = info.get('title', 'Video')
-        user_dir = os.path.join(DOWNLOAD_PATH, str(user_id))
+        video_key = make_video_key(info, url)
 
-        if not os.path.exists(user_dir):
-            os.makedirs(user_dir)
+        # Parts sent before a restart interrupted this job are not sent again
+        sent = await asyncio.to_thread(journal.sent_parts, job.id)
+        if sent:
+            logger.info(f"Resuming job {job.id}: {len(sent)} parts already sent", extra=log_ctx)
 
-        try:
-            logger.info(f"Starting download process for {url}", extra=log_ctx)
-            last_update_time = 0
-            current_part = 0
-            total_parts = 0
+        if file_cache:
+            try:
+                parts = await asyncio.to_thread(file_cache.get_parts, video_key, format_id, splitter.chunk_size)
+            except Exception as e:
+                logger.warning(f"File cache lookup failed: {e}", extra=log_ctx)
+                parts = None
 
-            async def progress_hook(stage, percent_or_sent, total=None):
-                nonlocal last_update_time
-                current_time = time.time()
+            if parts:
+                logger.info(f"File cache hit for {video_key} ({len(parts)} parts)", extra=log_ctx)
+                # Parts it delivers before failing are added to `sent` and not uploaded again
+                if await self._send_from_cache(bot, job, status_msg, title, parts, log_ctx, sent):
+                    return 0
+                await asyncio.to_thread(file_cache.invalidate, video_key, format_id, splitter.chunk_size)
 
-                # Update every 5 seconds or if finished
-                if stage != "finished" and current_time - last_update_time < 5:
-                    return
+        fmt = next((f for f in info.get('formats', []) if f.get('format_id') == format_id), None)
+        shared = None
+        delivery_started = time.monotonic()
 
-                last_update_time = current_time
+        try:
+            logger.info(f"Starting download process for {url}", extra=log_ctx)
+
+            def progress_hook(stage, percent_or_sent, total=None):
+                # Runs on the event loop; the status editor coalesces and rate-limits the edits
                 text = ""
 
                 if stage == "downloading":
@@ -184,84 +278,197 @@ class BotHandlers:
                     text = "Processing complete!"
 
                 if text:
-                    try:
-                        await status_msg.edit_text(text)
-                    except Exception:
-                        pass
-
-            # Download
-            await status_msg.edit_text("Starting download...")
-            file_path = await downloader.download_video(url, format_id, user_dir, progress_hook, user_context=log_ctx)
-
-            # Split
-            await status_msg.edit_text("Splitting video...")
-            chunks = await splitter.split_file(file_path)
-            total_parts = len(chunks)
+                    status_msg.update(text)
 
-            # Prepare for concurrent upload
-            await status_msg.edit_text(f"Uploading {total_parts} parts...")
-
-            total_size_all = sum(os.path.getsize(c) for c in chunks)
-            uploaded_bytes_per_chunk = [0] * total_parts
-
-            upload_semaphore = asyncio.Semaphore(3) # Max 3 concurrent uploads
             upload_tasks = []
+            chunks = []
+            uploaded_bytes_per_chunk = []
+
+            def caption_for(index):
+                total_parts = shared.total_parts
+                if total_parts:
+                    return f"{title} — Part {index + 1} of {total_parts}"
+                # Streaming: the part count is only known once the download ends
+                return f"{title} — Part {index + 1}"
+
+            def progress_for(index):
+                # Simulated progress for simple uploader
+                async def chunk_progress(sent, total):
+                    # With standard uploader, we only know start (0%) and end (100%).
+                    # This avoids complex wrappers and "unofficial" hacks.
+                    uploaded_bytes_per_chunk[index] = sent
+                    total_uploaded = sum(uploaded_bytes_per_chunk)
+                    progress_hook("uploading", total_uploaded, shared.total_size)
+                return chunk_progress if shared.done else None
+
+            async def upload_worker(indexes, batch, previous):
+                # An upload is also the post, and Telegram orders messages by when their request
+                # completes: with ORDERED_UPLOADS a job's sends run one after another
+                if previous is not None:
+                    await asyncio.shield(previous)
+                job.cancel_token.check()
+                # Pass the bot
+                messages = await uploader.upload_album(
+                    bot, chat_id, batch,
+                    [caption_for(i) for i in indexes],
+                    [progress_for(i) for i in indexes],
+                    cache_keys=[(video_key, format_id, splitter.chunk_size, i) for i in indexes],
+                    job_key=job.id, part_index=indexes[0]
+                )
+                try:
+                    await asyncio.to_thread(journal.mark_sent, job.id, [
+                        (i, m.message_id, m.document.file_id if m.document else None)
+                        for i, m in zip(indexes, messages)
+                    ])
+                except Exception as e:
+                    logger.warning(f"Could not journal sent parts: {e}", extra=log_ctx)
+
+            album_size = ALBUM_SIZE if ALBUM_UPLOADS else 1
+            album_bytes = ALBUM_MAX_MB * 1024 * 1024
+            batch = []  # (index, chunk)
+
+            def batch_bytes(extra=None):
+                # Bytes the album would hold in memory while it is sent
+                members = [c for _, c in batch] + ([extra] if extra is not None else [])
+                return sum(c.length for c in members if uploader.in_memory(c))
+
+            def flush():
+                upload_tasks.append(asyncio.create_task(
+                    upload_worker([i for i, _ in batch], [c for _, c in batch], upload_tasks[-1] if ORDERED_UPLOADS and upload_tasks else None)
+                ))
+                batch.clear()
+
+            # Download, shared with anyone else who requested the same video and format
+            status_msg.update("Starting download...")
+            shared = download_registry.acquire(video_key, format_id, url, fmt, log_ctx, info.get('platform'))
+            shared.subscribe(progress_hook)
 
-            async def upload_worker(index, chunk_path):
-                async with upload_semaphore:
-                    current_part = index + 1
-                    # chunk_name = os.path.basename(chunk_path)
-                    caption = f"{title} — Part {current_part} of {total_parts}"
-
-                    # Simulated progress for simple uploader
-                    async def chunk_progress(sent, total):
-                        # With standard uploader, we only know start (0%) and end (100%).
-                        # This avoids complex wrappers and "unofficial" hacks.
-                        uploaded_bytes_per_chunk[index] = sent
-                        total_uploaded = sum(uploaded_bytes_per_chunk)
-                        await progress_hook("uploading", total_uploaded, total_size_all)
-
-                    # Pass context.bot
-                    await uploader.upload_chunk(context.bot, update.effective_chat.id, chunk_path, caption, chunk_progress)
-
-            for i, chunk_path in enumerate(chunks):
-                upload_tasks.append(asyncio.create_task(upload_worker(i, chunk_path)))
+            try:
+                async for chunk in shared.iter_chunks():
+                    job.cancel_token.check()
+                    # Stop early if an earlier part already failed for good
+                    for task in upload_tasks:
+                        if task.done() and not task.cancelled() and task.exception():
+                            raise task.exception()
+                    index = len(chunks)
+                    chunks.append(chunk)
+                    if index in sent:
+                        uploaded_bytes_per_chunk.append(chunk.length)
+                        continue
+                    uploaded_bytes_per_chunk.append(0)
+                    if batch and batch_bytes(chunk) > album_bytes:
+                        flush()
+                    batch.append((index, chunk))
+                    # Fill albums, but do not let the uploads go idle waiting for more parts
+                    uploads_idle = all(task.done() for task in upload_tasks)
+                    if len(batch) >= album_size or batch_bytes() >= album_bytes or (uploads_idle and len(shared.chunks) <= len(chunks) and not shared.done):
+                        flush()
+                if batch:
+                    flush()
+            except BaseException:
+                for task in upload_tasks:
+                    task.cancel()
+                raise
+            finally:
+                shared.unsubscribe(progress_hook)
 
-            await asyncio.gather(*upload_tasks)
+            total_parts = len(chunks)
+            status_msg.update(f"Uploading {total_parts} parts...")
 
-            await status_msg.edit_text("All parts sent!")
+            upload_started = time.monotonic()
+            try:
+                # Time left after the download; per-request upload rates are recorded by the uploader
+                with metrics.span("upload", log_ctx):
+                    await asyncio.wait_for(asyncio.gather(*upload_tasks), timeout=UPLOAD_DEADLINE or None)
+            except asyncio.TimeoutError:
+                timings = dict(shared.timings, upload=round(time.monotonic() - upload_started, 1))
+                logger.warning(f"Watchdog aborting uploads of job {job.id}: deadline exceeded (stage timings: {timings})", extra=log_ctx)
+                raise StageStalled(f"Uploads exceeded their deadline of {human_readable_duration(UPLOAD_DEADLINE)}.")
+
+            status_msg.reply_markup = None
+            status_msg.update("All parts sent!")
+            if not sent:
+                # End-to-end rate of this job, for the delivery times shown in the quality picker
+                metrics.record_rate("delivery", sum(c.length for c in chunks), time.monotonic() - delivery_started)
 
             if total_parts > 1:
-                # Generate specific merge instructions
-                filenames = [f'"{os.path.basename(c)}"' for c in chunks]
-                safe_title = sanitize_filename(title)
-                linux_cmd = f"cat {' '.join(filenames)} > \"{safe_title} - Full.mp4\""
-                windows_cmd = f"copy /b {'+'.join(filenames)} \"{safe_title} - Full.mp4\""
-
-                # Truncate if too long (Telegram limit 4096 chars)
-                if len(linux_cmd) > 1000:
-                    linux_cmd = "cat \"Part A...\" ... > \"Full.mp4\" (too many parts to list)"
-                if len(windows_cmd) > 1000:
-                    windows_cmd = "copy /b ... (too many parts to list)"
-
-                instructions = (
-                    "To merge these parts:\n\n"
-                    "*Linux/macOS:*\n"
-                    f"`{linux_cmd}`\n\n"
-                    "*Windows CMD:*\n"
-                    f"`{windows_cmd}`\n\n"
-                    "*Android:* Use MiXplorer or Total Commander."
-                )
+                await self._send_merge_instructions(status_msg, title, [c.name for c in chunks])
 
-                await status_msg.reply_text(instructions, parse_mode=ParseMode.MARKDOWN)
+            if file_cache:
+                try:
+                    await asyncio.to_thread(file_cache.complete, video_key, format_id, splitter.chunk_size, total_parts)
+                except Exception as e:
+                    logger.warning(f"Could not complete file cache entry: {e}", extra=log_ctx)
 
+            return sum(c.length for c in chunks)
+
+        except (JobCancelled, JobInterrupted):
+            raise
         except Exception as e:
             logger.error(f"Process failed for user {user_id}: {e}", extra=log_ctx)
-            await status_msg.edit_text(f"Task failed: {e}")
+            status_msg.reply_markup = None
+            status_msg.update(f"Task failed: {e}")
         finally:
-            cleanup_temp_dir(user_dir)
-            # Clean up request data
-            if 'requests' in context.user_data and request_id in context.user_data['requests']:
-                del context.user_data['requests'][request_id]
+            if shared is not None:
+                # Files are removed once the last user sharing this download is done
+                download_registry.release(shared)
+
+    async def _send_merge_instructions(self, status_msg, title, names):
+        # Generate specific merge instructions
+        filenames = [f'"{name}"' for name in names]
+        safe_title = sanitize_filename(title)
+        linux_cmd = f"cat {' '.join(filenames)} > \"{safe_title} - Full.mp4\""
+        windows_cmd = f"copy /b {'+'.join(filenames)} \"{safe_title} - Full.mp4\""
+
+        # Truncate if too long (Telegram limit 4096 chars)
+        if len(linux_cmd) > 1000:
+            linux_cmd = "cat \"Part A...\" ... > \"Full.mp4\" (too many parts to list)"
+        if len(windows_cmd) > 1000:
+            windows_cmd = "copy /b ... (too many parts to list)"
+
+        instructions = (
+            "To merge these parts:\n\n"
+            "*Linux/macOS:*\n"
+            f"`{linux_cmd}`\n\n"
+            "*Windows CMD:*\n"
+            f"`{windows_cmd}`\n\n"
+            "*Android:* Use MiXplorer or Total Commander."
+        )
+
+        await status_msg.reply_text(instructions, parse_mode=ParseMode.MARKDOWN)
+
+    async def _send_from_cache(self, bot, job, status_msg, title, parts, log_ctx, sent):
+        """
+        Re-sends a previously uploaded job by file_id, except the parts already in `sent`.
+        Each delivered album is journaled and added to `sent`, like a fresh upload.
+        Returns False if Telegram rejected a cached file so the caller can fall back to downloading.
+        """
+        total_parts = len(parts)
+        pending = [i for i in range(total_parts) if i not in sent]
+        status_msg.update(f"Sending {len(pending)} cached parts...")
+        album_size = ALBUM_SIZE if ALBUM_UPLOADS else 1
+        try:
+            for first in range(0, len(pending), album_size):
+                batch = pending[first:first + album_size]
+                captions = [f"{title} — Part {i + 1} of {total_parts}" for i in batch]
+                messages = await uploader.send_cached_album(bot, job.chat_id, [parts[i]['file_id'] for i in batch], captions)
+                if not isinstance(messages, (list, tuple)):
+                    messages = [messages]
+                delivered = [(i, m.message_id, parts[i]['file_id']) for i, m in zip(batch, messages)]
+                sent.update((i, message_id) for i, message_id, _ in delivered)
+                try:
+                    await asyncio.to_thread(journal.mark_sent, job.id, delivered)
+                except Exception as e:
+                    logger.warning(f"Could not journal sent parts: {e}", extra=log_ctx)
+        except Exception as e:
+            logger.warning(f"Cached resend failed, downloading again: {e}", extra=log_ctx)
+            return False
+
+        status_msg.reply_markup = None
+        status_msg.update("All parts sent!")
+        if total_parts > 1:
+            await self._send_merge_instructions(status_msg, title, [p['name'] for p in parts])
+        return True
 
 handlers = BotHandlers()
+scheduler.set_runner(handlers.run_job)
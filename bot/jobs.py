@@ -0,0 +1,357 @@
+import os
+import shutil
+import asyncio
+import hashlib
+import itertools
+from .config import DOWNLOAD_PATH, SPOOL_PATH, PIPELINE_MODE, DOWNLOAD_DEADLINE, SPLIT_DEADLINE, PROGRESS_INTERVAL
+from .downloader import downloader
+from .extractor import extractor
+from .formats import estimate_size
+from .splitter import splitter, GrowingFile
+from .admission import disk_budget, spool_budget
+from .cancel import CancelToken, JobCancelled, JobInterrupted
+from .watchdog import watchdog
+from .journal import journal, is_under
+from .metrics import metrics
+from .dispatch import supervisor
+from .utils import cleanup_temp_dir
+from .logger import logger
+
+class SharedDownload:
+    """
+    One download + split of a (video, format) pair, shared by every user who asked for it.
+    Chunks are published as soon as they exist; each requester iterates them and runs
+    its own uploads. The output directory is removed when the last requester releases it,
+    unless the bot is shutting down: then it is kept, with its journal entry, for the restart.
+
+    Clips expected to fit in one part may be `spooled`: downloaded into the tmpfs spool and
+    uploaded from there. One that outgrows a part is moved to `spill_dir` on disk, where
+    yt-dlp resumes it. Spooled downloads are not journaled, they start over after a restart.
+    """
+    STOP_TIMEOUT = 5  # seconds to wait for a cancelled yt-dlp thread to exit
+
+    def __init__(self, key, url, format_id, fmt, output_dir, log_ctx, platform=None, spill_dir=None):
+        self.key = key
+        self.platform = platform
+        self.url = url
+        self.format_id = format_id
+        self.fmt = fmt
+        self.output_dir = output_dir
+        self.spill_dir = spill_dir
+        self.spooled = spill_dir is not None
+        self.spilling = False
+        self.attempt = None  # CancelToken of the running download attempt
+        self.download_task = None  # its task; a spill starts a new one
+        self.log_ctx = log_ctx
+        self.chunks = []
+        self.total_parts = 0
+        self.total_size = 0
+        self.done = False
+        self.error = None
+        self.refs = 0
+        self.task = None
+        self.subscribers = []
+        self.growing = GrowingFile()
+        # Set when nobody needs the download anymore; stops the yt-dlp thread and the split
+        self.cancel = CancelToken()
+        self.abort_error = None
+        self.timings = {}  # stage -> seconds, filled by the watchdog
+        self.keep_files = False  # set on shutdown, the download resumes after the restart
+        self.interrupted = False  # stopped by the shutdown rather than failed
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _publish(self, chunk):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def subscribe(self, callback):
+        """Registers a callback(stage, value) for download/split progress, called on the event loop."""
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+
+    def _broadcast(self, stage, value):
+        # Correct the disk reservation with what the download reports
+        factor = 1 if splitter.virtual else 2
+        total = self.growing.total_bytes * factor if self.growing.total_bytes else None
+        disk_budget.adjust(self.key, self.growing.downloaded_bytes * factor, total)
+        for callback in list(self.subscribers):
+            try:
+                callback(stage, value)
+            except Exception:
+                pass
+
+    def abort(self, error):
+        """Fails the download with `error`, stopping the yt-dlp thread and the split."""
+        self.abort_error = error
+        self.cancel.cancel()
+        if self.task is not None:
+            self.task.cancel()
+
+    def _download_progress(self):
+        # Nothing is downloaded while yt-dlp post-processes, the watchdog skips that time
+        return None if self.growing.postprocessing else self.growing.downloaded_bytes
+
+    async def iter_chunks(self):
+        """Yields every chunk of the job in order, waiting for new ones until the split ends."""
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+
+            changed = self._changed
+            if index < len(self.chunks):
+                continue
+            if self.error is not None:
+                raise self.error
+            if self.done:
+                return
+            await changed.wait()
+
+    def _start_download(self, info_dict, stream):
+        # Each attempt gets its own token, so a spill can stop one without cancelling the job
+        self.attempt = CancelToken()
+        self.cancel.on_cancel(self.attempt.cancel)
+        self.download_task = asyncio.create_task(
+            downloader.download_video(
+                self.url, self.format_id, self.output_dir, self._broadcast,
+                user_context=self.log_ctx, growing=self.growing, info_dict=info_dict,
+                stream=stream, cancel=self.attempt, fmt=self.fmt, platform=self.platform,
+                # aria2c cannot be moved mid-download, so spooled clips stay with yt-dlp
+                external=not self.spooled
+            )
+        )
+
+    async def _guard_spool(self):
+        """
+        Watches what a spooled download really occupies in the spool (hooks may be silent
+        for long stretches) and stops it for a spill once it is bigger than one part.
+        """
+        while self.spooled and not self.spilling:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            try:
+                used = sum(entry.stat().st_size for entry in os.scandir(self.output_dir) if entry.is_file())
+            except OSError:
+                continue
+            spool_budget.adjust(self.key, used, self.growing.total_bytes)
+            size = max(used, self.growing.total_bytes or 0)
+            if size > splitter.chunk_size and not self.growing.postprocessing:
+                # Bigger than one part after all: stop and continue on disk
+                self.spilling = True
+                self.attempt.cancel()
+
+    async def _spill(self):
+        """Moves the spooled download to disk and frees its share of the spool."""
+        logger.info(f"Download outgrew the spool, moving it to {self.spill_dir}", extra=self.log_ctx)
+        await asyncio.to_thread(shutil.move, self.output_dir, self.spill_dir)
+        self.output_dir = self.spill_dir
+        self.spooled = False
+        self.spilling = False
+        spool_budget.release(self.key)
+        await asyncio.to_thread(journal.start_download, *self.key, self.output_dir)
+
+    async def _download_spooling(self, info_dict, stream):
+        """Waits for the download, moving it to disk if it outgrows the spool. Returns its path."""
+        while True:
+            try:
+                # Shielded so a cancellation reaches run's except with the thread still tracked
+                file_path = await asyncio.shield(self.download_task)
+            except JobCancelled:
+                if not self.spilling or self.cancel.cancelled:
+                    raise
+                await self._spill()
+                self._start_download(info_dict, stream)
+                continue
+            if self.spooled and os.path.getsize(file_path) > splitter.chunk_size:
+                # Finished before the guard noticed; split it on disk, not in RAM
+                await self._spill()
+                file_path = os.path.join(self.output_dir, os.path.basename(file_path))
+            return file_path
+
+    async def run(self):
+        """Downloads and splits the video, publishing chunks as they are cut."""
+        # Continue in the directory of a run interrupted by a restart; yt-dlp resumes its .part file
+        previous = await asyncio.to_thread(journal.get_download, *self.key)
+        # Only directories of this worker: another one may still be writing to its own
+        if previous is not None and is_under(previous[0], DOWNLOAD_PATH) and os.path.isdir(previous[0]):
+            if self.spooled:
+                self.spooled = False
+                spool_budget.release(self.key)
+            self.output_dir = previous[0]
+            logger.info(f"Resuming interrupted download in {self.output_dir}", extra=self.log_ctx)
+        if not self.spooled:
+            await asyncio.to_thread(journal.start_download, *self.key, self.output_dir)
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        # Reuse the info from the quality picker so the site is not extracted twice
+        info_dict = extractor.get_cached_raw_info(self.url)
+
+        # A spooled clip is a single part, there is nothing to pipeline
+        stream = PIPELINE_MODE and downloader.supports_streaming(self.fmt) and not self.spooled
+        if stream:
+            # Pipeline: parts are cut and handed out while the rest is still downloading
+            logger.info(f"Streaming pipeline enabled for format {self.format_id}", extra=self.log_ctx)
+        self._start_download(info_dict, stream)
+
+        try:
+            with metrics.span("download", self.log_ctx) as span, watchdog.watch(
+                "download", self.url, self.abort, progress=self._download_progress,
+                deadline=DOWNLOAD_DEADLINE, timings=self.timings, log_ctx=self.log_ctx
+            ):
+                if stream:
+                    async for chunk in splitter.split_growing(self.growing, self.download_task, self.cancel):
+                        self.total_size += chunk.length
+                        self._publish(chunk)
+                else:
+                    guard = asyncio.create_task(self._guard_spool()) if self.spooled else None
+                    try:
+                        file_path = await self._download_spooling(info_dict, stream)
+                    finally:
+                        if guard is not None:
+                            guard.cancel()
+                span.nbytes = self.growing.downloaded_bytes
+
+            if stream:
+                self.total_parts = len(self.chunks)
+            else:
+                self._broadcast("splitting", None)
+                with metrics.span("split", self.log_ctx) as span, watchdog.watch(
+                    "split", self.url, self.abort, deadline=SPLIT_DEADLINE,
+                    timings=self.timings, log_ctx=self.log_ctx
+                ):
+                    chunks = await splitter.split_file(file_path, self.cancel)
+                    span.nbytes = sum(c.length for c in chunks)
+                # Serial mode knows the part count before any upload starts
+                self.total_parts = len(chunks)
+                self.total_size = sum(c.length for c in chunks)
+                for chunk in chunks:
+                    self._publish(chunk)
+
+            await asyncio.to_thread(
+                journal.finish_download, *self.key, self.output_dir,
+                self.chunks[-1].path if self.chunks else None, self.total_parts
+            )
+            self.done = True
+            self._notify()
+        except BaseException as e:
+            if self.interrupted:
+                # Not a failure: requesters stop quietly and their jobs stay queued for the restart
+                self.error = JobInterrupted("Interrupted by shutdown.")
+            elif self.abort_error is not None:
+                self.error = self.abort_error
+            else:
+                self.error = e if isinstance(e, Exception) else Exception("Download was cancelled.")
+            # Requesters can give up right away, only the directory cleanup waits for the thread
+            self._notify()
+            download_task = self.download_task
+            if not download_task.done():
+                # Stop the yt-dlp thread and let it exit before the directory is removed
+                self.cancel.cancel()
+                await asyncio.wait({download_task}, timeout=self.STOP_TIMEOUT)
+            if download_task.done() and not download_task.cancelled():
+                # The thread's own error is superseded by `e`, mark it as retrieved
+                download_task.exception()
+            if not self.keep_files and not self.spooled:
+                # A failed attempt is not resumable, the next one starts in a fresh directory
+                await asyncio.to_thread(journal.forget_download, *self.key, self.output_dir)
+            if not isinstance(e, Exception):
+                raise
+
+class DownloadRegistry:
+    """Single-flight registry: identical (video, format) requests attach to one running download."""
+    def __init__(self):
+        self.jobs = {}
+        self.counter = itertools.count(1)
+        self.preserve = False
+
+    def acquire(self, video_key, format_id, url, fmt, log_ctx, platform=None):
+        """Returns the shared job for the key, starting it if nobody is downloading it yet."""
+        key = (video_key, format_id)
+        job = self.jobs.get(key)
+        if job is None or job.error is not None:
+            # A failed job may still be releasing its directory, so every attempt gets its own
+            digest = hashlib.sha1(f"{video_key}|{format_id}".encode()).hexdigest()[:16]
+            name = f"{digest}-{next(self.counter)}"
+            output_dir = os.path.join(DOWNLOAD_PATH, name)
+            spill_dir = None
+            if self._fits_spool(key, fmt):
+                # Fast path: a single-part clip is staged in RAM, its disk directory is the fallback
+                spill_dir, output_dir = output_dir, os.path.join(SPOOL_PATH, name)
+            job = SharedDownload(key, url, format_id, fmt, output_dir, dict(log_ctx), platform, spill_dir)
+            self.jobs[key] = job
+            job.task = supervisor.spawn(job.run(), name=f"download-{os.path.basename(output_dir)}")
+        else:
+            logger.info(f"Attached to in-flight download of {video_key} ({job.refs} other requesters)", extra=log_ctx)
+
+        job.refs += 1
+        return job
+
+    def _fits_spool(self, key, fmt):
+        """Whether the download is known to fit in one part and the spool has room for it."""
+        size = estimate_size(fmt)
+        if spool_budget is None or not size or size > splitter.chunk_size:
+            return False
+        if '+' in str(fmt.get('format_id', '')):
+            # Merging needs the streams and the merged file at once, about twice the size
+            return False
+        try:
+            return spool_budget.try_reserve(key, size)
+        except OSError as e:
+            logger.warning(f"Spool unavailable, downloading to disk: {e}")
+            return False
+
+    def release(self, job):
+        """Drops one reference; the last one stops the download and removes its files."""
+        job.refs -= 1
+        if job.refs > 0:
+            return
+
+        if self.jobs.get(job.key) is job:
+            del self.jobs[job.key]
+
+        if self.preserve:
+            self._stop(job)
+            return
+        supervisor.spawn(self._discard(job), name=f"discard-{os.path.basename(job.output_dir)}")
+
+    def _stop(self, job):
+        job.interrupted = True
+        # Spooled clips are not resumed, startup clears the spool
+        job.keep_files = not job.spooled
+        if not job.task.done():
+            job.cancel.cancel()
+            job.task.cancel()
+
+    async def _discard(self, job):
+        if not job.task.done():
+            job.cancel.cancel()
+            job.task.cancel()
+            await asyncio.wait({job.task})
+        try:
+            await asyncio.to_thread(journal.forget_download, *job.key, job.output_dir)
+        except Exception as e:
+            logger.warning(f"Failed to drop journal entry of {job.output_dir}: {e}", extra=job.log_ctx)
+        await asyncio.to_thread(cleanup_temp_dir, job.output_dir)
+        if job.spooled:
+            spool_budget.release(job.key)
+
+    async def shutdown(self):
+        """Stops every download but keeps its files and journal entry, so it resumes after a restart."""
+        self.preserve = True
+        tasks = {job.task for job in self.jobs.values()}
+        for job in self.jobs.values():
+            self._stop(job)
+        if tasks:
+            await asyncio.wait(tasks, timeout=SharedDownload.STOP_TIMEOUT + 1)
+
+download_registry = DownloadRegistry()
+if spool_budget is not None:
+    metrics.gauge("bot_spool_reserved_bytes", "Bytes reserved in the small-clip spool.", lambda: spool_budget.reserved)
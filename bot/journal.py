@@ -0,0 +1,111 @@
+import os
+import time
+from .config import JOURNAL_DB
+from .store import SQLiteStore
+
+def is_under(path, root):
+    return os.path.dirname(os.path.abspath(path)) == os.path.abspath(root)
+
+class JobJournal(SQLiteStore):
+    """
+    What an interrupted job needs to resume after a restart: where its download lives
+    and how far it got, and which parts were already sent (with their message ids).
+    Methods are blocking; call them via asyncio.to_thread.
+    """
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS downloads ("
+        " video_key TEXT NOT NULL,"
+        " format_id TEXT NOT NULL,"
+        " output_dir TEXT NOT NULL,"
+        " state TEXT NOT NULL,"
+        " file_path TEXT,"
+        " part_count INTEGER,"
+        " updated_at REAL NOT NULL,"
+        " PRIMARY KEY (video_key, format_id))",
+        "CREATE TABLE IF NOT EXISTS sent_parts ("
+        " job_id INTEGER NOT NULL,"
+        " part_index INTEGER NOT NULL,"
+        " message_id INTEGER,"
+        " file_id TEXT,"
+        " sent_at REAL NOT NULL,"
+        " PRIMARY KEY (job_id, part_index))",
+    ]
+
+    def start_download(self, video_key, format_id, output_dir):
+        self.execute(
+            "INSERT OR REPLACE INTO downloads (video_key, format_id, output_dir, state, updated_at)"
+            " VALUES (?, ?, ?, 'downloading', ?)",
+            (video_key, format_id, output_dir, time.time())
+        )
+
+    def finish_download(self, video_key, format_id, output_dir, file_path, part_count):
+        """Marks the download complete and split into `part_count` parts."""
+        self.execute(
+            "UPDATE downloads SET state = 'downloaded', file_path = ?, part_count = ?, updated_at = ?"
+            " WHERE video_key = ? AND format_id = ? AND output_dir = ?",
+            (file_path, part_count, time.time(), video_key, format_id, output_dir)
+        )
+
+    def get_download(self, video_key, format_id):
+        """Returns (output_dir, state, file_path, part_count) of an interrupted download, or None."""
+        rows = self.query(
+            "SELECT output_dir, state, file_path, part_count FROM downloads WHERE video_key = ? AND format_id = ?",
+            (video_key, format_id)
+        )
+        return rows[0] if rows else None
+
+    def forget_download(self, video_key, format_id, output_dir):
+        """Drops the entry, unless a newer attempt in another directory replaced it."""
+        self.execute(
+            "DELETE FROM downloads WHERE video_key = ? AND format_id = ? AND output_dir = ?",
+            (video_key, format_id, output_dir)
+        )
+
+    def mark_sent(self, job_id, parts):
+        """Records sent parts, given as (part_index, message_id, file_id) tuples."""
+        now = time.time()
+        with self.lock:
+            conn = self._connect()
+            conn.executemany(
+                "INSERT OR REPLACE INTO sent_parts (job_id, part_index, message_id, file_id, sent_at) VALUES (?, ?, ?, ?, ?)",
+                [(job_id, index, message_id, file_id, now) for index, message_id, file_id in parts]
+            )
+            conn.commit()
+
+    def sent_parts(self, job_id):
+        """Returns {part_index: message_id} of the parts this job already sent."""
+        rows = self.query("SELECT part_index, message_id FROM sent_parts WHERE job_id = ?", (job_id,))
+        return dict(rows)
+
+    def forget_job(self, job_id):
+        self.execute("DELETE FROM sent_parts WHERE job_id = ?", (job_id,))
+
+    def prune(self, download_keys, job_ids, root):
+        """
+        Keeps only entries of the given (video_key, format_id) pairs and job ids, i.e. of jobs
+        that will be resumed. Download entries outside `root` belong to other workers and are
+        left alone. Returns the download directories under `root` that are still needed.
+        """
+        with self.lock:
+            conn = self._connect()
+            keep = []
+            for video_key, format_id, output_dir in conn.execute(
+                "SELECT video_key, format_id, output_dir FROM downloads"
+            ).fetchall():
+                if not is_under(output_dir, root):
+                    continue
+                if (video_key, format_id) in download_keys and os.path.isdir(output_dir):
+                    keep.append(output_dir)
+                else:
+                    conn.execute(
+                        "DELETE FROM downloads WHERE video_key = ? AND format_id = ?",
+                        (video_key, format_id)
+                    )
+
+            for (job_id,) in conn.execute("SELECT DISTINCT job_id FROM sent_parts").fetchall():
+                if job_id not in job_ids:
+                    conn.execute("DELETE FROM sent_parts WHERE job_id = ?", (job_id,))
+            conn.commit()
+        return keep
+
+journal = JobJournal(JOURNAL_DB)
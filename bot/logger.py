@@ -1,14 +1,38 @@
 import logging
 import json
 import logging.handlers
+import atexit
+import itertools
+import multiprocessing
 import os
+import queue
 import sys
-from .config import LOG_FILE
+import threading
+import time
+from .config import LOG_FILE, LOG_QUEUE_SIZE, LOG_BATCH_SIZE, LOG_SAMPLE_RATES
+
+# Attributes every LogRecord has; anything else on a record came from 'extra'
+STANDARD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {'message', 'asctime'}
 
 class JSONFormatter(logging.Formatter):
+    encoder = json.JSONEncoder(default=str)
+
+    def __init__(self):
+        super().__init__()
+        self.cached_second = None
+        self.cached_prefix = ""
+
+    def timestamp(self, created):
+        # Same output as formatTime, but strftime runs once per second
+        second = int(created)
+        if second != self.cached_second:
+            self.cached_second = second
+            self.cached_prefix = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+        return f"{self.cached_prefix},{int((created - second) * 1000):03d}"
+
     def format(self, record):
         log_record = {
-            "timestamp": self.formatTime(record, self.datefmt),
+            "timestamp": self.timestamp(record.created),
             "level": record.levelname,
             "message": record.getMessage(),
             "logger": record.name,
@@ -18,19 +42,122 @@ class JSONFormatter(logging.Formatter):
         }
 
         # Add extra fields from 'extra' parameter
-        # Standard LogRecord attributes to exclude
-        standard_attrs = {
-            'args', 'asctime', 'created', 'exc_info', 'exc_text', 'filename',
-            'funcName', 'levelname', 'levelno', 'lineno', 'module',
-            'msecs', 'message', 'msg', 'name', 'pathname', 'process',
-            'processName', 'relativeCreated', 'stack_info', 'thread', 'threadName'
-        }
+        attrs = record.__dict__
+        for key in attrs.keys() - STANDARD_ATTRS:
+            if not key.startswith('_'):
+                log_record[key] = attrs[key]
+        if record.exc_text:
+            log_record["exception"] = record.exc_text
+
+        return self.encoder.encode(log_record)
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps 1 in N records of high-frequency messages. Callers tag them with
+    extra={'sample': tag}; rates come from LOG_SAMPLE_RATES, untagged records always pass.
+    """
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.counters = {tag: itertools.count() for tag in rates}
+
+    def filter(self, record):
+        tag = getattr(record, 'sample', None)
+        rate = self.rates.get(tag)
+        if not rate:
+            return True
+        if next(self.counters[tag]) % rate:
+            return False
+        record.sample_rate = rate
+        return True
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the writer thread. Only the message is rendered on the caller's thread
+    (its arguments may change afterwards); JSON encoding and I/O happen in the writer.
+    A full queue drops the record instead of blocking the event loop.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
 
-        for key, value in record.__dict__.items():
-            if key not in standard_attrs and not key.startswith('_'):
-                log_record[key] = value
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class BatchWriter:
+    """
+    Background thread that drains the log queue and writes whatever has accumulated
+    (up to batch_size records) with one write and one flush per handler.
+    """
+    def __init__(self, log_queue, handlers, formatter, source, batch_size=LOG_BATCH_SIZE):
+        self.queue = log_queue
+        self.handlers = handlers
+        self.formatter = formatter
+        self.source = source  # the queue handler, for its dropped count
+        self.batch_size = max(1, batch_size)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Writes out everything queued so far and stops the thread."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join(timeout=5)
+            self.thread = None
+
+    def _run(self):
+        while True:
+            records = [self.queue.get()]
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
 
-        return json.dumps(log_record)
+            stopping = None in records
+            lines = []
+            for record in records:
+                if record is not None:
+                    try:
+                        lines.append(self.formatter.format(record))
+                    except Exception as e:
+                        lines.append(json.dumps({"level": "ERROR", "message": f"Could not format log record: {e}"}))
+            dropped, self.source.dropped = self.source.dropped, 0
+            if dropped:
+                lines.append(json.dumps({"level": "WARNING", "message": f"Log queue full, dropped {dropped} records"}))
+            if lines:
+                self._write("".join(line + "\n" for line in lines))
+            if stopping:
+                return
+
+    def _write(self, text):
+        for handler in self.handlers:
+            handler.acquire()
+            try:
+                if isinstance(handler, logging.handlers.RotatingFileHandler):
+                    # Checked per batch instead of per record
+                    if handler.maxBytes and handler.stream.tell() + len(text) >= handler.maxBytes:
+                        handler.doRollover()
+                handler.stream.write(text)
+                handler.flush()
+            except Exception as e:
+                print(f"Error writing logs: {e}", file=sys.stderr)
+            finally:
+                handler.release()
 
 def setup_logger():
     logger = logging.getLogger("VideoSplitterBot")
@@ -51,20 +178,31 @@ def setup_logger():
             # But prompt says exit cleanly.
             pass
 
-    # File Handler
-    try:
-        file_handler = logging.handlers.RotatingFileHandler(
-            LOG_FILE, maxBytes=10*1024*1024, backupCount=5
-        )
-        file_handler.setFormatter(JSONFormatter())
-        logger.addHandler(file_handler)
-    except Exception as e:
-        print(f"Error setting up file logging: {e}")
+    handlers = []
+
+    # File Handler. Extraction worker processes log to the console only: several processes
+    # rotating one file independently would lose records.
+    if multiprocessing.parent_process() is None:
+        try:
+            file_handler = logging.handlers.RotatingFileHandler(
+                LOG_FILE, maxBytes=10*1024*1024, backupCount=5
+            )
+            handlers.append(file_handler)
+        except Exception as e:
+            print(f"Error setting up file logging: {e}")
 
     # Console Handler
-    console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setFormatter(JSONFormatter())
-    logger.addHandler(console_handler)
+    handlers.append(logging.StreamHandler(sys.stdout))
+
+    # The logger only enqueues; formatting and writes happen on the writer thread
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_RATES))
+    logger.addHandler(queue_handler)
+
+    writer = BatchWriter(log_queue, handlers, JSONFormatter(), queue_handler)
+    writer.start()
+    atexit.register(writer.stop)
 
     return logger
 
@@ -1,21 +1,112 @@
 import logging
+import signal
+import asyncio
+from urllib.parse import urlparse
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, filters
-from bot.config import BOT_TOKEN, DOWNLOAD_PATH
+from bot.config import (
+    BOT_TOKEN, DOWNLOAD_PATH, SPOOL_PATH, LOCAL_BOT_API, LOCAL_BOT_API_URL, MAX_CHUNK_SIZE_MB, METRICS_HOST, METRICS_PORT,
+    BOT_ROLE, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET, UPDATE_CONCURRENCY
+)
 from bot.handlers import handlers
+from bot.extractor import extractor
+from bot.scheduler import scheduler
+from bot.jobs import download_registry
+from bot.journal import journal
+from bot.cache import make_video_key
+from bot.transport import build_requests, use_local_api
+from bot.metrics import metrics
+from bot.dispatch import PerUserUpdateProcessor, supervisor
 from bot.logger import logger
 from bot.utils import cleanup_download_dir
 
+def resumable_dirs():
+    """Drops journal entries of jobs that will not run again; returns the download dirs to keep."""
+    pending = scheduler.store.load_pending()
+    return journal.prune(
+        {(make_video_key(job.info, job.url), job.format_id) for job in pending},
+        {job.id for job in pending},
+        DOWNLOAD_PATH
+    )
+
+def run_worker(app, post_init, post_stop):
+    """Runs jobs from the shared queue without receiving updates, until SIGINT/SIGTERM."""
+    async def serve():
+        async with app:
+            await post_init(app)
+            stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, stop.set)
+            await stop.wait()
+            await post_stop(app)
+
+    asyncio.run(serve())
+
 def main():
-    logger.info("Starting Video Splitter Bot...")
+    logger.info(f"Starting Video Splitter Bot ({BOT_ROLE})...")
+
+    if BOT_ROLE != "frontend":
+        # Clean up downloads directory on startup, keeping partial downloads of restored jobs
+        keep = resumable_dirs()
+        if keep:
+            logger.info(f"Keeping {len(keep)} partial downloads to resume")
+        cleanup_download_dir(DOWNLOAD_PATH, keep=keep)
+        if SPOOL_PATH:
+            # Spooled clips are small and start over after a restart
+            cleanup_download_dir(SPOOL_PATH)
 
-    # Clean up downloads directory on startup
-    cleanup_download_dir(DOWNLOAD_PATH)
+    if BOT_ROLE != "worker":
+        # Warm up extraction workers before the first URL arrives
+        extractor.start_pool()
 
     try:
-        app = ApplicationBuilder().token(BOT_TOKEN).build()
+        async def post_init(application):
+            # Restore queued jobs and start dispatching once the bot is ready
+            await scheduler.start(application.bot)
+            if METRICS_PORT:
+                try:
+                    await metrics.start_server(METRICS_HOST, METRICS_PORT)
+                except OSError as e:
+                    logger.error(f"Could not start metrics endpoint on {METRICS_HOST}:{METRICS_PORT}: {e}")
+
+        async def post_stop(application):
+            # Interrupt running jobs while the bot can still be used; they resume on the next start.
+            # The scheduler must know it is stopping first, or interrupted jobs count as finished.
+            scheduler.stopping = True
+            await download_registry.shutdown()
+            await scheduler.stop()
+            # Directory cleanups and other leftovers get a moment to finish
+            await supervisor.shutdown()
+            await metrics.stop_server()
+
+        # Separate connection pools for uploads, control calls and polling
+        bot_request, updates_request = build_requests()
+
+        builder = (
+            ApplicationBuilder().token(BOT_TOKEN)
+            .request(bot_request)
+            .get_updates_request(updates_request)
+            .post_init(post_init)
+            .post_stop(post_stop)
+            # Long handlers (URL analysis) of one user do not hold up everyone else's updates
+            .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+        )
+        if BOT_ROLE == "worker":
+            # Workers only send; updates go to the frontend
+            builder = builder.updater(None)
+        if LOCAL_BOT_API:
+            logger.info(f"Using local Bot API server at {LOCAL_BOT_API_URL} ({MAX_CHUNK_SIZE_MB} MB parts)")
+            builder = use_local_api(builder)
+        app = builder.build()
+
+        if BOT_ROLE == "worker":
+            logger.info("Worker started, waiting for jobs...")
+            run_worker(app, post_init, post_stop)
+            return
 
         # Register handlers
         app.add_handler(CommandHandler("start", handlers.start))
+        app.add_handler(CommandHandler("stats", handlers.stats))
         app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handlers.handle_url))
         app.add_handler(CallbackQueryHandler(handlers.handle_callback))
 
@@ -25,8 +116,18 @@ def main():
 
         app.add_error_handler(error_handler)
 
-        logger.info("Bot started and polling...")
-        app.run_polling()
+        if WEBHOOK_URL:
+            logger.info(f"Bot started, receiving updates on {WEBHOOK_URL}...")
+            app.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=urlparse(WEBHOOK_URL).path.lstrip("/"),
+                webhook_url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET or None
+            )
+        else:
+            logger.info("Bot started and polling...")
+            app.run_polling()
 
     except Exception as e:
         logger.critical(f"Bot crashed: {e}")
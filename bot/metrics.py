@@ -0,0 +1,222 @@
+import time
+import uuid
+import asyncio
+import bisect
+from contextlib import contextmanager
+from .cancel import JobCancelled
+from .logger import logger
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+def _render_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self, **labels):
+        """Sum over every label set that includes `labels`."""
+        wanted = set(labels.items())
+        return sum(v for key, v in self.values.items() if wanted <= set(key))
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        for key, value in self.values.items():
+            yield f"{self.name}{_render_labels(key)} {value}"
+
+class Histogram:
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = sorted(buckets)
+        self.series = {}  # label key -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, **labels):
+        key = _key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def count(self, **labels):
+        series = self.series.get(_key(labels))
+        return sum(series[:-1]) if series else 0
+
+    def quantile(self, q, **labels):
+        """Estimates the q-quantile by linear interpolation within buckets, like histogram_quantile."""
+        series = self.series.get(_key(labels))
+        if not series:
+            return None
+        counts = series[:-1]
+        rank = q * sum(counts)
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                if index == len(self.buckets):
+                    # Beyond the last bucket: the best we can say is "more than" its bound
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return None
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        for key, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ["+Inf"], series[:-1]):
+                cumulative += count
+                yield f"{self.name}_bucket{_render_labels(key, [('le', bound)])} {cumulative}"
+            yield f"{self.name}_sum{_render_labels(key)} {series[-1]}"
+            yield f"{self.name}_count{_render_labels(key)} {cumulative}"
+
+class Span:
+    __slots__ = ('stage', 'nbytes', 'started')
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.nbytes = 0
+        self.started = time.monotonic()
+
+class Metrics:
+    """
+    In-process metrics in the Prometheus text format, served on METRICS_PORT.
+    Counters and histograms are updated by the pipeline; gauges are callables
+    registered by the modules owning the state and read at scrape time.
+    Everything is updated from the event loop thread, except counters bumped by extraction
+    threads, where an increment lost to a race is acceptable.
+    """
+    def __init__(self):
+        self.stage_seconds = Histogram(
+            "bot_stage_seconds", "Duration of job stages.",
+            [0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200]
+        )
+        self.throughput = Histogram(
+            "bot_throughput_bytes_per_second", "Transfer rate of finished downloads and uploads.",
+            [2 ** n * 64 * 1024 for n in range(13)]  # 64 KB/s .. 256 MB/s
+        )
+        self.queue_wait = Histogram(
+            "bot_queue_wait_seconds", "Time jobs spent queued before a slot was free.",
+            [0.1, 1, 5, 15, 30, 60, 300, 900, 1800, 3600]
+        )
+        self.pool_occupancy = Histogram(
+            "bot_thread_pool_occupancy", "Busy download threads, sampled when a download starts.",
+            [1, 2, 4, 8, 16, 32, 64, 128]
+        )
+        self.retry_after = Counter("bot_retry_after_total", "RetryAfter (flood control) responses from Telegram.")
+        self.rate_limited = Counter("bot_rate_limited_total", "Requests that queued for or were refused by a site's rate limit.")
+        self.negative_cache_hits = Counter("bot_negative_cache_hits_total", "Extractions answered from the cache of recent failures.")
+        self.gauges = []  # (name, help, fn returning a number or {label key: value})
+        self.recent_rates = {}  # stage -> bytes/s, moving average of recent jobs
+        self.server = None
+
+    def gauge(self, name, help_text, fn):
+        self.gauges.append((name, help_text, fn))
+
+    def record_rate(self, stage, nbytes, seconds):
+        """Records the throughput of one finished stage or job."""
+        if not nbytes or seconds <= 0:
+            return
+        rate = nbytes / seconds
+        self.throughput.observe(rate, stage=stage)
+        previous = self.recent_rates.get(stage)
+        self.recent_rates[stage] = rate if previous is None else 0.7 * previous + 0.3 * rate
+
+    def recent_rate(self, stage):
+        """Recent throughput of a stage in bytes/s, None until one was measured."""
+        return self.recent_rates.get(stage)
+
+    def new_trace_id(self):
+        return uuid.uuid4().hex[:16]
+
+    @contextmanager
+    def span(self, stage, log_ctx=None):
+        """
+        Times the block as one stage of a job and logs it with the job's trace id.
+        Set `span.nbytes` inside the block to also record the throughput.
+        """
+        span = Span(stage)
+        outcome = "error"
+        try:
+            yield span
+            outcome = "ok"
+        except (asyncio.CancelledError, JobCancelled):
+            outcome = "cancelled"
+            raise
+        finally:
+            elapsed = time.monotonic() - span.started
+            self.stage_seconds.observe(elapsed, stage=stage, outcome=outcome)
+            if outcome == "ok":
+                self.record_rate(stage, span.nbytes, elapsed)
+            logger.info(
+                f"Stage {stage} {outcome} after {elapsed:.2f}s",
+                extra={**(log_ctx or {}), 'span': stage, 'duration': round(elapsed, 3), 'outcome': outcome, 'bytes': span.nbytes}
+            )
+
+    def render(self):
+        lines = []
+        for metric in (self.stage_seconds, self.throughput, self.queue_wait, self.pool_occupancy, self.retry_after,
+                       self.rate_limited, self.negative_cache_hits):
+            lines.extend(metric.render())
+        for name, help_text, fn in self.gauges:
+            try:
+                value = fn()
+            except Exception as e:
+                logger.warning(f"Gauge {name} failed: {e}")
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            if isinstance(value, dict):
+                for key, v in value.items():
+                    lines.append(f"{name}{_render_labels(key)} {v}")
+            else:
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def start_server(self, host, port):
+        """Serves GET /metrics on host:port."""
+        self.server = await asyncio.start_server(self._serve, host, port)
+        logger.info(f"Metrics endpoint listening on http://{host}:{port}/metrics")
+
+    async def stop_server(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _serve(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+            # Drain the headers, the request has no body
+            while (await asyncio.wait_for(reader.readline(), timeout=10)).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except Exception:
+            pass
+        finally:
+            writer.close()
+
+metrics = Metrics()
@@ -0,0 +1,99 @@
+import time
+import asyncio
+import threading
+from urllib.parse import urlparse
+from .config import SITE_RATE_LIMIT, SITE_RATE_LIMITS
+from .metrics import metrics
+from .logger import logger
+
+# Short-link hosts named after the site they belong to
+SITE_ALIASES = {'youtu': 'youtube', 'dai': 'dailymotion', 'x': 'twitter', 'fb': 'facebook', 'redd': 'reddit'}
+# Second-level labels of country domains such as example.co.uk
+GENERIC_LABELS = {'co', 'com', 'net', 'org', 'ac', 'gov', 'edu'}
+
+def site_of(url):
+    """
+    Names the site of a page URL like its extractor ("www.youtube.com" -> "youtube").
+    The extractor itself is only known after extraction, which is what is being limited.
+    """
+    labels = (urlparse(url).hostname or '').split('.')
+    if len(labels) < 2:
+        return labels[0] or 'generic'
+    name = labels[-2]
+    if name in GENERIC_LABELS and len(labels) >= 3:
+        name = labels[-3]
+    return SITE_ALIASES.get(name, name)
+
+class SiteBusy(Exception):
+    """Raised when a request would wait longer than allowed for its site's rate limit."""
+    pass
+
+class TokenBucket:
+    """
+    Token bucket that hands out reservations: tokens may go negative, and each caller
+    waits until its own token is due, so concurrent requests queue in arrival order.
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = max(rate, 0.001)
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    def reserve(self, now):
+        """Takes a token and returns the seconds until it may be used."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self):
+        self.tokens += 1
+
+class SiteRateLimiter:
+    """
+    Per-site rate limits shared by extraction and downloads. Callers on the event loop use
+    wait_async; `wait` sleeps in the calling thread and is meant for threads of their own.
+    """
+    def __init__(self, default=SITE_RATE_LIMIT, limits=SITE_RATE_LIMITS):
+        self.default = default
+        self.limits = limits
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def _reserve(self, site, max_wait):
+        with self.lock:
+            bucket = self.buckets.get(site)
+            if bucket is None:
+                bucket = self.buckets[site] = TokenBucket(*self.limits.get(site, self.default))
+            delay = bucket.reserve(time.monotonic())
+            if max_wait is not None and delay > max_wait:
+                bucket.refund()
+                metrics.rate_limited.inc(site=site, outcome="refused")
+                raise SiteBusy(f"Too many requests to {site} right now, please try again in a minute.")
+            if delay > 0:
+                metrics.rate_limited.inc(site=site, outcome="queued")
+        if delay > 0:
+            logger.info(f"Rate limit for {site}: waiting {delay:.1f}s", extra={'site': site, 'sample': 'rate_limit'})
+        return delay
+
+    def wait(self, url, max_wait=None):
+        """Blocks until the URL's site allows another request. For worker threads."""
+        delay = self._reserve(site_of(url), max_wait)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_async(self, url, max_wait=None):
+        delay = self._reserve(site_of(url), max_wait)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def penalize(self, url):
+        """Empties the site's bucket after it reported throttling, so the next requests back off."""
+        with self.lock:
+            bucket = self.buckets.get(site_of(url))
+            if bucket is not None:
+                bucket.tokens = min(bucket.tokens, 0.0) - bucket.capacity
+
+site_limiter = SiteRateLimiter()
@@ -0,0 +1,551 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+from .config import (
+    MAX_CONCURRENT_DOWNLOADS, JOB_DB, MAX_QUEUED_JOBS_PER_USER, DEFAULT_JOB_SIZE_MB,
+    USER_WEIGHTS, SJF_AGING_SECONDS, QUEUE_STATUS_INTERVAL,
+    BOT_ROLE, WORKER_ID, WORKER_SLOTS, JOB_LEASE_SECONDS, JOB_POLL_INTERVAL
+)
+from .store import SQLiteStore
+from .status import StatusMessage, cancel_markup
+from .cancel import CancelToken, JobInterrupted
+from .admission import disk_budget
+from .journal import journal
+from .metrics import metrics
+from .dispatch import supervisor
+from .cache import make_video_key
+from .splitter import splitter
+from .utils import human_readable_size, human_readable_duration
+from .logger import logger
+
+class QueueFullError(Exception):
+    """Raised when a user already has the maximum number of queued jobs."""
+    pass
+
+class Job:
+    """A download request waiting for or holding a processing slot."""
+    __slots__ = (
+        'id', 'user_id', 'username', 'chat_id', 'message_id', 'url', 'format_id',
+        'info', 'est_size', 'created_at', 'started_at', 'last_status', 'disk_key', 'cancel_token', 'trace_id'
+    )
+
+    def __init__(self, user_id, username, chat_id, message_id, url, format_id, info, est_size=None, job_id=None, created_at=None, trace_id=None):
+        self.id = job_id
+        self.user_id = user_id
+        self.username = username
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.url = url
+        self.format_id = format_id
+        self.info = info
+        self.est_size = est_size
+        self.created_at = created_at or time.time()
+        self.started_at = None
+        self.last_status = None
+        self.disk_key = None
+        self.cancel_token = CancelToken()
+        # Carried in log extras; restored jobs start a new trace
+        self.trace_id = trace_id or metrics.new_trace_id()
+
+class JobStore(SQLiteStore):
+    """
+    Persists queued and running jobs so a restart does not lose them.
+    In frontend/worker mode it is also the queue shared by every process: workers claim
+    jobs atomically and keep a lease on them with heartbeats.
+    """
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " user_id INTEGER NOT NULL,"
+        " username TEXT,"
+        " chat_id INTEGER NOT NULL,"
+        " message_id INTEGER NOT NULL,"
+        " url TEXT NOT NULL,"
+        " format_id TEXT NOT NULL,"
+        " info TEXT NOT NULL,"
+        " est_size INTEGER,"
+        " state TEXT NOT NULL,"
+        " created_at REAL NOT NULL,"
+        " updated_at REAL NOT NULL)",
+    ]
+    # Added for the shared queue; ALTERed into databases created before
+    COLUMNS = {
+        'worker': "TEXT",
+        'heartbeat': "REAL",
+        'cancel_requested': "INTEGER NOT NULL DEFAULT 0",
+    }
+
+    def _connect(self):
+        if self.conn is None:
+            conn = super()._connect()
+            existing = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for name, definition in self.COLUMNS.items():
+                if name not in existing:
+                    try:
+                        conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {definition}")
+                    except sqlite3.OperationalError:
+                        # Another process added it first
+                        pass
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, user_id)")
+            conn.commit()
+        return self.conn
+
+    def add(self, job):
+        cursor = self.execute(
+            "INSERT INTO jobs (user_id, username, chat_id, message_id, url, format_id, info, est_size, state, created_at, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'queued', ?, ?)",
+            (job.user_id, job.username, job.chat_id, job.message_id, job.url, job.format_id,
+             json.dumps(job.info), job.est_size, job.created_at, time.time())
+        )
+        return cursor.lastrowid
+
+    def set_state(self, job_id, state):
+        self.execute("UPDATE jobs SET state = ?, updated_at = ? WHERE id = ?", (state, time.time(), job_id))
+
+    def remove(self, job_id):
+        self.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def load_pending(self):
+        """Jobs that were queued or running when the bot stopped, oldest first."""
+        return self._load("state IN ('queued', 'running')")
+
+    def _load(self, where, params=()):
+        rows = self.query(
+            "SELECT id, user_id, username, chat_id, message_id, url, format_id, info, est_size, created_at"
+            f" FROM jobs WHERE {where} ORDER BY id", params
+        )
+        return [
+            Job(row[1], row[2], row[3], row[4], row[5], row[6], json.loads(row[7]), row[8], job_id=row[0], created_at=row[9])
+            for row in rows
+        ]
+
+    # Shared queue (frontend/worker mode)
+
+    def queued_ids(self):
+        return {row[0] for row in self.query("SELECT id FROM jobs WHERE state = 'queued'")}
+
+    def load_jobs(self, job_ids):
+        if not job_ids:
+            return []
+        return self._load(f"id IN ({','.join('?' * len(job_ids))})", tuple(job_ids))
+
+    def count_user_jobs(self, user_id):
+        return self.query("SELECT COUNT(*) FROM jobs WHERE user_id = ? AND state IN ('queued', 'running')", (user_id,))[0][0]
+
+    def claim(self, job_id, worker, limit):
+        """
+        Atomically moves a queued job to running for `worker`, unless its user already has a
+        running job or `limit` jobs are running across all workers. Returns True if claimed.
+        """
+        now = time.time()
+        cursor = self.execute(
+            "UPDATE jobs SET state = 'running', worker = ?, heartbeat = ?, updated_at = ?"
+            " WHERE id = ? AND state = 'queued'"
+            " AND NOT EXISTS (SELECT 1 FROM jobs AS other WHERE other.state = 'running' AND other.user_id = jobs.user_id)"
+            " AND (SELECT COUNT(*) FROM jobs WHERE state = 'running') < ?",
+            (worker, now, now, job_id, limit)
+        )
+        return cursor.rowcount == 1
+
+    def heartbeat(self, worker, job_ids):
+        """
+        Renews the worker's lease on its running jobs.
+        Returns (ids whose cancellation was requested, ids the worker no longer holds).
+        """
+        if not job_ids:
+            return set(), set()
+        marks = ','.join('?' * len(job_ids))
+        with self.lock:
+            conn = self._connect()
+            conn.execute(
+                f"UPDATE jobs SET heartbeat = ? WHERE worker = ? AND state = 'running' AND id IN ({marks})",
+                (time.time(), worker, *job_ids)
+            )
+            conn.commit()
+            rows = conn.execute(
+                f"SELECT id, cancel_requested FROM jobs WHERE worker = ? AND state = 'running' AND id IN ({marks})",
+                (worker, *job_ids)
+            ).fetchall()
+        held = {row[0] for row in rows}
+        return {row[0] for row in rows if row[1]}, set(job_ids) - held
+
+    def requeue_expired(self, lease):
+        """
+        Puts running jobs of workers that stopped sending heartbeats back in the queue,
+        or drops them if their user asked to cancel. Returns the number requeued.
+        """
+        now = time.time()
+        with self.lock:
+            conn = self._connect()
+            conn.execute(
+                "DELETE FROM jobs WHERE state = 'running' AND heartbeat < ? AND cancel_requested = 1", (now - lease,)
+            )
+            cursor = conn.execute(
+                "UPDATE jobs SET state = 'queued', worker = NULL, updated_at = ? WHERE state = 'running' AND heartbeat < ?",
+                (now, now - lease)
+            )
+            conn.commit()
+            return cursor.rowcount
+
+    def release_worker(self, worker):
+        """Puts a stopping worker's running jobs back in the queue for the other workers."""
+        self.execute(
+            "UPDATE jobs SET state = 'queued', worker = NULL, updated_at = ? WHERE worker = ? AND state = 'running'",
+            (time.time(), worker)
+        )
+
+    def request_cancel(self, job_id, user_id):
+        """Drops a queued job or flags a running one for its worker. Returns 'queued', 'running' or None."""
+        if self.execute("DELETE FROM jobs WHERE id = ? AND user_id = ? AND state = 'queued'", (job_id, user_id)).rowcount:
+            return 'queued'
+        if self.execute(
+            "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND user_id = ? AND state = 'running'", (job_id, user_id)
+        ).rowcount:
+            return 'running'
+        return None
+
+class JobScheduler:
+    """
+    Fair job scheduler in front of the download pipeline.
+
+    Users are served by weighted fair queuing: each dispatch advances the user's virtual
+    finish time by (estimated size / weight), so heavy users cannot monopolize the slots and
+    small jobs naturally go first. Within one user's queue the shortest job goes first,
+    with waiting time aging large jobs forward so they are never starved.
+    Each user runs at most one job at a time.
+
+    Outside standalone mode the queue lives in the shared store: the frontend only adds,
+    cancels and reports on queued jobs, and each worker mirrors the queue, picks jobs the
+    same way and claims them atomically, which enforces per-user exclusivity and the
+    global MAX_CONCURRENT_DOWNLOADS across processes.
+    """
+    def __init__(self, store, slots=None, role=BOT_ROLE):
+        self.store = store
+        self.role = role
+        self.shared = role != 'standalone'
+        self.slots = slots or (WORKER_SLOTS if role == 'worker' else MAX_CONCURRENT_DOWNLOADS)
+        # Identifies this process in job leases; WORKER_ID alone may be reused after a restart
+        self.instance = f"{WORKER_ID}:{os.getpid()}"
+        self.claimed = set()  # ids of running jobs this worker holds a lease on
+        self.lost = set()     # ids of jobs whose lease expired and went to another worker
+        self.poll_task = None
+        self.queues = {}    # user_id -> [Job]
+        self.running = {}   # job id -> Job
+        self.user_finish = {}
+        self.virtual_time = 0.0
+        self.rate = None    # bytes/s of one slot, moving average over finished jobs
+        self.runner = None
+        self.bot = None
+        self.tasks = set()
+        self.status_task = None
+        self.waiting_for_disk = False
+        self.stopping = False
+
+    def set_runner(self, runner):
+        """runner(bot, job) runs the pipeline and returns the number of bytes processed."""
+        self.runner = runner
+
+    async def start(self, bot):
+        """Restores jobs left over from the previous run and starts dispatching."""
+        self.bot = bot
+        if self.shared:
+            await self._refresh_queue()
+            logger.info(f"Running as {self.role} {self.instance}, {sum(len(q) for q in self.queues.values())} jobs queued")
+        else:
+            known = {job.id for queue in self.queues.values() for job in queue}
+            for job in await asyncio.to_thread(self.store.load_pending):
+                if job.id in known:
+                    continue
+                await asyncio.to_thread(self.store.set_state, job.id, 'queued')
+                self.queues.setdefault(job.user_id, []).append(job)
+            restored = sum(len(q) for q in self.queues.values())
+            if restored:
+                logger.info(f"Restored {restored} queued jobs")
+        if self.role != 'frontend':
+            logger.info(f"Disk budget: {disk_budget.describe()}")
+
+        if self.role == 'worker':
+            self.poll_task = asyncio.create_task(self._poll_loop())
+        else:
+            # Workers have no updates to answer; queue positions are reported by whoever receives them
+            self.status_task = asyncio.create_task(self._status_loop())
+        self._dispatch()
+
+    async def stop(self):
+        """Interrupts running jobs but leaves them in the store, so they resume after a restart."""
+        self.stopping = True
+        for task in (self.status_task, self.poll_task):
+            if task:
+                task.cancel()
+        tasks = set(self.tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+        if self.role == 'worker':
+            # Other workers can pick them up right away instead of waiting for the lease to expire
+            try:
+                await asyncio.to_thread(self.store.release_worker, self.instance)
+            except Exception as e:
+                logger.warning(f"Could not release running jobs: {e}")
+
+    def user_job_count(self, user_id):
+        queued = len(self.queues.get(user_id, []))
+        return queued + sum(1 for job in self.running.values() if job.user_id == user_id)
+
+    async def submit(self, job):
+        """Stores and queues a job. Returns its queue position (0 means it started right away)."""
+        if self.shared:
+            count = await asyncio.to_thread(self.store.count_user_jobs, job.user_id)
+        else:
+            count = self.user_job_count(job.user_id)
+        if count >= MAX_QUEUED_JOBS_PER_USER:
+            raise QueueFullError(f"You already have {MAX_QUEUED_JOBS_PER_USER} jobs queued. Please wait until one finishes.")
+
+        job.id = await asyncio.to_thread(self.store.add, job)
+        self.queues.setdefault(job.user_id, []).append(job)
+        self._dispatch()
+        return self.position(job.id)
+
+    async def cancel(self, job_id, user_id):
+        """
+        Cancels a job of the user. A queued job is dropped; a running one has its token
+        cancelled and stops on its own. Returns 'queued', 'running' or None if not found.
+        """
+        if self.shared:
+            # The job may run in another process: its worker sees the flag on the next heartbeat
+            result = await asyncio.to_thread(self.store.request_cancel, job_id, user_id)
+            if result == 'queued':
+                self._forget_queued(job_id)
+                await asyncio.to_thread(journal.forget_job, job_id)
+            return result
+
+        queue = self.queues.get(user_id, [])
+        for job in queue:
+            if job.id == job_id:
+                queue.remove(job)
+                if not queue:
+                    del self.queues[user_id]
+                await asyncio.to_thread(self.store.remove, job_id)
+                await asyncio.to_thread(journal.forget_job, job_id)
+                return 'queued'
+
+        job = self.running.get(job_id)
+        if job is not None and job.user_id == user_id:
+            job.cancel_token.cancel()
+            return 'running'
+        return None
+
+    def _cost(self, job):
+        size = job.est_size or DEFAULT_JOB_SIZE_MB * 1024 * 1024
+        return size / USER_WEIGHTS.get(job.user_id, 1.0)
+
+    def _head(self, queue, now):
+        # Shortest job first, with waiting time shrinking the effective size
+        return min(queue, key=lambda j: (j.est_size or DEFAULT_JOB_SIZE_MB * 1024 * 1024) / (1 + (now - j.created_at) / SJF_AGING_SECONDS))
+
+    def _select(self, queues, user_finish, virtual_time, busy_users, now):
+        """Picks the job with the smallest virtual finish tag among users that may start one."""
+        best = None
+        for user_id, queue in queues.items():
+            if not queue or user_id in busy_users:
+                continue
+            job = self._head(queue, now)
+            start_tag = max(virtual_time, user_finish.get(user_id, 0.0))
+            finish_tag = start_tag + self._cost(job)
+            if best is None or (finish_tag, job.created_at) < (best[0], best[2].created_at):
+                best = (finish_tag, start_tag, job)
+        return best
+
+    def _dispatch(self):
+        now = time.time()
+        while len(self.running) < self.slots and self.runner and self.bot and not self.stopping and self.role != 'frontend':
+            busy_users = {job.user_id for job in self.running.values()}
+            best = self._select(self.queues, self.user_finish, self.virtual_time, busy_users, now)
+            if best is None:
+                return
+            finish_tag, start_tag, job = best
+
+            # Admission control: the job's download must fit in the disk budget
+            disk_key = (make_video_key(job.info, job.url), job.format_id)
+            needed = (job.est_size or DEFAULT_JOB_SIZE_MB * 1024 * 1024) * (1 if splitter.virtual else 2)
+            if not disk_budget.try_reserve(disk_key, needed):
+                if not self.waiting_for_disk:
+                    logger.info(f"Job {job.id} waits for disk space ({disk_budget.describe()})")
+                self.waiting_for_disk = True
+                return
+            self.waiting_for_disk = False
+            job.disk_key = disk_key
+
+            self.queues[job.user_id].remove(job)
+            if not self.queues[job.user_id]:
+                del self.queues[job.user_id]
+            self.user_finish[job.user_id] = finish_tag
+            self.virtual_time = max(self.virtual_time, start_tag)
+            self.running[job.id] = job
+            job.started_at = now
+            task = supervisor.spawn(self._run(job), name=f"job-{job.id}")
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, job):
+        if self.shared:
+            try:
+                claimed = await asyncio.to_thread(self.store.claim, job.id, self.instance, MAX_CONCURRENT_DOWNLOADS)
+            except Exception as e:
+                logger.warning(f"Could not claim job {job.id}: {e}")
+                claimed = False
+            if not claimed:
+                # Taken or cancelled meanwhile, its user is busy elsewhere or the global limit is
+                # reached; the next poll brings it back if it is still queued
+                self.running.pop(job.id, None)
+                disk_budget.release(job.disk_key)
+                return
+            self.claimed.add(job.id)
+
+        processed = 0
+        interrupted = False
+        try:
+            if not self.shared:
+                await asyncio.to_thread(self.store.set_state, job.id, 'running')
+            wait = job.started_at - job.created_at
+            metrics.queue_wait.observe(wait)
+            logger.info(f"Job {job.id} started after {wait:.1f}s in queue", extra={'user_id': job.user_id, 'job_id': job.id, 'trace_id': job.trace_id})
+            processed = await self.runner(self.bot, job) or 0
+        except JobInterrupted:
+            logger.info(f"Job {job.id} interrupted by shutdown, it resumes on the next start", extra={'user_id': job.user_id, 'job_id': job.id})
+            interrupted = True
+        except Exception as e:
+            logger.error(f"Job {job.id} crashed: {e}", extra={'user_id': job.user_id, 'job_id': job.id})
+        finally:
+            self.running.pop(job.id, None)
+            self.claimed.discard(job.id)
+            disk_budget.release(job.disk_key)
+            duration = time.time() - job.started_at
+            if processed and duration > 0:
+                rate = processed / duration
+                self.rate = rate if self.rate is None else 0.7 * self.rate + 0.3 * rate
+            if self.stopping or interrupted or job.id in self.lost:
+                # Interrupted by the shutdown, the job is restored on the next start,
+                # or another worker owns it now
+                self.lost.discard(job.id)
+                return
+            try:
+                await asyncio.to_thread(self.store.remove, job.id)
+                await asyncio.to_thread(journal.forget_job, job.id)
+            except Exception as e:
+                logger.warning(f"Could not remove job {job.id} from store: {e}")
+            self._dispatch()
+
+    def _forget_queued(self, job_id):
+        for user_id, queue in list(self.queues.items()):
+            self.queues[user_id] = [job for job in queue if job.id != job_id]
+            if not self.queues[user_id]:
+                del self.queues[user_id]
+
+    async def _refresh_queue(self):
+        """Mirrors the shared queue: adds jobs queued by other processes, drops ones taken or cancelled."""
+        ids = await asyncio.to_thread(self.store.queued_ids)
+        known = set()
+        for user_id, queue in list(self.queues.items()):
+            kept = [job for job in queue if job.id in ids]
+            known.update(job.id for job in kept)
+            if kept:
+                self.queues[user_id] = kept
+            else:
+                del self.queues[user_id]
+        new = ids - known - set(self.running)
+        for job in await asyncio.to_thread(self.store.load_jobs, sorted(new)):
+            self.queues.setdefault(job.user_id, []).append(job)
+
+    async def _poll_loop(self):
+        """Worker side of the shared queue: renews leases, applies cancellations and claims new jobs."""
+        while True:
+            try:
+                requeued = await asyncio.to_thread(self.store.requeue_expired, JOB_LEASE_SECONDS)
+                if requeued:
+                    logger.warning(f"Requeued {requeued} jobs of workers that stopped responding")
+                cancelled, lost = await asyncio.to_thread(self.store.heartbeat, self.instance, list(self.claimed))
+                for job_id in lost - self.lost:
+                    job = self.running.get(job_id)
+                    if job is not None:
+                        logger.warning(f"Lease on job {job_id} expired, another worker may run it; stopping", extra={'job_id': job_id})
+                        self.lost.add(job_id)
+                        job.cancel_token.cancel()
+                for job_id in cancelled:
+                    job = self.running.get(job_id)
+                    if job is not None:
+                        job.cancel_token.cancel()
+                await self._refresh_queue()
+                self._dispatch()
+            except Exception as e:
+                logger.warning(f"Job queue poll failed: {e}")
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+
+    def _order(self):
+        """Simulates the dispatch order of all queued jobs (ignoring per-user exclusivity)."""
+        queues = {user_id: list(queue) for user_id, queue in self.queues.items()}
+        user_finish = dict(self.user_finish)
+        virtual_time = self.virtual_time
+        now = time.time()
+        order = []
+        while True:
+            best = self._select(queues, user_finish, virtual_time, set(), now)
+            if best is None:
+                return order
+            finish_tag, start_tag, job = best
+            queues[job.user_id].remove(job)
+            user_finish[job.user_id] = finish_tag
+            virtual_time = max(virtual_time, start_tag)
+            order.append(job)
+
+    def position(self, job_id):
+        """1-based queue position, or 0 if the job is running or unknown."""
+        for index, job in enumerate(self._order()):
+            if job.id == job_id:
+                return index + 1
+        return 0
+
+    def _eta(self, ahead_bytes):
+        if not self.rate:
+            return None
+        return ahead_bytes / (self.rate * self.slots)
+
+    async def _status_loop(self):
+        """Keeps the status message of every queued job showing its position and ETA."""
+        while True:
+            await asyncio.sleep(QUEUE_STATUS_INTERVAL)
+            try:
+                if self.shared:
+                    await self._refresh_queue()
+                # Space may have been freed outside the bot
+                self._dispatch()
+                order = self._order()
+                # Running jobs are assumed half done on average
+                ahead = sum((j.est_size or DEFAULT_JOB_SIZE_MB * 1024 * 1024) for j in self.running.values()) / 2
+                for index, job in enumerate(order):
+                    eta = self._eta(ahead)
+                    text = f"Queued for download: position {index + 1} of {len(order)}"
+                    if index == 0 and self.waiting_for_disk:
+                        text += " (waiting for disk space)"
+                    if eta is not None:
+                        text += f", starts in ~{human_readable_duration(eta)}"
+                    if job.est_size:
+                        text += f"\nEstimated size: {human_readable_size(job.est_size)}"
+                    ahead += job.est_size or DEFAULT_JOB_SIZE_MB * 1024 * 1024
+
+                    if job not in self.queues.get(job.user_id, ()):
+                        # Dispatched while earlier messages were being edited
+                        continue
+                    if text != job.last_status and self.bot:
+                        job.last_status = text
+                        StatusMessage(self.bot, job.chat_id, job.message_id, cancel_markup(job.id)).update(text)
+            except Exception as e:
+                logger.warning(f"Queue status update failed: {e}")
+
+scheduler = JobScheduler(JobStore(JOB_DB))
+metrics.gauge("bot_jobs_queued", "Jobs waiting for a processing slot.", lambda: sum(len(q) for q in scheduler.queues.values()))
+metrics.gauge("bot_jobs_running", "Jobs holding a processing slot.", lambda: len(scheduler.running))
+metrics.gauge("bot_job_slots", "Processing slots.", lambda: scheduler.slots)
@@ -1,49 +1,101 @@
+import time
 import asyncio
+import itertools
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from typing import Dict
-from .config import MAX_CONCURRENT_DOWNLOADS
-
-class SessionManager:
-    _instance = None
-
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super(SessionManager, cls).__new__(cls)
-            cls._instance.semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
-            cls._instance.user_locks: Dict[int, asyncio.Lock] = {}
-        return cls._instance
-
-    async def acquire_global(self):
-        """Acquire a global slot for download/processing."""
-        await self.semaphore.acquire()
-
-    def release_global(self):
-        """Release a global slot."""
-        self.semaphore.release()
-
-    def get_user_lock(self, user_id: int) -> asyncio.Lock:
-        """Get or create a lock for a specific user to prevent concurrent requests."""
-        if user_id not in self.user_locks:
-            self.user_locks[user_id] = asyncio.Lock()
-        return self.user_locks[user_id]
-
-    async def run_with_global_limit(self, func, *args, **kwargs):
-        """Run a function ensuring global concurrency limit."""
-        async with self.semaphore:
-            return await func(*args, **kwargs)
-
-    async def run_exclusive_user(self, user_id: int, func, *args, **kwargs):
-        """Run a function ensuring the user processes only one request at a time."""
-        lock = self.get_user_lock(user_id)
-        # Using wait_for to prevent infinite waiting if something goes wrong?
-        # For now, just acquire.
-        if lock.locked():
-             # Option: return False or raise exception if user is busy
-             # Prompt says "queue it or notify them to wait".
-             # With lock, it queues automatically (waits).
-             pass
-
-        async with lock:
-            return await func(*args, **kwargs)
-
-# Global instance
-session_manager = SessionManager()
+from .config import REQUEST_TTL, MAX_PENDING_REQUESTS
+
+class KeyedLocks:
+    """
+    One asyncio.Lock per key, existing only while someone holds or waits for it,
+    so keys that go idle cost nothing. Waiters get the lock in arrival order.
+    """
+    def __init__(self):
+        self.locks: Dict[object, asyncio.Lock] = {}
+        self.users: Dict[object, int] = {}
+
+    def get(self, key) -> asyncio.Lock:
+        if key not in self.locks:
+            self.locks[key] = asyncio.Lock()
+        return self.locks[key]
+
+    def is_locked(self, key) -> bool:
+        lock = self.locks.get(key)
+        return lock is not None and lock.locked()
+
+    @asynccontextmanager
+    async def hold(self, key):
+        lock = self.get(key)
+        self.users[key] = self.users.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            remaining = self.users[key] - 1
+            if remaining:
+                self.users[key] = remaining
+            else:
+                del self.users[key]
+                del self.locks[key]
+
+class PendingRequest:
+    """An analyzed URL waiting for the user to pick a format."""
+    __slots__ = ('user_id', 'url', 'info', 'trace_id', 'expires_at')
+
+    def __init__(self, user_id, url, info, trace_id, expires_at):
+        self.user_id = user_id
+        self.url = url
+        self.info = info
+        self.trace_id = trace_id
+        self.expires_at = expires_at
+
+class RequestStore:
+    """
+    Bounded store of pending requests shared by all users, with TTL and LRU eviction.
+    Requests are addressed by short numeric tokens that fit in callback data next to
+    a format index, so format ids never need to be parsed out of it.
+    """
+    def __init__(self, max_entries=MAX_PENDING_REQUESTS, ttl=REQUEST_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # token -> PendingRequest, least recently added first
+        # Start from the clock so buttons left over from before a restart do not match new requests
+        self.tokens = itertools.count(int(time.time()) % 100000 * 1000)
+
+    def add(self, user_id, url, info, trace_id=None):
+        """Stores a request and returns its token."""
+        self._expire()
+        token = next(self.tokens)
+        self.entries[token] = PendingRequest(user_id, url, info, trace_id, time.monotonic() + self.ttl)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return token
+
+    def pop(self, token, user_id):
+        """Takes the user's request out of the store; None if it expired, was evicted or is not theirs."""
+        request = self.entries.get(token)
+        if request is None or request.user_id != user_id:
+            return None
+        del self.entries[token]
+        if request.expires_at < time.monotonic():
+            return None
+        return request
+
+    def restore(self, token, request):
+        """Puts back a popped request that could not be queued, so its buttons work again."""
+        if request.expires_at >= time.monotonic():
+            self.entries[token] = request
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _expire(self):
+        # Entries expire in insertion order, so only the oldest need checking
+        now = time.monotonic()
+        while self.entries:
+            token, request = next(iter(self.entries.items()))
+            if request.expires_at >= now:
+                break
+            del self.entries[token]
+
+request_store = RequestStore()
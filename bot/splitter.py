@@ -1,18 +1,90 @@
 import os
+import asyncio
 import aiofiles
 from .utils import get_chunk_suffix
-from .config import MAX_CHUNK_SIZE_MB
+from .config import MAX_CHUNK_SIZE_MB, PIPELINE_POLL_INTERVAL, VIRTUAL_CHUNKS
 from .logger import logger
 
+class GrowingFile:
+    """
+    A file that is still being written by the downloader thread.
+    The download hook sets `path` as soon as yt-dlp knows the target filename,
+    and keeps the byte counters current. `postprocessing` is set while yt-dlp
+    merges or converts, when no bytes are downloaded.
+    """
+    def __init__(self):
+        self.path = None
+        self.downloaded_bytes = 0
+        self.total_bytes = None
+        self.postprocessing = False
+
+class FileChunk:
+    """
+    A part to upload: `length` bytes at `offset` of `path`, sent under `name`.
+    In virtual mode `path` is the original download and no part file exists.
+    """
+    __slots__ = ('path', 'offset', 'length', 'name')
+
+    def __init__(self, path, offset, length, name):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.name = name
+
+    @classmethod
+    def whole(cls, path):
+        """A chunk covering an entire file."""
+        return cls(path, 0, os.path.getsize(path), os.path.basename(path))
+
+    def is_whole_file(self):
+        """True if the chunk covers its entire file, so the file itself can be sent."""
+        return self.offset == 0 and self.length == os.path.getsize(self.path)
+
+    def read(self):
+        """
+        Reads the byte range with positional reads (blocking, run it in a thread).
+        Several chunks of one file can be read concurrently without sharing a file offset.
+        """
+        with open(self.path, 'rb') as f:
+            if not hasattr(os, 'pread'):
+                # Windows has no pread, fall back to seek + read on a private handle
+                f.seek(self.offset)
+                data = f.read(self.length)
+            else:
+                fd = f.fileno()
+                data = os.pread(fd, self.length, self.offset)
+                if len(data) < self.length:
+                    # Short reads are allowed by pread, collect the rest
+                    parts = [data]
+                    got = len(data)
+                    while got < self.length:
+                        block = os.pread(fd, self.length - got, self.offset + got)
+                        if not block:
+                            break
+                        parts.append(block)
+                        got += len(block)
+                    data = b''.join(parts)
+
+        if len(data) != self.length:
+            raise Exception(f"Unexpected end of file while reading {self.name}")
+        return data
+
 class FileSplitter:
     def __init__(self):
         self.chunk_size = MAX_CHUNK_SIZE_MB * 1024 * 1024
         self.buffer_size = 8 * 1024 * 1024 # 8 MB buffer for reading
+        self.virtual = VIRTUAL_CHUNKS
 
-    async def split_file(self, file_path):
+    def _chunk_name(self, file_path, index):
+        name_without_ext, ext = os.path.splitext(os.path.basename(file_path))
+        return f"{name_without_ext} - {get_chunk_suffix(index)}{ext}"
+
+    async def split_file(self, file_path, cancel=None):
         """
         Splits the file into chunks of size MAX_CHUNK_SIZE_MB.
-        Returns a list of paths to the chunks.
+        Returns a list of FileChunk descriptors. In virtual mode they are byte ranges
+        over the original file; otherwise each one points at a written part file.
+        cancel: optional CancelToken checked between buffers.
         """
         try:
             file_size = os.path.getsize(file_path)
@@ -21,13 +93,18 @@ class FileSplitter:
             return []
 
         if file_size <= self.chunk_size:
-            return [file_path]
+            return [FileChunk(file_path, 0, file_size, os.path.basename(file_path))]
+
+        if self.virtual:
+            chunks = []
+            for index, offset in enumerate(range(0, file_size, self.chunk_size)):
+                length = min(self.chunk_size, file_size - offset)
+                chunks.append(FileChunk(file_path, offset, length, self._chunk_name(file_path, index)))
+            return chunks
 
         dir_name = os.path.dirname(file_path)
-        base_name = os.path.basename(file_path)
-        name_without_ext, ext = os.path.splitext(base_name)
 
-        chunk_paths = []
+        chunks = []
         chunk_index = 0
         bytes_written_to_chunk = 0
         current_chunk_file = None
@@ -35,27 +112,31 @@ class FileSplitter:
         try:
             async with aiofiles.open(file_path, 'rb') as src:
                 while True:
+                    if cancel is not None:
+                        cancel.check()
                     data = await src.read(self.buffer_size)
                     if not data:
                         break
 
                     data_len = len(data)
+                    view = memoryview(data)
                     cursor = 0
 
                     while cursor < data_len:
                         if current_chunk_file is None:
-                            suffix = get_chunk_suffix(chunk_index)
-                            chunk_name = f"{name_without_ext} - {suffix}{ext}"
+                            chunk_name = self._chunk_name(file_path, chunk_index)
                             chunk_path = os.path.join(dir_name, chunk_name)
                             current_chunk_file = await aiofiles.open(chunk_path, 'wb')
-                            chunk_paths.append(chunk_path)
+                            chunks.append(FileChunk(chunk_path, 0, 0, chunk_name))
 
                         remaining_space = self.chunk_size - bytes_written_to_chunk
                         bytes_to_write = min(data_len - cursor, remaining_space)
 
-                        await current_chunk_file.write(data[cursor:cursor+bytes_to_write])
+                        # memoryview slices avoid copying the buffer again
+                        await current_chunk_file.write(view[cursor:cursor+bytes_to_write])
 
                         bytes_written_to_chunk += bytes_to_write
+                        chunks[-1].length = bytes_written_to_chunk
                         cursor += bytes_to_write
 
                         if bytes_written_to_chunk >= self.chunk_size:
@@ -67,17 +148,106 @@ class FileSplitter:
             if current_chunk_file:
                 await current_chunk_file.close()
 
-            return chunk_paths
+            return chunks
 
         except Exception as e:
             logger.error(f"Error splitting file {file_path}: {e}")
             # Clean up partial chunks?
-            for p in chunk_paths:
-                if os.path.exists(p):
+            for c in chunks:
+                if os.path.exists(c.path):
                     try:
-                        os.remove(p)
+                        os.remove(c.path)
                     except:
                         pass
             raise e
 
+    async def split_growing(self, growing, download_task, cancel=None):
+        """
+        Cuts chunks off a file while it is being downloaded.
+        Yields each FileChunk as soon as its bytes are on disk; the last chunk is
+        cut once `download_task` (which returns the final file path) completes.
+        cancel: optional CancelToken checked on every poll.
+        """
+        chunk_index = 0
+        offset = 0
+        current_path = None
+        virtual_chunks = []
+
+        while True:
+            if cancel is not None:
+                cancel.check()
+            finished = download_task.done()
+            if finished:
+                # Re-raises the download error, if any
+                growing.path = download_task.result()
+
+            path = growing.path
+            if chunk_index and path != current_path:
+                # yt-dlp renames the .part file when it completes; anything else means the bytes changed
+                if os.path.exists(current_path) or path is None or not os.path.exists(path):
+                    raise Exception("Downloaded file was renamed after streaming started.")
+                for chunk in virtual_chunks:
+                    chunk.path = path
+            current_path = path
+
+            if path is None or not os.path.exists(path):
+                if finished:
+                    raise Exception("File not found after download.")
+                await asyncio.sleep(PIPELINE_POLL_INTERVAL)
+                continue
+
+            size = os.path.getsize(path)
+            if size < offset:
+                # The downloader restarted the file from scratch, parts already shipped are stale
+                raise Exception("Download restarted while streaming, parts already sent are invalid.")
+
+            while size - offset >= self.chunk_size or (finished and size > offset):
+                length = min(self.chunk_size, size - offset)
+                if finished and chunk_index == 0 and length == size:
+                    # Fits in one part, send the file itself
+                    yield FileChunk(path, 0, size, os.path.basename(path))
+                    return
+
+                chunk_name = self._chunk_name(self._final_name(path), chunk_index)
+                if self.virtual:
+                    chunk = FileChunk(path, offset, length, chunk_name)
+                    virtual_chunks.append(chunk)
+                else:
+                    chunk_path = os.path.join(os.path.dirname(path), chunk_name)
+                    await self._copy_range(path, offset, length, chunk_path)
+                    chunk = FileChunk(chunk_path, 0, length, chunk_name)
+                offset += length
+                chunk_index += 1
+                yield chunk
+
+            if finished:
+                return
+
+            await asyncio.sleep(PIPELINE_POLL_INTERVAL)
+
+    def _final_name(self, path):
+        # Parts are named after the finished file, not the .part file it is cut from
+        return path[:-len('.part')] if path.endswith('.part') else path
+
+    async def _copy_range(self, src_path, offset, length, dest_path):
+        """Copies `length` bytes starting at `offset` into a new file."""
+        try:
+            async with aiofiles.open(src_path, 'rb') as src, aiofiles.open(dest_path, 'wb') as dest:
+                await src.seek(offset)
+                remaining = length
+                while remaining > 0:
+                    data = await src.read(min(self.buffer_size, remaining))
+                    if not data:
+                        raise Exception(f"Unexpected end of file at offset {offset + length - remaining}")
+                    await dest.write(data)
+                    remaining -= len(data)
+        except Exception as e:
+            logger.error(f"Error copying chunk {dest_path}: {e}")
+            if os.path.exists(dest_path):
+                try:
+                    os.remove(dest_path)
+                except:
+                    pass
+            raise e
+
 splitter = FileSplitter()
@@ -0,0 +1,162 @@
+import time
+import asyncio
+from collections import OrderedDict
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter, BadRequest
+from .config import STATUS_EDIT_INTERVAL, STATUS_EDITS_PER_SECOND
+from .utils import retry_after_seconds
+from .metrics import metrics
+from .logger import logger
+
+def cancel_markup(job_id):
+    """Inline keyboard with the Cancel button shown under a job's status message."""
+    return InlineKeyboardMarkup([[InlineKeyboardButton("Cancel", callback_data=f"cancel_{job_id}")]])
+
+class StatusMessage:
+    """
+    Handle to a bot message identified by chat and message id.
+    Jobs keep this instead of a telegram Message so they can be stored and restored after a restart.
+    reply_markup is sent with every edit; set it to None to remove the buttons.
+    """
+    __slots__ = ('bot', 'chat_id', 'message_id', 'reply_markup')
+
+    def __init__(self, bot, chat_id, message_id, reply_markup=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.reply_markup = reply_markup
+
+    def update(self, text, **kwargs):
+        """Schedules an edit through the shared status editor (latest text wins)."""
+        status_editor.update(self, text, **kwargs)
+
+    async def edit_text(self, text, **kwargs):
+        kwargs.setdefault('reply_markup', self.reply_markup)
+        return await self.bot.edit_message_text(
+            text, chat_id=self.chat_id, message_id=self.message_id, **kwargs
+        )
+
+    async def reply_text(self, text, **kwargs):
+        return await self.bot.send_message(
+            self.chat_id, text, reply_to_message_id=self.message_id, **kwargs
+        )
+
+class StatusEditor:
+    """
+    Coalescing, rate-limited editor for status messages.
+
+    Only the latest pending text per message is kept. Edits go out at most once per
+    STATUS_EDIT_INTERVAL per chat and STATUS_EDITS_PER_SECOND for the whole bot, a
+    RetryAfter pauses the affected chat for the requested time, and text identical to
+    what the message already shows is never sent.
+    """
+    MAX_TRACKED = 10000
+
+    def __init__(self, chat_interval=STATUS_EDIT_INTERVAL, edits_per_second=STATUS_EDITS_PER_SECOND):
+        self.chat_interval = chat_interval
+        self.global_interval = 1.0 / edits_per_second
+        self.pending = OrderedDict()  # (chat_id, message_id) -> (status_msg, text, kwargs)
+        self.shown = OrderedDict()    # (chat_id, message_id) -> text last delivered
+        self.chat_ready_at = {}       # chat_id -> monotonic time of the next allowed edit
+        self.busy_chats = set()
+        self.next_send_at = 0.0
+        self.wakeup = None
+        self.task = None
+        self.sending = set()
+
+    def update(self, status_msg, text, **kwargs):
+        """Records the latest text for a message. Must be called on the event loop thread."""
+        key = (status_msg.chat_id, status_msg.message_id)
+        if key not in self.pending and self.shown.get(key) == text and not kwargs:
+            return
+        # Replacing in place keeps the message's position in the queue
+        self.pending[key] = (status_msg, text, kwargs)
+
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.get_running_loop().create_task(self._run())
+        self.wakeup.set()
+
+    def forget(self, status_msg):
+        """Drops tracking state of a message that will not be edited again."""
+        self.shown.pop((status_msg.chat_id, status_msg.message_id), None)
+
+    def _next_ready(self, now):
+        """Returns the first pending key whose chat may be edited now, and the earliest wait otherwise."""
+        wait = None
+        for key in self.pending:
+            chat_id = key[0]
+            if chat_id in self.busy_chats:
+                continue
+            ready_at = self.chat_ready_at.get(chat_id, 0.0)
+            if ready_at <= now:
+                return key, 0
+            wait = ready_at - now if wait is None else min(wait, ready_at - now)
+        return None, wait
+
+    async def _run(self):
+        while True:
+            if not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            if now < self.next_send_at:
+                await asyncio.sleep(self.next_send_at - now)
+                continue
+
+            key, wait = self._next_ready(now)
+            if key is None:
+                self.wakeup.clear()
+                try:
+                    # Sleep until a chat becomes ready or a new update arrives
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            status_msg, text, kwargs = self.pending.pop(key)
+            if self.shown.get(key) == text and not kwargs:
+                continue
+
+            self.next_send_at = now + self.global_interval
+            self.busy_chats.add(key[0])
+            task = asyncio.create_task(self._send(key, status_msg, text, kwargs))
+            self.sending.add(task)
+            task.add_done_callback(self.sending.discard)
+
+    async def _send(self, key, status_msg, text, kwargs):
+        chat_id = key[0]
+        delay = self.chat_interval
+        try:
+            await status_msg.edit_text(text, **kwargs)
+            self._remember(key, text)
+        except RetryAfter as e:
+            delay = max(delay, retry_after_seconds(e))
+            metrics.retry_after.inc(kind="status_edit")
+            logger.warning(f"Flood control on chat {chat_id}, pausing status edits for {delay:.0f}s", extra={'sample': 'status_flood'})
+            # Retry unless a newer text arrived meanwhile
+            if key not in self.pending:
+                self.pending[key] = (status_msg, text, kwargs)
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                self._remember(key, text)
+        except Exception:
+            pass
+        finally:
+            self.chat_ready_at[chat_id] = time.monotonic() + delay
+            self.busy_chats.discard(chat_id)
+            if len(self.chat_ready_at) > self.MAX_TRACKED:
+                now = time.monotonic()
+                self.chat_ready_at = {c: t for c, t in self.chat_ready_at.items() if t > now}
+            if self.wakeup:
+                self.wakeup.set()
+
+    def _remember(self, key, text):
+        self.shown[key] = text
+        self.shown.move_to_end(key)
+        while len(self.shown) > self.MAX_TRACKED:
+            self.shown.popitem(last=False)
+
+status_editor = StatusEditor()
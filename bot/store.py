@@ -0,0 +1,41 @@
+import os
+import sqlite3
+import threading
+
+class SQLiteStore:
+    """
+    Base class for the bot's small local SQLite stores.
+    Subclasses set SCHEMA (a list of statements run on first use).
+    Methods are blocking; call them via asyncio.to_thread from async code.
+    """
+    SCHEMA = []
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def _connect(self):
+        if self.conn is None:
+            db_dir = os.path.dirname(self.db_path)
+            if db_dir and not os.path.exists(db_dir):
+                os.makedirs(db_dir)
+            self.conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            for statement in self.SCHEMA:
+                self.conn.execute(statement)
+            self.conn.commit()
+        return self.conn
+
+    def execute(self, sql, params=()):
+        """Runs one write statement and commits. Returns the cursor."""
+        with self.lock:
+            conn = self._connect()
+            cursor = conn.execute(sql, params)
+            conn.commit()
+            return cursor
+
+    def query(self, sql, params=()):
+        """Runs a read statement and returns all rows."""
+        with self.lock:
+            return self._connect().execute(sql, params).fetchall()
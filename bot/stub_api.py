@@ -0,0 +1,173 @@
+"""
+Stub of a local telegram-bot-api server, to try LOCAL_BOT_API mode without Telegram.
+
+    python -m bot.stub_api --port 8081   # serve and print every call; point LOCAL_BOT_API_URL here
+    python -m bot.stub_api --check       # send a part and an album through a stub in local mode
+
+Sends answer with fake messages. Documents passed as file:// URIs are reported with
+whether the file exists, which is what the real server needs in --local mode.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+from pathlib import Path
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        # /bot<token>/<method>
+        _, _, method = self.path.rpartition('/')
+        if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        else:
+            # Multipart: a file uploaded as bytes, which local mode with shared files avoids
+            params = {'multipart_bytes': len(body)}
+        self.server.calls.append((self.path, method, params))
+        self.server.log(method, params)
+        self._reply(self.server.answer(method, params))
+
+    do_GET = do_POST
+
+    def _reply(self, result):
+        data = json.dumps({'ok': True, 'result': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, verbose=True):
+        super().__init__(('127.0.0.1', port), StubHandler)
+        self.verbose = verbose
+        self.calls = []  # (path, method, params)
+        self.lock = threading.Lock()
+        self.message_id = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def log(self, method, params):
+        if not self.verbose:
+            return
+        documents = [params.get('document')] if 'document' in params else [m.get('media') for m in json.loads(params.get('media', '[]'))]
+        notes = []
+        for document in documents:
+            if isinstance(document, str) and document.startswith('file://'):
+                path = urlparse(document).path
+                notes.append(f"{path} ({'exists' if os.path.exists(path) else 'MISSING'})")
+        if 'multipart_bytes' in params:
+            notes.append(f"{params['multipart_bytes']} bytes uploaded")
+        print(f"{method} {' '.join(notes)}".rstrip(), flush=True)
+
+    def _message(self, chat_id, document=None):
+        with self.lock:
+            self.message_id += 1
+            message_id = self.message_id
+        message = {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': int(chat_id or 0), 'type': 'private'}}
+        if document is not None:
+            name = Path(urlparse(document).path).name if document.startswith('file://') else 'document'
+            message['document'] = {'file_id': f"stub-{message_id}", 'file_unique_id': f"u{message_id}", 'file_name': name}
+        return message
+
+    def answer(self, method, params):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Stub', 'username': 'stub_bot'}
+        if method == 'sendDocument':
+            return self._message(params.get('chat_id'), params.get('document', ''))
+        if method == 'sendMediaGroup':
+            media = json.loads(params.get('media', '[]'))
+            return [self._message(params.get('chat_id'), m.get('media', '')) for m in media]
+        if method == 'sendMessage':
+            return self._message(params.get('chat_id'))
+        if method == 'getUpdates':
+            time.sleep(1)
+            return []
+        return True
+
+def check():
+    """Sends through a stub the way bot.main wires local mode; returns a list of problems."""
+    server = StubServer(0, verbose=False)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ.update(LOCAL_BOT_API='true', LOCAL_BOT_API_SHARED_FILES='true', LOCAL_BOT_API_URL=server.url)
+    os.environ.setdefault('BOT_TOKEN', '123:stub')
+
+    import asyncio
+    from telegram.ext import ApplicationBuilder
+    from .config import BOT_TOKEN
+    from .splitter import FileChunk
+    from .transport import build_requests, use_local_api, request_pools
+    from .uploader import uploader
+
+    async def send(paths):
+        bot_request, updates_request = build_requests()
+        app = use_local_api(ApplicationBuilder().token(BOT_TOKEN).request(bot_request).get_updates_request(updates_request)).build()
+        await app.bot.initialize()
+        try:
+            await uploader.upload_chunk(app.bot, 42, paths[0], "part")
+            await uploader.upload_album(app.bot, 42, [FileChunk.whole(p) for p in paths], ["a", "b"])
+        finally:
+            await app.bot.shutdown()
+
+    problems = []
+    with tempfile.TemporaryDirectory() as folder:
+        paths = []
+        for name in ("part1.mp4", "part2.mp4"):
+            path = os.path.join(folder, name)
+            with open(path, 'wb') as f:
+                f.write(b'\0' * 1024)
+            paths.append(path)
+        asyncio.run(send(paths))
+        uris = [Path(p).absolute().as_uri() for p in paths]
+
+        sends = {method: (path, params) for path, method, params in server.calls}
+        for method in ('getMe', 'sendDocument', 'sendMediaGroup'):
+            if method not in sends:
+                problems.append(f"{method} never reached the stub")
+            elif sends[method][0] != f"/bot{BOT_TOKEN}/{method}":
+                problems.append(f"{method} went to {sends[method][0]}, not under base_url")
+        if 'sendDocument' in sends and sends['sendDocument'][1].get('document') != uris[0]:
+            problems.append(f"sendDocument did not pass the part as {uris[0]}")
+        if 'sendMediaGroup' in sends:
+            media = [m.get('media') for m in json.loads(sends['sendMediaGroup'][1].get('media', '[]'))]
+            if media != uris:
+                problems.append(f"sendMediaGroup passed {media}, not the file:// URIs")
+        if request_pools['media'].requests != 2:
+            problems.append(f"{request_pools['media'].requests} requests used the media pool, expected the 2 sends")
+    server.shutdown()
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub of a local telegram-bot-api server.")
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--check', action='store_true', help="verify local mode routing and file:// sends, then exit")
+    args = parser.parse_args()
+
+    if args.check:
+        problems = check()
+        for problem in problems:
+            print(f"FAIL: {problem}")
+        print("FAIL" if problems else "OK: local mode calls go to the stub and parts are sent as file:// paths")
+        sys.exit(1 if problems else 0)
+
+    server = StubServer(args.port)
+    print(f"Stub Bot API server on {server.url}, set LOCAL_BOT_API_URL to it")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import time
+from telegram.error import TimedOut
+from telegram.request import BaseRequest, HTTPXRequest
+from .config import (
+    LOCAL_BOT_API_URL, MEDIA_POOL_SIZE, CONTROL_POOL_SIZE, CONTROL_TIMEOUT, MEDIA_POOL_TIMEOUT, CONTROL_POOL_TIMEOUT, HTTP2
+)
+from .metrics import metrics
+from .logger import logger
+
+class PooledRequest(HTTPXRequest):
+    """HTTPXRequest that keeps counters on how busy its connection pool is."""
+    SATURATION_LOG_INTERVAL = 60
+
+    def __init__(self, name, connection_pool_size, **kwargs):
+        super().__init__(connection_pool_size=connection_pool_size, **kwargs)
+        self.name = name
+        self.size = connection_pool_size
+        self.in_flight = 0
+        self.peak = 0
+        self.requests = 0
+        self.saturated = 0      # requests that found every connection busy
+        self.pool_timeouts = 0  # requests that gave up waiting for a connection
+        self.last_warning = 0.0
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        self.requests += 1
+        if self.in_flight >= self.size:
+            self.saturated += 1
+            now = time.monotonic()
+            if now - self.last_warning > self.SATURATION_LOG_INTERVAL:
+                self.last_warning = now
+                logger.warning(f"HTTP pool '{self.name}' saturated: {self.in_flight} requests for {self.size} connections")
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            return await super().do_request(url, method, request_data, *args, **kwargs)
+        except TimedOut as e:
+            if "Pool timeout" in str(e):
+                self.pool_timeouts += 1
+            raise e
+        finally:
+            self.in_flight -= 1
+
+    def stats(self):
+        return {
+            'size': self.size, 'in_flight': self.in_flight, 'peak': self.peak,
+            'requests': self.requests, 'saturated': self.saturated, 'pool_timeouts': self.pool_timeouts,
+        }
+
+class RoutingRequest(BaseRequest):
+    """
+    Sends file uploads through the media pool and every other Bot API call through the
+    control pool, so large uploads cannot hold up edits and callback answers.
+    """
+    MEDIA_METHODS = {
+        'sendDocument', 'sendMediaGroup', 'sendVideo', 'sendAudio', 'sendAnimation',
+        'sendPhoto', 'sendVoice', 'sendVideoNote', 'editMessageMedia',
+    }
+
+    def __init__(self, control, media):
+        self.control = control
+        self.media = media
+
+    @property
+    def read_timeout(self):
+        return self.control.read_timeout
+
+    async def initialize(self):
+        await self.control.initialize()
+        await self.media.initialize()
+
+    async def shutdown(self):
+        await self.control.shutdown()
+        await self.media.shutdown()
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        is_media = endpoint in self.MEDIA_METHODS or (request_data is not None and request_data.contains_files)
+        target = self.media if is_media else self.control
+        return await target.do_request(url, method, request_data, *args, **kwargs)
+
+def _http_version():
+    if not HTTP2:
+        return "1.1"
+    try:
+        import h2  # noqa: F401
+        return "2"
+    except ImportError:
+        logger.warning("HTTP2 is enabled but the h2 package is missing (pip install httpx[http2]), using HTTP/1.1")
+        return "1.1"
+
+# Populated by build_requests, name -> PooledRequest
+request_pools = {}
+
+def build_requests():
+    """
+    Returns (bot request, getUpdates request) for the ApplicationBuilder.
+    HTTP/2 is only used for control calls: many small requests multiplex well on one
+    connection, while uploads get dedicated HTTP/1.1 connections.
+    """
+    control = PooledRequest(
+        "control", CONTROL_POOL_SIZE,
+        read_timeout=CONTROL_TIMEOUT, write_timeout=CONTROL_TIMEOUT, connect_timeout=CONTROL_TIMEOUT,
+        pool_timeout=CONTROL_POOL_TIMEOUT, http_version=_http_version()
+    )
+    media = PooledRequest(
+        "media", MEDIA_POOL_SIZE,
+        read_timeout=300, write_timeout=300, media_write_timeout=300, connect_timeout=60,
+        pool_timeout=MEDIA_POOL_TIMEOUT
+    )
+    # A single long poll is ever in flight; PTB adds the poll timeout to read_timeout
+    polling = PooledRequest("polling", 1, read_timeout=CONTROL_TIMEOUT, connect_timeout=CONTROL_TIMEOUT, pool_timeout=CONTROL_POOL_TIMEOUT)
+
+    request_pools.update(control=control, media=media, polling=polling)
+    return RoutingRequest(control, media), polling
+
+def use_local_api(builder, url=LOCAL_BOT_API_URL):
+    """Points an ApplicationBuilder at a self-hosted telegram-bot-api server running with --local."""
+    return builder.base_url(f"{url}/bot").base_file_url(f"{url}/file/bot").local_mode(True)
+
+def _pool_stat(field):
+    return lambda: {(('pool', name),): pool.stats()[field] for name, pool in request_pools.items()}
+
+metrics.gauge("bot_http_pool_size", "Connections per Bot API HTTP pool.", _pool_stat('size'))
+metrics.gauge("bot_http_pool_in_flight", "Requests in flight per Bot API HTTP pool.", _pool_stat('in_flight'))
+metrics.gauge("bot_http_pool_saturated", "Requests that found every connection of the pool busy.", _pool_stat('saturated'))
+metrics.gauge("bot_http_pool_timeouts", "Requests that gave up waiting for a pooled connection.", _pool_stat('pool_timeouts'))
@@ -0,0 +1,151 @@
+import time
+import heapq
+import asyncio
+import itertools
+from collections import deque
+from .config import UPLOAD_INITIAL_CONCURRENCY, UPLOAD_MIN_CONCURRENCY, UPLOAD_MAX_CONCURRENCY
+from .metrics import metrics
+from .logger import logger
+
+class UploadScheduler:
+    """
+    Process-wide gate for Bot API uploads with adaptive concurrency.
+
+    The number of uploads in flight follows AIMD: every successful upload while all
+    slots are busy grows the limit by 1/limit (about one slot per round), a RetryAfter
+    halves it and pauses every upload for the requested time, and network errors shrink
+    it by a quarter. Growth stops once another slot no longer raises the measured
+    throughput by at least PLATEAU_GAIN.
+
+    Free slots go to the job with the fewest uploads in flight, and within a job to the
+    lowest part index, so jobs get fair shares. Slots only order the starts: callers that
+    need their messages in order send one after another. An album takes one slot per part
+    it carries, which keeps the bytes held in memory bounded.
+    """
+    WINDOW = 30.0         # seconds of completed uploads used to measure throughput
+    PLATEAU_GAIN = 1.05
+
+    def __init__(self, initial=UPLOAD_INITIAL_CONCURRENCY, min_limit=UPLOAD_MIN_CONCURRENCY, max_limit=UPLOAD_MAX_CONCURRENCY):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.in_flight = 0
+        self.job_in_flight = {}  # job key -> uploads in flight
+        self.waiting = {}        # job key -> heap of (part_index, seq, weight, future)
+        self.seq = itertools.count()
+        self.paused_until = 0.0
+        self.resume_handle = None
+        self.completions = deque()  # (monotonic time, bytes)
+        self.busy_since = None
+        self.level_rate = {}        # slot count -> bytes/s observed with that many slots
+
+    async def acquire(self, job_key, part_index, weight=1):
+        """Waits for `weight` upload slots. Every acquire must be paired with a `release`."""
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting.setdefault(job_key, []), (part_index, next(self.seq), weight, future))
+        self._grant()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just before the cancellation arrived, hand the slot back
+                self.release(job_key, weight)
+            raise
+
+    def release(self, job_key, weight=1):
+        self.in_flight -= weight
+        count = self.job_in_flight.get(job_key, 0) - weight
+        if count > 0:
+            self.job_in_flight[job_key] = count
+        else:
+            self.job_in_flight.pop(job_key, None)
+        if self.in_flight == 0:
+            self.busy_since = None
+            self.completions.clear()
+        self._grant()
+
+    def report_success(self, nbytes):
+        """Records a finished upload; call it before releasing the slot."""
+        now = time.monotonic()
+        self.completions.append((now, nbytes))
+        while self.completions and self.completions[0][0] < now - self.WINDOW:
+            self.completions.popleft()
+
+        span = now - max(now - self.WINDOW, self.busy_since or now)
+        rate = sum(b for _, b in self.completions) / max(span, 1.0)
+        level = int(self.limit)
+        previous = self.level_rate.get(level)
+        self.level_rate[level] = rate if previous is None else 0.7 * previous + 0.3 * rate
+
+        if self.in_flight < level or level >= self.max_limit:
+            # Demand did not fill the slots, no evidence that more would help
+            return
+        lower = self.level_rate.get(level - 1)
+        if lower is not None and self.level_rate[level] < lower * self.PLATEAU_GAIN:
+            return
+
+        self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+        if int(self.limit) > level:
+            logger.info(f"Upload concurrency raised to {int(self.limit)} ({rate / 1024 / 1024:.1f} MB/s)")
+
+    def report_flood(self, retry_after):
+        """Telegram asked to slow down: halve the limit and hold all uploads for `retry_after` seconds."""
+        self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        self._decrease(0.5, f"flood control, pausing uploads for {retry_after:.0f}s")
+        # Throughput seen before the flood no longer tells what the API accepts
+        self.level_rate.clear()
+
+    def report_failure(self):
+        """A network error or timeout: back off moderately."""
+        self._decrease(0.75, "network error")
+
+    def _decrease(self, factor, reason):
+        level = int(self.limit)
+        self.limit = max(float(self.min_limit), self.limit * factor)
+        if int(self.limit) < level:
+            logger.warning(f"Upload concurrency lowered to {int(self.limit)} after {reason}")
+
+    def _next_job(self):
+        best = None
+        for job_key, heap in self.waiting.items():
+            rank = (self.job_in_flight.get(job_key, 0), heap[0][1])
+            if best is None or rank < best[0]:
+                best = (rank, job_key)
+        return best[1] if best else None
+
+    def _grant(self):
+        now = time.monotonic()
+        if now < self.paused_until:
+            if self.resume_handle is None:
+                self.resume_handle = asyncio.get_running_loop().call_later(self.paused_until - now, self._resume)
+            return
+
+        while self.in_flight < int(self.limit):
+            job_key = self._next_job()
+            if job_key is None:
+                return
+            heap = self.waiting[job_key]
+            _, _, weight, future = heap[0]
+            if not future.done() and self.in_flight and self.in_flight + weight > int(self.limit):
+                # Wait for room instead of letting smaller uploads overtake and starve it
+                return
+            heapq.heappop(heap)
+            if not heap:
+                del self.waiting[job_key]
+            if future.done():
+                # Waiter was cancelled
+                continue
+            if self.in_flight == 0:
+                self.busy_since = now
+            self.in_flight += weight
+            self.job_in_flight[job_key] = self.job_in_flight.get(job_key, 0) + weight
+            future.set_result(None)
+
+    def _resume(self):
+        self.resume_handle = None
+        self._grant()
+
+upload_scheduler = UploadScheduler()
+metrics.gauge("bot_upload_concurrency_limit", "Current adaptive upload concurrency limit.", lambda: int(upload_scheduler.limit))
+metrics.gauge("bot_uploads_in_flight", "Upload slots in use.", lambda: upload_scheduler.in_flight)
+metrics.gauge("bot_uploads_waiting", "Uploads waiting for a slot.", lambda: sum(len(h) for h in upload_scheduler.waiting.values()))
@@ -1,58 +1,228 @@
-import os
+import time
 import asyncio
+from pathlib import Path
+from telegram import InputMediaDocument
+from telegram.error import RetryAfter, NetworkError
+from .splitter import FileChunk
+from .upload_scheduler import upload_scheduler
+from .utils import retry_after_seconds
+from .cache import file_cache
+from .config import LOCAL_BOT_API, LOCAL_BOT_API_SHARED_FILES, STALL_WINDOW, STALL_MIN_SPEED_KB
+from .watchdog import StageStalled
+from .metrics import metrics
 from .logger import logger
 
 class TelegramUploader:
-    async def upload_chunk(self, bot, chat_id, file_path, caption, progress_callback=None):
+    MAX_FLOOD_WAITS = 10
+
+    def in_memory(self, chunk):
+        """Whether sending the chunk holds its bytes in memory (everything but file:// references)."""
+        return not (LOCAL_BOT_API and LOCAL_BOT_API_SHARED_FILES and chunk.is_whole_file())
+
+    async def _load(self, chunk):
+        """Returns what to pass as the document: a file:// URI for a local server, the bytes otherwise."""
+        if not self.in_memory(chunk):
+            # The local Bot API server opens the file itself, no bytes pass through the bot
+            return Path(chunk.path).absolute().as_uri()
+        # python-telegram-bot reads the whole document into memory anyway,
+        # so read exactly the range off the event loop and hand over the bytes.
+        # No part file is ever written for virtual chunks.
+        return await asyncio.to_thread(chunk.read)
+
+    async def _send_with_retries(self, send, label, nbytes, job_key, part_index, weight=1, retries=3):
         """
-        Uploads a file using the official python-telegram-bot instance.
+        Runs `send()` in slots of the shared upload scheduler.
+        Flood waits are held by the scheduler and do not count as attempts;
+        other errors are retried `retries` times with backoff. The request body cannot
+        report progress, so an attempt slower than the stall floor for its size is
+        abandoned and retried.
         """
-        retries = 3
+        deadline = max(STALL_WINDOW, nbytes / (STALL_MIN_SPEED_KB * 1024))
         backoff = 2
+        attempt = 0
+        floods = 0
 
-        for attempt in range(retries):
+        while True:
+            await upload_scheduler.acquire(job_key, part_index, weight)
             try:
-                # Use standard 'open' and let python-telegram-bot handle it.
-                # This ensures we use all official stuff (httpx underneath).
-                # Progress is sacrificed for simplicity and standard compliance.
+                started = time.monotonic()
+                try:
+                    result = await asyncio.wait_for(send(), timeout=deadline)
+                except asyncio.TimeoutError:
+                    raise StageStalled(f"Upload of {label} stalled, no response after {deadline:.0f}s")
+                upload_scheduler.report_success(nbytes)
+                elapsed = time.monotonic() - started
+                metrics.stage_seconds.observe(elapsed, stage="upload_request", outcome="ok")
+                if elapsed > 0:
+                    metrics.throughput.observe(nbytes / elapsed, stage="upload_request")
+                return result
 
-                # We can simulate progress "start" and "end" if needed in the handler.
-                if progress_callback:
-                    try:
-                        # Fake start
-                        file_size = os.path.getsize(file_path)
-                        await progress_callback(0, file_size)
-                    except:
-                        pass
+            except RetryAfter as e:
+                # Telegram says exactly when to come back; the scheduler holds every upload until then
+                wait = retry_after_seconds(e)
+                metrics.retry_after.inc(kind="upload")
+                upload_scheduler.report_flood(wait)
+                floods += 1
+                if floods > self.MAX_FLOOD_WAITS:
+                    raise e
+                logger.warning(f"Upload of {label} hit flood control, retrying in {wait:.0f}s", extra={'sample': 'upload_retry'})
+                continue
+
+            except Exception as e:
+                if isinstance(e, (NetworkError, StageStalled)):
+                    upload_scheduler.report_failure()
+                attempt += 1
+                logger.warning(f"Upload attempt {attempt} of {label} failed: {e}", extra={'sample': 'upload_retry'})
+                if attempt >= retries:
+                    # Let the caller deal with final failure
+                    raise e
+
+            finally:
+                upload_scheduler.release(job_key, weight)
+
+            await asyncio.sleep(backoff)
+            backoff *= 2
 
-                # 5 minute timeout for 50MB is generous.
-                with open(file_path, 'rb') as f:
-                    await bot.send_document(
-                        chat_id=chat_id,
-                        document=f,
-                        caption=caption,
-                        read_timeout=300,
-                        write_timeout=300,
-                        connect_timeout=60
-                    )
-
-                if progress_callback:
+    async def _finish(self, message, chunk, progress_callback, cache_key):
+        if cache_key and file_cache and message.document:
+            try:
+                await asyncio.to_thread(
+                    file_cache.put_part, *cache_key,
+                    message.document.file_id, chunk.name, chunk.length
+                )
+            except Exception as e:
+                logger.warning(f"Could not record file_id for {chunk.name}: {e}")
+
+        if progress_callback:
+            try:
+                # Fake end
+                await progress_callback(chunk.length, chunk.length)
+            except:
+                pass
+
+    async def upload_chunk(self, bot, chat_id, chunk, caption, progress_callback=None, cache_key=None, job_key=None, part_index=0):
+        """
+        Uploads a chunk using the official python-telegram-bot instance.
+        `chunk` is a FileChunk (a byte range of a file) or a plain file path.
+        cache_key: optional (video_key, format_id, chunk_size, part_index) to record the file_id under.
+        job_key and part_index place the upload in the shared upload scheduler's queue.
+        Returns the sent message.
+        """
+        if isinstance(chunk, str):
+            chunk = FileChunk.whole(chunk)
+        if job_key is None:
+            job_key = chat_id
+
+        # We can simulate progress "start" and "end" if needed in the handler.
+        file_size = chunk.length
+
+        async def send():
+            if progress_callback:
+                try:
+                    # Fake start
+                    await progress_callback(0, file_size)
+                except:
+                    pass
+
+            # 5 minutes is generous for 50MB; 2000MB parts on a local server get at least 1MB/s
+            return await bot.send_document(
+                chat_id=chat_id,
+                document=await self._load(chunk),
+                filename=chunk.name,
+                caption=caption,
+                read_timeout=max(300, file_size / (1024 * 1024)),
+                write_timeout=300,
+                connect_timeout=60
+            )
+
+        message = await self._send_with_retries(send, chunk.name, file_size, job_key, part_index)
+        await self._finish(message, chunk, progress_callback, cache_key)
+        return message
+
+    async def upload_album(self, bot, chat_id, chunks, captions, progress_callbacks=None, cache_keys=None, job_key=None, part_index=0):
+        """
+        Uploads up to 10 chunks as one sendMediaGroup album, in order, with a caption per part.
+        The lists are aligned with `chunks`; part_index is the index of the first chunk.
+        Unless the server reads the files itself, all members are in memory for the request,
+        so callers cap albums by total size (ALBUM_MAX_MB). An album succeeds or fails as a whole:
+        a failed album is split in halves, and only a half that fails again is split further,
+        down to single parts. Returns the sent messages in order.
+        """
+        count = len(chunks)
+        progress_callbacks = progress_callbacks or [None] * count
+        cache_keys = cache_keys or [None] * count
+        if job_key is None:
+            job_key = chat_id
+
+        if count == 1:
+            return [await self.upload_chunk(
+                bot, chat_id, chunks[0], captions[0], progress_callbacks[0], cache_keys[0], job_key, part_index
+            )]
+
+        total_size = sum(c.length for c in chunks)
+        label = f"{chunks[0].name} (+{count - 1} parts)"
+
+        async def send():
+            media = []
+            for chunk, caption, callback in zip(chunks, captions, progress_callbacks):
+                if callback:
                     try:
-                        # Fake end
-                        await progress_callback(file_size, file_size)
+                        await callback(0, chunk.length)
                     except:
                         pass
+                media.append(InputMediaDocument(await self._load(chunk), caption=caption, filename=chunk.name))
 
-                return True
+            timeout = max(300, total_size / (1024 * 1024))
+            return await bot.send_media_group(
+                chat_id=chat_id,
+                media=media,
+                read_timeout=timeout,
+                write_timeout=timeout,
+                connect_timeout=60
+            )
 
-            except Exception as e:
-                logger.warning(f"Upload attempt {attempt+1} failed: {e}")
-                if attempt < retries - 1:
-                    await asyncio.sleep(backoff)
-                    backoff *= 2
-                else:
-                    # Let the handler deal with final failure
+        try:
+            messages = await self._send_with_retries(send, label, total_size, job_key, part_index, weight=count, retries=1)
+        except RetryAfter:
+            raise
+        except Exception as e:
+            half = count // 2
+            logger.warning(f"Album {label} failed, sending it as albums of {half} and {count - half} parts: {e}")
+            messages = []
+            for start, end in ((0, half), (half, count)):
+                messages.extend(await self.upload_album(
+                    bot, chat_id, chunks[start:end], captions[start:end], progress_callbacks[start:end],
+                    cache_keys[start:end], job_key, part_index + start
+                ))
+            return messages
+
+        for message, chunk, callback, cache_key in zip(messages, chunks, progress_callbacks, cache_keys):
+            await self._finish(message, chunk, callback, cache_key)
+        return messages
+
+    async def _with_flood_waits(self, send):
+        floods = 0
+        while True:
+            try:
+                return await send()
+            except RetryAfter as e:
+                metrics.retry_after.inc(kind="cached_send")
+                floods += 1
+                if floods > self.MAX_FLOOD_WAITS:
                     raise e
-        return False
+                await asyncio.sleep(retry_after_seconds(e))
+
+    async def send_cached(self, bot, chat_id, file_id, caption):
+        """Re-sends an already uploaded document by its file_id, no bytes are transferred."""
+        return await self._with_flood_waits(
+            lambda: bot.send_document(chat_id=chat_id, document=file_id, caption=caption)
+        )
+
+    async def send_cached_album(self, bot, chat_id, file_ids, captions):
+        """Re-sends up to 10 already uploaded documents as one album."""
+        if len(file_ids) == 1:
+            return await self.send_cached(bot, chat_id, file_ids[0], captions[0])
+        media = [InputMediaDocument(file_id, caption=caption) for file_id, caption in zip(file_ids, captions)]
+        return await self._with_flood_waits(lambda: bot.send_media_group(chat_id=chat_id, media=media))
 
 uploader = TelegramUploader()
@@ -2,6 +2,8 @@ import re
 import os
 import shutil
 import string
+import datetime
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
 def sanitize_filename(name):
     """
@@ -14,6 +16,26 @@ def sanitize_filename(name):
     name = re.sub(r'\s+', ' ', name).strip()
     return name
 
+# Query parameters that only track where a link was shared from
+TRACKING_PARAMS = {'si', 'feature', 'fbclid', 'gclid', 'igshid', 'ref', 'ref_src'}
+
+def normalize_url(url):
+    """
+    Normalizes a URL so that reposts of the same link map to one key.
+    Lowercases scheme and host, drops the fragment and tracking parameters, sorts the query.
+    """
+    parts = urlsplit(url.strip())
+    query = [
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k not in TRACKING_PARAMS and not k.startswith('utm_')
+    ]
+    query.sort()
+    netloc = parts.netloc.lower()
+    if netloc.startswith('www.'):
+        netloc = netloc[4:]
+    path = parts.path.rstrip('/') or '/'
+    return urlunsplit((parts.scheme.lower(), netloc, path, urlencode(query), ''))
+
 def get_chunk_suffix(index):
     """
     Generates a suffix like 'Part A', 'Part B' ... 'Part Z', 'Part AA', etc.
@@ -48,15 +70,19 @@ def cleanup_temp_dir(path):
         except Exception as e:
             print(f"Error cleaning up {path}: {e}")
 
-def cleanup_download_dir(download_path):
+def cleanup_download_dir(download_path, keep=()):
     """
     Cleans up the entire download directory on startup.
+    Directories listed in `keep` (work of jobs that will resume) are left alone.
     """
+    keep = {os.path.abspath(path) for path in keep}
     if os.path.exists(download_path):
         try:
             # Delete all subdirectories (user sessions)
             for item in os.listdir(download_path):
                 item_path = os.path.join(download_path, item)
+                if os.path.abspath(item_path) in keep:
+                    continue
                 if os.path.isdir(item_path):
                     shutil.rmtree(item_path)
                 else:
@@ -76,3 +102,24 @@ def human_readable_size(size, decimal_places=2):
             return f"{size:.{decimal_places}f} {unit}"
         size /= 1024.0
     return f"{size:.{decimal_places}f} PB"
+
+def human_readable_duration(seconds):
+    """
+    Converts seconds to a short string (e.g. 45s, 3m 20s, 1h 05m).
+    """
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds // 3600}h {(seconds % 3600) // 60:02d}m"
+
+def retry_after_seconds(error):
+    """
+    Seconds to wait from a telegram RetryAfter error.
+    Newer python-telegram-bot versions report a timedelta instead of an int.
+    """
+    value = error.retry_after
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    return float(value)
@@ -0,0 +1,108 @@
+import time
+import asyncio
+from collections import deque
+from contextlib import contextmanager
+from .config import WATCHDOG_INTERVAL, STALL_WINDOW, STALL_MIN_SPEED_KB
+from .utils import human_readable_duration
+from .logger import logger
+
+class StageStalled(Exception):
+    """A job stage was aborted for making too little progress or running past its deadline."""
+    pass
+
+class StageWatch:
+    __slots__ = ('stage', 'label', 'on_stall', 'progress', 'deadline', 'timings', 'log_ctx', 'started', 'samples', 'fired')
+
+    def __init__(self, stage, label, on_stall, progress, deadline, timings, log_ctx):
+        self.stage = stage
+        self.label = label
+        self.on_stall = on_stall
+        self.progress = progress
+        self.deadline = deadline
+        self.timings = timings
+        self.log_ctx = log_ctx or {}
+        self.started = time.monotonic()
+        self.samples = deque()  # (monotonic time, bytes)
+        self.fired = False
+
+class Watchdog:
+    """
+    Aborts job stages that stop making progress, so stuck downloads do not hold
+    scheduler slots and pool threads forever.
+
+    A watched stage reports a byte counter through `progress()` (None while it cannot
+    be measured, e.g. during post-processing). If the counter grows slower than
+    STALL_MIN_SPEED_KB over STALL_WINDOW seconds, or the stage runs past its deadline,
+    `on_stall(StageStalled)` is called once and the intervention is logged with the
+    job's stage timings.
+    """
+    def __init__(self, interval=WATCHDOG_INTERVAL, window=STALL_WINDOW, min_speed=STALL_MIN_SPEED_KB * 1024):
+        self.interval = interval
+        self.window = window
+        self.min_speed = min_speed
+        self.watches = set()
+        self.task = None
+
+    @contextmanager
+    def watch(self, stage, label, on_stall, progress=None, deadline=0, timings=None, log_ctx=None):
+        """
+        Watches the code in the block. `timings` (a dict) receives the stage duration
+        on exit and is included in the log line of any intervention.
+        """
+        watch = StageWatch(stage, label, on_stall, progress, deadline, timings, log_ctx)
+        self.watches.add(watch)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        try:
+            yield watch
+        finally:
+            self.watches.discard(watch)
+            if timings is not None:
+                timings[stage] = round(time.monotonic() - watch.started, 1)
+
+    async def _run(self):
+        while self.watches:
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            for watch in list(self.watches):
+                if not watch.fired:
+                    try:
+                        self._check(watch, now)
+                    except Exception as e:
+                        logger.warning(f"Watchdog check of {watch.stage} failed: {e}", extra=watch.log_ctx)
+
+    def _check(self, watch, now):
+        elapsed = now - watch.started
+        if watch.deadline and elapsed > watch.deadline:
+            self._fire(watch, f"{watch.stage} exceeded its deadline of {human_readable_duration(watch.deadline)}", elapsed)
+            return
+        if watch.progress is None:
+            return
+
+        value = watch.progress()
+        samples = watch.samples
+        if value is None or (samples and value < samples[-1][1]):
+            # Not measurable right now, or a new file started: restart the window
+            samples.clear()
+            if value is None:
+                return
+        samples.append((now, value))
+        # Keep one sample at or before the start of the window
+        while len(samples) > 1 and samples[1][0] <= now - self.window:
+            samples.popleft()
+
+        first_time, first_value = samples[0]
+        if now - first_time < self.window:
+            return
+        speed = (value - first_value) / (now - first_time)
+        if speed < self.min_speed:
+            self._fire(watch, f"{watch.stage} stalled at {speed / 1024:.1f} KB/s over {human_readable_duration(now - first_time)}", elapsed)
+
+    def _fire(self, watch, reason, elapsed):
+        watch.fired = True
+        timings = dict(watch.timings or {})
+        timings[watch.stage] = round(elapsed, 1)
+        logger.warning(f"Watchdog aborting {watch.label}: {reason} (stage timings: {timings})", extra=watch.log_ctx)
+        watch.on_stall(StageStalled(f"The {reason}."))
+
+watchdog = Watchdog()